@@ -0,0 +1,51 @@
+# Copyright (c) Matt Haggard.
+# See LICENSE for details.
+
+"""
+Measure how long it takes to compile large constraints.
+
+    python bench/compile.py [terms ...]
+
+If compiling takes time in proportion to the number of terms, the time per
+term stays about the same as the number of terms grows.
+"""
+
+import sys
+import time
+
+from norm.orm.props import Int, String
+from norm.orm.expr import Query, And, Or, compiler
+
+
+
+class Thing(object):
+    __sql_table__ = 'thing'
+    id = Int(primary=True)
+    name = String()
+
+
+
+def measure(query):
+    best = None
+    for i in xrange(3):
+        start = time.time()
+        compiler.compile(query)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main(*counts):
+    counts = counts or (1000, 10000, 100000)
+    print '%-8s %12s %15s' % ('terms', 'seconds', 'us per term')
+    for count in counts:
+        query = Query(Thing, Or(*[And(Thing.id == i, Thing.name == 'x')
+                                  for i in xrange(count)]))
+        elapsed = measure(query)
+        print '%-8d %12.4f %15.2f' % (count, elapsed,
+                                       elapsed / count * 1000000)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,116 @@
+# Copyright (c) Matt Haggard.
+# See LICENSE for details.
+
+"""
+Measure how many rows per second can be turned into objects.
+
+    python bench/materialize.py [rows]
+
+This compares L{BaseOperator._makeObjects} with the way it was done before
+there was a L{RowMaterializer} (zipping each row with the query's properties,
+converting each value and setting it with L{Property.fromDatabase}, which
+validates it and resets the object's changes).
+"""
+
+import sys
+import time
+from collections import defaultdict
+from datetime import date
+
+from norm.sqlite import SqliteOperator
+from norm.orm.props import Int, String, Unicode, Date, Bool
+from norm.orm.expr import Query
+
+
+
+class Thing(object):
+    __sql_table__ = 'thing'
+    id = Int(primary=True)
+    name = String()
+    uni = Unicode()
+    date = Date()
+    mybool = Bool()
+
+
+
+class Other(object):
+    __sql_table__ = 'other'
+    id = Int(primary=True)
+    thing_id = Int()
+
+
+
+def legacyReconstitute(data):
+    """
+    L{reconstitute} as it was, setting each value with
+    L{Property.fromDatabase}.
+    """
+    classes = []
+    class_data = defaultdict(lambda:[])
+    for prop, value in data:
+        if prop.cls not in classes:
+            classes.append(prop.cls)
+        class_data[prop.cls].append((prop, value))
+    ret = []
+    for cls in classes:
+        obj = cls.__new__(cls)
+        empty_obj = True
+        for prop, value in class_data[cls]:
+            if empty_obj and value is not None:
+                empty_obj = False
+            prop.fromDatabase(obj, value)
+        if empty_obj:
+            ret.append(None)
+        else:
+            ret.append(obj)
+    if len(ret) == 1:
+        return ret[0]
+    return ret
+
+
+def reconstituteRows(oper, rows, query):
+    ret = []
+    props = query.properties()
+    for row in rows:
+        data = zip(props, row)
+        data = [(x[0], oper.fromDB.convert(x[0].__class__, x[1]))
+                for x in data]
+        ret.append(legacyReconstitute(data))
+    return ret
+
+
+def materializeRows(oper, rows, query):
+    return oper._makeObjects(rows, query)
+
+
+def measure(func, oper, rows, query):
+    best = None
+    for i in xrange(3):
+        start = time.time()
+        func(oper, rows, query)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(rows) / best
+
+
+def main(count=50000):
+    oper = SqliteOperator()
+    day = date(2001, 1, 1)
+    cases = [
+        ('one class', Query(Thing),
+         [(day, i, 1, 'name', u'uni') for i in xrange(count)]),
+        ('two classes', Query((Thing, Other)),
+         [(day, i, 1, 'name', u'uni', i, i)
+          for i in xrange(count)]),
+    ]
+    print '%-12s %15s %15s %8s' % ('', 'before rows/s', 'after rows/s',
+                                   'speedup')
+    for name, query, rows in cases:
+        before = measure(reconstituteRows, oper, rows, query)
+        after = measure(materializeRows, oper, rows, query)
+        print '%-12s %15d %15d %7.2fx' % (name, before, after, after / before)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -2,13 +2,18 @@
 # See LICENSE for details.
 
 from zope.interface import implements
-from twisted.internet import defer
+from twisted.internet import defer, threads, task
+from twisted.python.failure import Failure
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
 
 from functools import partial
+from bisect import bisect_left
 
 from collections import deque, defaultdict
 
 from norm.interface import IAsyncCursor, IRunner, IPool
+from norm.error import Error
 
 
 
@@ -28,6 +33,10 @@ class BlockingCursor(object):
         return defer.maybeDeferred(self.cursor.execute, sql, params)
 
 
+    def executemany(self, sql, param_list):
+        return defer.maybeDeferred(self.cursor.executemany, sql, param_list)
+
+
     def fetchone(self):
         return defer.maybeDeferred(self.cursor.fetchone)
 
@@ -36,10 +45,33 @@ class BlockingCursor(object):
         return defer.maybeDeferred(self.cursor.fetchall)
 
 
+    def fetchmany(self, size):
+        return defer.maybeDeferred(self.cursor.fetchmany, size)
+
+
+    @defer.inlineCallbacks
+    def stream(self, sql, params, func, size=1000):
+        """
+        Execute C{sql} and give the rows to C{func} C{size} at a time.  Most
+        DB-API2 cursors (SQLite's included) step through results as they are
+        fetched, so only one batch is held in memory at a time.
+        """
+        yield self.execute(sql, params)
+        while True:
+            rows = yield self.fetchmany(size)
+            if not rows:
+                break
+            yield func(rows)
+
+
     def lastRowId(self):
         return defer.succeed(self.cursor.lastrowid)
 
 
+    def rowCount(self):
+        return defer.succeed(self.cursor.rowcount)
+
+
     def close(self):
         return defer.maybeDeferred(self.cursor.close)
 
@@ -80,6 +112,14 @@ class BlockingRunner(object):
         return cursor.execute(qry, params)
 
 
+    def runMany(self, qry, param_list):
+        return self.runInteraction(self._runMany, qry, param_list)
+
+
+    def _runMany(self, cursor, qry, param_list):
+        return cursor.executemany(qry, param_list)
+
+
     def runInteraction(self, function, *args, **kwargs):
         cursor = self.cursorFactory(self.conn.cursor())
         d = defer.maybeDeferred(function, cursor, *args, **kwargs)
@@ -103,17 +143,366 @@ class BlockingRunner(object):
 
 
 
+def _synchronousResult(d):
+    """
+    Return the result of a C{Deferred} that has already fired, raising the
+    exception if it failed.
+
+    @raise Error: If C{d} has not fired yet.
+    """
+    results = []
+    d.addBoth(results.append)
+    if not results:
+        raise Error('Interaction did not complete synchronously.  Only '
+                    'blocking cursors may be used in a threaded runner.')
+    result = results[0]
+    if isinstance(result, Failure):
+        result.raiseException()
+    return result
+
+
+
+class ThreadedRunner(object):
+    """
+    I run interactions against a single DB-API2 connection in a dedicated
+    worker thread so that blocking database work doesn't stall the reactor.
+
+    The connection is made (and only ever used) in my worker thread, so
+    connections which must stay on the thread that created them (like
+    SQLite's) are fine.  Entire interactions run in that thread, which means
+    the cursors handed to interactions fire their C{Deferred}s synchronously.
+    """
+
+    implements(IRunner)
+
+    cursorFactory = BlockingCursor
+
+
+    def __init__(self, connect, reactor=None):
+        """
+        @param connect: A function accepting no arguments which returns a
+            synchronous database connection.  It will be called in my worker
+            thread the first time I'm used.
+        @param reactor: The reactor to deliver results to (defaults to the
+            global reactor).
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.conn = None
+        self._connect = connect
+        self.threadpool = ThreadPool(1, 1, 'norm.ThreadedRunner')
+        self.threadpool.start()
+        self._shutdownTrigger = reactor.addSystemEventTrigger(
+            'during', 'shutdown', self._stop)
+
+
+    def _inThread(self, func, *args, **kwargs):
+        return threads.deferToThreadPool(self.reactor, self.threadpool,
+                                         func, *args, **kwargs)
+
+
+    def _connection(self):
+        if self.conn is None:
+            self.conn = self._connect()
+        return self.conn
+
+
+    def runQuery(self, qry, params=()):
+        return self.runInteraction(self._runQuery, qry, params)
+
+
+    def _runQuery(self, cursor, qry, params):
+        d = cursor.execute(qry, params)
+        d.addCallback(lambda _: cursor.fetchall())
+        return d
+
+
+    def runOperation(self, qry, params=()):
+        return self.runInteraction(self._runOperation, qry, params)
+
+
+    def _runOperation(self, cursor, qry, params):
+        return cursor.execute(qry, params)
+
+
+    def runMany(self, qry, param_list):
+        return self.runInteraction(self._runMany, qry, param_list)
+
+
+    def _runMany(self, cursor, qry, param_list):
+        return cursor.executemany(qry, param_list)
+
+
+    def runInteraction(self, function, *args, **kwargs):
+        return self._inThread(self._runInteraction, function, *args, **kwargs)
+
+
+    def _runInteraction(self, function, *args, **kwargs):
+        """
+        Run C{function} to completion in the worker thread, then commit (or
+        roll back if it failed).
+        """
+        conn = self._connection()
+        cursor = self.cursorFactory(conn.cursor())
+        try:
+            result = _synchronousResult(
+                defer.maybeDeferred(function, cursor, *args, **kwargs))
+        except:
+            conn.rollback()
+            raise
+        conn.commit()
+        return result
+
+
+    def close(self):
+        if self.threadpool.joined:
+            return defer.succeed(None)
+        d = self._inThread(self._close)
+        return d.addBoth(self._stopAndPassthrough)
+
+
+    def _close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+    def _stopAndPassthrough(self, result):
+        if self._shutdownTrigger is not None:
+            self.reactor.removeSystemEventTrigger(self._shutdownTrigger)
+            self._shutdownTrigger = None
+        self._stop()
+        return result
+
+
+    def _stop(self):
+        if not self.threadpool.joined:
+            self.threadpool.stop()
+
+
+
+class PoolMetrics(object):
+    """
+    I keep track of how a L{ConnectionPool} is being used: how long things
+    wait for a connection and how many statements and errors each connection
+    has had.
+
+    @ivar wait_buckets: The upper bounds (in seconds) of the buckets of the
+        wait time histogram.  Waits longer than the last one are counted in
+        an extra bucket.
+    @ivar sink: A function called with C{(event, data)} for each checkout
+        (C{event} is C{'checkout'}) and release (C{'release'}) of a
+        connection, where C{data} is a dictionary of measurements.
+    """
+
+    wait_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_counts = [0] * (len(self.wait_buckets) + 1)
+        self.queries = defaultdict(int)
+        self.errors = defaultdict(int)
+
+
+    def checkedOut(self, conn, wait, **data):
+        """
+        Record that C{conn} was handed out after waiting C{wait} seconds.
+        """
+        self.checkouts += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.wait_counts[bisect_left(self.wait_buckets, wait)] += 1
+        if self.sink is not None:
+            data['wait'] = wait
+            self.sink('checkout', data)
+
+
+    def released(self, conn, duration, failed, statements=1, **data):
+        """
+        Record that C{conn} is done being used for C{duration} seconds, in
+        which it executed C{statements} statements.
+        """
+        self.queries[conn] += statements
+        if failed:
+            self.errors[conn] += 1
+        if self.sink is not None:
+            data['duration'] = duration
+            data['failed'] = failed
+            self.sink('release', data)
+
+
+    def forget(self, conn):
+        """
+        Stop keeping counts for a connection that's gone.
+        """
+        self.queries.pop(conn, None)
+        self.errors.pop(conn, None)
+
+
+    def waitHistogram(self):
+        """
+        Get a list of C{(upper bound, count)} for the wait times.  The last
+        bound is C{None}.
+        """
+        return zip(self.wait_buckets + (None,), self.wait_counts)
+
+
+
+def _failedWith(failure, names):
+    """
+    Whether a failure is from an exception with one of the given class names
+    (of any module).
+    """
+    parents = set([x.rsplit('.', 1)[-1] for x in failure.parents])
+    return bool(parents.intersection(names))
+
+
+
+class _Disconnected(Exception):
+    """
+    Something failed because its connection was lost.
+    """
+
+
+    def __init__(self, conn, failure):
+        Exception.__init__(self, conn, failure)
+        self.conn = conn
+        self.failure = failure
+
+
+
+class _WatchedCursor(object):
+    """
+    I pass everything through to a cursor, counting the statements executed
+    for an L{_Attempt}.
+    """
+
+
+    def __init__(self, cursor, attempt):
+        self._cursor = cursor
+        self._attempt = attempt
+
+
+    def __getattr__(self, name):
+        value = getattr(self._cursor, name)
+        if name in ('execute', 'executemany', 'stream', 'copyFrom'):
+            self._attempt.statements += 1
+        return value
+
+
+
+class _Attempt(object):
+    """
+    I run an interaction, keeping track of how far it got so that a
+    L{ConnectionPool} can tell whether it's safe to try it again.
+
+    @ivar statements: The number of statements it has executed.
+    @ivar finished: Whether it finished (so the failure was in committing).
+    """
+
+
+    def __init__(self, function):
+        self.function = function
+        self.statements = 0
+        self.finished = False
+
+
+    def __call__(self, cursor, *args, **kwargs):
+        d = defer.maybeDeferred(self.function, _WatchedCursor(cursor, self),
+                                *args, **kwargs)
+        d.addCallback(self._finished)
+        return d
+
+
+    def _finished(self, result):
+        self.finished = True
+        return result
+
+
+
 class ConnectionPool(object):
+    """
+    I run things on connections from a pool of connections.
+
+    If I've been told how to make connections (with L{setConnect}) I can
+    also grow and shrink:
+
+        - When something has to wait for a connection and I have fewer than
+          C{max_size} connections, I make a new one.
+
+        - Every C{check_interval} seconds, I L{check} my idle connections:
+          those which have been idle longer than C{idle_timeout} are closed
+          (as long as I keep at least C{min_size}), those older than
+          C{max_lifetime} are replaced, and the rest are tested with a
+          C{select 1} and replaced if they're broken.
+
+        - When something fails with an error from a lost connection (see
+          C{disconnect_errors}) and a C{select 1} on the connection fails
+          too, the connection is closed and replaced.  What failed is tried
+          again on another connection if nothing it did could have been
+          applied: an interaction which failed on its first statement, or a
+          single statement which was never sent (see C{unsent_errors}).
+
+    @ivar disconnect_errors: Names of the exceptions (of any database
+        module) which a lost connection causes.
+    @ivar unsent_errors: Names of the exceptions which mean the connection
+        was closed before a statement was sent.
+    """
 
 
     implements(IRunner)
 
     db_scheme = None
+    disconnect_errors = ('OperationalError', 'InterfaceError')
+    unsent_errors = ('InterfaceError',)
 
 
-    def __init__(self, pool=None):
+    def __init__(self, pool=None, min_size=0, max_size=None,
+                 idle_timeout=None, max_lifetime=None, check_interval=None,
+                 check_timeout=10, clock=None, sink=None):
+        """
+        @param pool: An L{IPool} to hold the connections.
+        @param min_size: The fewest connections to have.
+        @param max_size: The most connections to have, or C{None} to only
+            make new connections when there are none.
+        @param idle_timeout: Seconds a connection can be unused before it's
+            closed, or C{None} to keep idle connections.
+        @param max_lifetime: Seconds after which a connection is replaced,
+            or C{None} to keep connections forever.
+        @param check_interval: Seconds between calls to L{check}, or C{None}
+            to not check periodically.
+        @param check_timeout: Seconds to wait for the C{select 1} which tests
+            a connection before treating it as broken, or C{None} to wait
+            forever.
+        @param clock: An L{IReactorTime} provider (defaults to the reactor).
+        @param sink: A function to be given measurements as connections are
+            used.  See L{PoolMetrics}.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
         self.pool = pool or NextAvailablePool()
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.check_timeout = check_timeout
+        self.clock = clock
         self._makeConnection = None
+        self._connecting = 0
+        self._checking = set()
+        self._created = {}
+        self._last_used = {}
+        self._checker = None
+        self.metrics = PoolMetrics(sink)
+        if check_interval is not None:
+            self._checker = task.LoopingCall(self.check)
+            self._checker.clock = clock
+            self._checker.start(check_interval, now=False)
 
 
     def setConnect(self, func, *args, **kwargs):
@@ -132,9 +521,139 @@ class ConnectionPool(object):
 
 
     def add(self, conn):
+        now = self.clock.seconds()
+        self._created[conn] = now
+        self._last_used[conn] = now
+        self.pool.add(conn)
+
+
+    def size(self):
+        """
+        Get the number of connections I have (including ones being made and
+        ones being checked).
+        """
+        return len(self.pool.list()) + self._connecting + len(self._checking)
+
+
+    def _canGrow(self):
+        if self._makeConnection is None:
+            return False
+        size = self.size()
+        if self.max_size is None:
+            return size == 0
+        return size < self.max_size
+
+
+    def _grow(self):
+        self._connecting += 1
+        d = self.makeConnection()
+        d.addBoth(self._connected)
+        return d
+
+
+    def _connected(self, result):
+        self._connecting -= 1
+        if isinstance(result, Failure):
+            log.err(result, 'Error making a new connection')
+            return None
+        self.add(result)
+        return result
+
+
+    def _fill(self):
+        """
+        Make connections until I have at least C{min_size}.
+        """
+        dlist = []
+        if self._makeConnection is not None:
+            while self.size() < self.min_size:
+                dlist.append(self._grow())
+        return defer.gatherResults(dlist)
+
+
+    def _forget(self, conn):
+        self._created.pop(conn, None)
+        self._last_used.pop(conn, None)
+        self.metrics.forget(conn)
+
+
+    def _retire(self, conn):
+        """
+        Remove a connection from the pool and close it.
+        """
+        self._forget(conn)
+        d = self.pool.remove(conn)
+        d.addCallback(lambda conn: conn.close())
+        d.addErrback(log.err, 'Error closing a connection')
+        return d
+
+
+    def check(self):
+        """
+        Close or replace idle connections which are too old, idle too long
+        or broken, and make sure I have at least C{min_size} connections.
+
+        @return: A C{Deferred} which fires when the checks are done.
+        """
+        now = self.clock.seconds()
+        size = self.size()
+        dlist = []
+        for conn in self.pool.idle():
+            age = now - self._created.get(conn, now)
+            idle = now - self._last_used.get(conn, now)
+            if self.max_lifetime is not None and age >= self.max_lifetime:
+                size -= 1
+                dlist.append(self._retire(conn))
+            elif (self.idle_timeout is not None and idle >= self.idle_timeout
+                    and size > self.min_size):
+                size -= 1
+                dlist.append(self._retire(conn))
+            else:
+                dlist.append(self._healthCheck(conn))
+        d = defer.gatherResults(dlist)
+        d.addCallback(lambda _: self._fill())
+        d.addCallback(lambda _: None)
+        return d
+
+
+    def _healthCheck(self, conn):
+        """
+        Take an idle connection out of the pool and see if it works.  It's
+        put back if it does, and closed if it doesn't.
+        """
+        self._checking.add(conn)
+        d = self.pool.remove(conn)
+        d.addCallback(self._probe)
+        d.addCallbacks(self._healthy, self._unhealthy,
+                       callbackArgs=(conn,), errbackArgs=(conn,))
+        return d
+
+
+    def _probe(self, conn):
+        """
+        See if a connection works by running C{select 1} on it, giving up
+        after C{check_timeout} seconds (so a connection that never answers
+        is treated as broken).
+        """
+        d = conn.runQuery('select 1')
+        if self.check_timeout is not None:
+            d.addTimeout(self.check_timeout, self.clock)
+        return d
+
+
+    def _healthy(self, result, conn):
+        self._checking.discard(conn)
         self.pool.add(conn)
 
 
+    def _unhealthy(self, failure, conn):
+        self._checking.discard(conn)
+        self._forget(conn)
+        d = defer.maybeDeferred(conn.close)
+        d.addErrback(lambda _: None)
+        return d
+
+
     def runInteraction(self, function, *args, **kwargs):
         return self._runWithConn('runInteraction', function, *args, **kwargs)
 
@@ -147,66 +666,154 @@ class ConnectionPool(object):
         return self._runWithConn('runOperation', *args, **kwargs)
 
 
-    def _finish(self, result, conn):
-        self.pool.done(conn)
+    def runMany(self, *args, **kwargs):
+        return self._runWithConn('runMany', *args, **kwargs)
+
+
+    def _finish(self, result, conn, started, attempt=None):
+        now = self.clock.seconds()
+        if conn in self._last_used:
+            self._last_used[conn] = now
+        statements = 1
+        if attempt is not None:
+            statements = attempt.statements
+        self.metrics.released(conn, now - started,
+                              isinstance(result, Failure), statements,
+                              **self._counts())
+        if isinstance(result, Failure) and result.check(_Disconnected):
+            self._forget(conn)
+            self.pool.remove(conn)
+            self.pool.done(conn)
+            d = defer.maybeDeferred(conn.close)
+            d.addErrback(lambda _: None)
+        else:
+            self.pool.done(conn)
         return result
 
 
+    def _counts(self):
+        size = len(self.pool.list())
+        idle = len(self.pool.idle())
+        return {
+            'size': size,
+            'idle': idle,
+            'in_use': size - idle,
+            'waiting': self.pool.waiting(),
+        }
+
+
+    def stats(self):
+        """
+        Get a dictionary of statistics about my connections and how they've
+        been used:
+
+            - C{size}, C{idle}, C{in_use}: Number of connections, and how many
+              of those are and aren't being used.
+            - C{waiting}: Number of things waiting for a connection.
+            - C{connecting}: Number of connections being made.
+            - C{checkouts}: Number of times a connection was handed out.
+            - C{wait_total}, C{wait_max}: Total and longest time (in seconds)
+              spent waiting for a connection.
+            - C{wait_histogram}: See L{PoolMetrics.waitHistogram}.
+            - C{connections}: A list of dictionaries for each connection with
+              its C{queries} (statements executed) and C{errors} counts.
+        """
+        metrics = self.metrics
+        ret = self._counts()
+        ret.update({
+            'connecting': self._connecting,
+            'checkouts': metrics.checkouts,
+            'wait_total': metrics.wait_total,
+            'wait_max': metrics.wait_max,
+            'wait_histogram': metrics.waitHistogram(),
+            'connections': [{
+                'queries': metrics.queries.get(conn, 0),
+                'errors': metrics.errors.get(conn, 0),
+            } for conn in self.pool.list()],
+        })
+        return ret
+
+
     def _runWithConn(self, name, *args, **kwargs):
+        return self._run(name, args, kwargs, True)
+
+
+    def _run(self, name, args, kwargs, retry):
+        if not self.pool.idle() and self._canGrow():
+            self._grow()
         d = self.pool.get()
-        d.addCallback(self._startRunWithConn, name, *args, **kwargs)
+        d.addCallback(self._startRunWithConn, self.clock.seconds(), name,
+                      args, kwargs, retry)
         return d
 
 
-    def _startRunWithConn(self, conn, name, *args, **kwargs):
+    def _startRunWithConn(self, conn, requested, name, args, kwargs, retry):
+        started = self.clock.seconds()
+        self.metrics.checkedOut(conn, started - requested, **self._counts())
+        reconnect = self._makeConnection is not None
+        attempt = None
+        call_args = args
+        if name == 'runInteraction':
+            attempt = _Attempt(args[0])
+            call_args = (attempt,) + args[1:]
         m = getattr(conn, name)
-        d = m(*args, **kwargs)
-        if self._makeConnection:
-            d.addErrback(self._retryOnDisconnect, conn, name, args, kwargs)
-        return d.addBoth(self._finish, conn)
+        d = m(*call_args, **kwargs)
+        if reconnect:
+            d.addErrback(self._checkConnection, conn)
+        d.addBoth(self._finish, conn, started, attempt)
+        if reconnect:
+            d.addErrback(self._retryOnDisconnect, name, args, kwargs,
+                         attempt, retry)
+        return d
 
 
-    def _retryOnDisconnect(self, failure, conn, name, args, kwargs):
+    def _checkConnection(self, failure, conn):
         """
-        XXX UNTESTED
+        If a failure looks like it's from a lost connection, see if the
+        connection is really broken.
         """
-        # check if it's the connection
-        d = conn.runQuery('select 1')
-        d.addCallbacks(
-            self._connectionTestSucceeded,
-            self._connectionTestFailed,
-            callbackArgs=(failure,),
-            errbackArgs=(conn, name, args, kwargs, failure),
-        )
+        if not _failedWith(failure, self.disconnect_errors):
+            return failure
+        d = self._probe(conn)
+        d.addCallbacks(lambda _: failure,
+                       lambda _: Failure(_Disconnected(conn, failure)))
         return d
 
 
-    def _connectionTestSucceeded(self, result, original_failure):
+    def _retryOnDisconnect(self, failure, name, args, kwargs, attempt,
+                           retry):
         """
-        The connection is good; fail like you were going to.
+        Replace a broken connection and, if nothing done on it could have
+        been applied, try again on another connection.
         """
-        return original_failure
+        if not failure.check(_Disconnected):
+            return failure
+        original = failure.value.failure
+        d = self._grow()
+        d.addCallback(self._replaced, original, name, args, kwargs, attempt,
+                      retry)
+        return d
 
 
-    @defer.inlineCallbacks
-    def _connectionTestFailed(self, result, bad_conn, name, args, kwargs,
-                              original_failure):
-        """
-        The connection is bad, try the query again.
-        """
-        retval = original_failure
-        try:
-            new_conn = yield self.makeConnection()
-            m = getattr(new_conn, name)
-            retval = yield m(*args, **kwargs)
-            self.pool.remove(bad_conn)
-            self.pool.add(new_conn)
-        except:
-            pass
-        defer.returnValue(retval)
+    def _replaced(self, new_conn, original, name, args, kwargs, attempt,
+                  retry):
+        if new_conn is None or not retry:
+            return original
+        if attempt is not None:
+            # An interaction is only tried again if it failed on its first
+            # statement, before anything could have been committed.
+            if attempt.finished or attempt.statements > 1:
+                return original
+        elif not _failedWith(original, self.unsent_errors):
+            # A single statement may have been run (and committed) before
+            # the connection was lost, unless it was already closed.
+            return original
+        return self._run(name, args, kwargs, False)
 
 
     def close(self):
+        if self._checker is not None and self._checker.running:
+            self._checker.stop()
         dlist = []
         for item in self.pool.list():
             dlist.append(defer.maybeDeferred(item.close))
@@ -274,6 +881,14 @@ class NextAvailablePool(object):
         return self._all_options
 
 
+    def idle(self):
+        return list(self._options)
+
+
+    def waiting(self):
+        return len(self._pending)
+
+
 
 
 
@@ -16,6 +16,14 @@ class IAsyncCursor(Interface):
         """
 
 
+    def executemany(query, param_list):
+        """
+        Execute the given sql once for each set of params in C{param_list}.
+
+        Return a C{Deferred} which will fire when they've all been executed.
+        """
+
+
     def fetchone():
         pass
 
@@ -24,12 +32,39 @@ class IAsyncCursor(Interface):
         pass
 
 
+    def fetchmany(size):
+        """
+        Fetch at most C{size} more rows of the results.  An empty list means
+        there are no more rows.
+        """
+
+
+    def stream(query, params, func, size=1000):
+        """
+        Execute the given sql and params, calling C{func} with each list of
+        at most C{size} rows of the results.  Rows are fetched a batch at a
+        time so that huge results can be read with constant memory.  If
+        C{func} returns a C{Deferred}, the next batch isn't fetched until it
+        fires.
+
+        Return a C{Deferred} which will fire once every row has been given to
+        C{func}.
+        """
+
+
     def lastRowId():
         """
         Return a C{Deferred} id of the most recently inserted row.
         """
 
 
+    def rowCount():
+        """
+        Return a C{Deferred} number of rows changed by the last statement
+        executed.
+        """
+
+
     def close():
         pass
 
@@ -53,6 +88,13 @@ class IRunner(Interface):
         """
 
 
+    def runMany(sql, param_list):
+        """
+        Run a query with no results once for each set of params in
+        C{param_list}, in a one-off transaction.
+        """
+
+
     def runInteraction(function, *args, **kwargs):
         """
         Run a function within a database transaction.  The function will be
@@ -101,6 +143,18 @@ class IPool(Interface):
         """
 
 
+    def idle():
+        """
+        List the things which are ready for use (not gotten).
+        """
+
+
+    def waiting():
+        """
+        Return the number of L{get} calls waiting for something to be ready.
+        """
+
+
 
 class IOperator(Interface):
     """
@@ -116,15 +170,59 @@ class IOperator(Interface):
         """
 
 
-    def query(cursor, query):
+    def insertMany(cursor, objs, refresh=True):
         """
-        XXX
+        Insert several ORM objects into the database in as few statements as
+        possible.
+
+        @param refresh: If C{True}, update the objects' attributes from the
+            inserted rows (as L{insert} does).  If C{False}, the objects are
+            left as they are, which may allow a faster insert.
+
+        @return: The list of objects.
         """
 
 
-    def refresh(cursor, obj):
+    def query(cursor, query, as_=None):
         """
-        XXX
+        Query for objects.
+
+        @param as_: If given, return plain values instead of objects:
+            C{'tuples'}, C{'namedtuples'}, C{'dicts'} or C{'columns'} (a
+            dictionary of column name to list of values).
+        """
+
+
+    def count(cursor, query):
+        """
+        Count the rows a query would return, without returning them.
+        """
+
+
+    def iterate(cursor, query, func, batch_size=1000):
+        """
+        Query for objects without loading them all at once.  C{func} will be
+        called with lists of at most C{batch_size} objects.  If C{func}
+        returns a C{Deferred}, the next batch won't be fetched until it fires.
+
+        @return: A C{Deferred} which fires when all the objects have been
+            given to C{func}.
+        """
+
+
+    def loadRelated(cursor, objs, relation):
+        """
+        Load a L{Relation} of several objects with as few queries as
+        possible.
+
+        @return: A C{Deferred} list of the related objects.
+        """
+
+
+    def refresh(cursor, obj, props=None):
+        """
+        Update an object's attributes from the database.  If C{props} is
+        given, only those properties are updated.
         """
 
 
@@ -134,12 +232,41 @@ class IOperator(Interface):
         """
 
 
+    def updateMany(cursor, objs):
+        """
+        Update several ORM objects in the database, in as few statements as
+        possible.
+
+        @return: The list of objects.
+        """
+
+
     def delete(cursor, obj):
         """
         XXX
         """
 
 
+    def updateWhere(cursor, cls, constraints, values):
+        """
+        Update the rows of C{cls}' table matching C{constraints} with a
+        single statement, setting the attributes named in the dictionary
+        C{values}.  C{values} must not be empty, and validators see C{None}
+        as the object.
+
+        @return: A C{Deferred} which fires with the number of rows updated.
+        """
+
+
+    def deleteWhere(cursor, cls, constraints):
+        """
+        Delete the rows of C{cls}' table matching C{constraints} with a
+        single statement.
+
+        @return: A C{Deferred} which fires with the number of rows deleted.
+        """
+
+
 
 
 
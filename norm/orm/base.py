@@ -1,13 +1,17 @@
 # Copyright (c) Matt Haggard.
 # See LICENSE for details.
 
-from collections import defaultdict, MutableMapping
+from collections import defaultdict, MutableMapping, OrderedDict, namedtuple
+from itertools import izip
 import inspect
+import threading
 import weakref
 
 from zope.interface import implements
+from twisted.internet import defer
 
-from norm.orm.error import NotFound
+from norm.error import Error
+from norm.orm.error import NotFound, NotLoaded
 from norm.interface import IOperator
 
 
@@ -76,6 +80,25 @@ class _WeakIdentityDict(MutableMapping):
         return len(iter(self))
 
 
+_unset = object()
+_not_loaded = object()
+
+
+
+def _compactValues(obj):
+    """
+    Get the list of attribute values of an instance of a L{compact} class,
+    creating it if this is the first time it's needed.
+    """
+    try:
+        return obj._norm_values
+    except AttributeError:
+        values = obj._norm_values = [_unset] * obj._norm_size
+        obj._norm_changed = 0
+        return values
+
+
+
 class Property(_Comparable):
     """
     I am a property on a class that maps to database column.
@@ -83,18 +106,22 @@ class Property(_Comparable):
     @ivar attr_name: Name of the attribute on the class
     @ivar column_name: Name of the column in the database.
     @ivar primary: C{True} if I am a part of the primary key.
+    @ivar deferred: C{True} if I'm not loaded by queries unless asked for.
     @ivar cls: The Class I live on.
     """
 
     _value_dict = _WeakIdentityDict()
     _changes = _WeakIdentityDict()
+    _index = None
     attr_name = None
     cls = None
     primary = False
+    deferred = False
 
 
     def __init__(self, column_name=None, primary=False, fromDatabase=None,
-                 toDatabase=None, default_factory=None, validators=None):
+                 toDatabase=None, default_factory=None, validators=None,
+                 deferred=False):
         """
         @param column_name: Name of the column in the database if different
             than the name being used in the class.  Meaning, these two lines
@@ -116,11 +143,17 @@ class Property(_Comparable):
             assigned to this attribute.  Each function will be called with
             three arguments:
                 - prop: (me, the thing you're instantiating with this __init__)
-                - obj: The object on which the value is being set
+                - obj: The object on which the value is being set, or
+                  C{None} for values given to L{IOperator.updateWhere}
                 - value: The value being set.
             Each validator will be called in the order given.
+        @param deferred: C{True} means queries won't load this attribute
+            unless it's named in the query's projection.  Until it's loaded
+            (see L{norm.porcelain.ORMHandle.load}) or set, getting it raises
+            L{NotLoaded}.
         """
         self.column_name = column_name
+        self.deferred = deferred
         self._fromDatabase = fromDatabase or (lambda x:x)
         self._toDatabase = toDatabase or (lambda x:x)
         self._default_factory = default_factory
@@ -147,23 +180,47 @@ class Property(_Comparable):
         new_value = value
         for v in self.validators:
             new_value = v(self, obj, new_value)
-        self._values(obj)[self.attr_name] = new_value
+        if self._index is None:
+            self._values(obj)[self.attr_name] = new_value
+        else:
+            _compactValues(obj)[self._index] = new_value
         if record_change:
             self._markChanged(obj)
 
 
     def _getValue(self, obj):
+        value = self._rawValue(obj)
+        if value is not _unset:
+            if value is _not_loaded:
+                raise NotLoaded(obj, self)
+            return value
+        if self._default_factory:
+            self._setValue(obj, self._default_factory())
+        else:
+            self._setValue(obj, None, record_change=False)
+        return self._getValue(obj)
+
+
+    def _rawValue(self, obj):
+        """
+        Get the stored value for an object without populating defaults.
+        """
         if not self.attr_name:
             self._cacheAttrName(obj.__class__)
-        values = self._values(obj)
-        try:
-            return values[self.attr_name]
-        except KeyError:
-            if self._default_factory:
-                self._setValue(obj, self._default_factory())
-            else:
-                self._setValue(obj, None, record_change=False)
-            return values[self.attr_name]
+        if self._index is None:
+            return self._values(obj).get(self.attr_name, _unset)
+        return _compactValues(obj)[self._index]
+
+
+    def _markNotLoaded(self, obj):
+        if self._index is None:
+            self._values(obj)[self.attr_name] = _not_loaded
+        else:
+            _compactValues(obj)[self._index] = _not_loaded
+
+
+    def _isLoaded(self, obj):
+        return self._rawValue(obj) is not _not_loaded
 
 
     def _values(self, obj):
@@ -185,19 +242,45 @@ class Property(_Comparable):
 
 
     def _markChanged(self, obj):
-        self.changes(obj).add(self)
+        if self._index is None:
+            self._changedNames(obj).add(self.attr_name)
+        else:
+            _compactValues(obj)
+            obj._norm_changed |= 1 << self._index
+
+
+    def _clearChanged(self, obj):
+        if self._index is None:
+            self._changedNames(obj).discard(self.attr_name)
+        else:
+            _compactValues(obj)
+            obj._norm_changed &= ~(1 << self._index)
+
+
+    def _isChanged(self, obj):
+        if self._index is None:
+            return self.attr_name in self._changedNames(obj)
+        _compactValues(obj)
+        return bool(obj._norm_changed & (1 << self._index))
+
+
+    def _changedNames(self, obj):
+        changed = self._changes.get(obj, None)
+        if changed is None:
+            changed = self._changes[obj] = set()
+        return changed
 
 
     def changes(self, obj):
         """
         Get a list of changes on this object (not just for this property).
         """
-        for prop in classInfo(obj).attributes.values():
+        for prop in classInfo(obj).properties:
             # this is so that default values are populated
-            prop.valueFor(obj)
-        if self._changes.get(obj, None) is None:
-            self._changes[obj] = set()
-        return self._changes[obj]
+            if prop._isLoaded(obj):
+                prop.valueFor(obj)
+        return [prop for prop in classInfo(obj).properties
+                if prop._isChanged(obj)]
 
 
     def _cacheAttrName(self, cls):
@@ -236,10 +319,7 @@ class Property(_Comparable):
         @param value: The value returned by the database.
         """
         self._setValue(obj, self._fromDatabase(value), record_change=False)
-        try:
-            self.changes(obj).remove(self)
-        except:
-            pass
+        self._clearChanged(obj)
 
 
     def __repr__(self):
@@ -250,34 +330,308 @@ class Property(_Comparable):
 
 
 
+def _resolve(prop, cls):
+    """
+    Get the L{Property} given to a L{Relation}, which may be a function
+    returning it (for classes which aren't defined yet).
+    """
+    if not isinstance(prop, Property):
+        prop = prop()
+    if prop.cls is None:
+        prop._cacheAttrName(cls)
+    return prop
+
+
+
+class Relation(object):
+    """
+    I am an attribute of a class holding the objects of another class related
+    to an object by a key.  I'm only loaded when asked for, either by a
+    query's C{eager} option or by L{norm.porcelain.ORMHandle.load}, which
+    load me for many objects with one query.  Until I'm loaded, getting me
+    raises L{NotLoaded}.
+
+    Only single column keys are supported.
+
+    @ivar attr_name: Name of the attribute on the class
+    @ivar cls: The Class I live on.
+    """
+
+    _value_dict = _WeakIdentityDict()
+    attr_name = None
+    cls = None
+
+
+    def __init__(self, local, remote, order_by=None):
+        """
+        @param local: The L{Property} of my class holding the key.
+        @param remote: The L{Property} of the related class which matches
+            C{local}.  Either property may instead be given as a function
+            returning it, for classes which aren't defined yet:
+
+                children = Many(id, lambda: Child.parent_id)
+
+        @param order_by: How to sort related objects (as for L{Query}), or
+            a function returning it.
+        """
+        self._local = local
+        self._remote = remote
+        self.order_by = order_by
+
+
+    def __get__(self, obj, cls):
+        if not self.attr_name:
+            self._cacheAttrName(cls)
+        if obj is None:
+            return self
+        try:
+            return self._value_dict[obj][self.attr_name]
+        except KeyError:
+            raise NotLoaded(obj, self)
+
+
+    def __set__(self, obj, value):
+        raise AttributeError("%r can't be set" % (self,))
+
+
+    def _cacheAttrName(self, cls):
+        for attr in dir(cls):
+            try:
+                rel = cls.__dict__[attr]
+            except:
+                continue
+            if isinstance(rel, Relation):
+                rel.attr_name = attr
+                rel.cls = cls
+
+
+    @property
+    def local(self):
+        return _resolve(self._local, self.cls)
+
+
+    @property
+    def remote(self):
+        return _resolve(self._remote, self.cls)
+
+
+    def _setLoaded(self, obj, value):
+        self._value_dict.setdefault(obj, {})[self.attr_name] = value
+
+
+    def _isLoaded(self, obj):
+        return self.attr_name in self._value_dict.get(obj, {})
+
+
+    def query(self, keys):
+        """
+        Get a L{Query} for the objects related to the given keys.
+        """
+        from norm.orm.expr import Query, In
+        remote = self.remote
+        order_by = self.order_by
+        if callable(order_by):
+            order_by = order_by()
+        return Query(remote.cls, In(remote, keys), order_by=order_by)
+
+
+    def attach(self, objs, related):
+        """
+        Set me on each of C{objs} to its objects among C{related}.
+        """
+        raise NotImplementedError('Implement attach')
+
+
+    def _mapped(self, value, func):
+        """
+        Get my value with C{func} applied to each related object.
+        """
+        raise NotImplementedError('Implement _mapped')
+
+
+    def __repr__(self):
+        return '<%s %s of %r 0x%x>' % (self.__class__.__name__,
+                                       self.attr_name, self.cls, id(self))
+
+
+
+class One(Relation):
+    """
+    I am the one object (or C{None}) related to an object, such as a child's
+    parent:
+
+        parent = One(parent_id, lambda: Parent.id)
+
+    Setting me sets the key to match the given object.
+    """
+
+
+    def __set__(self, obj, value):
+        if not self.attr_name:
+            self._cacheAttrName(obj.__class__)
+        key = None
+        if value is not None:
+            key = self.remote.valueFor(value)
+        self.local._setValue(obj, key)
+        self._setLoaded(obj, value)
+
+
+    def attach(self, objs, related):
+        remote = self.remote
+        local = self.local
+        by_key = dict([(remote.valueFor(x), x) for x in related])
+        for obj in objs:
+            self._setLoaded(obj, by_key.get(local.valueFor(obj), None))
+
+
+    def _mapped(self, value, func):
+        return func(value)
+
+
+
+class Many(Relation):
+    """
+    I am the list of objects related to an object, such as a parent's
+    children:
+
+        children = Many(id, lambda: Child.parent_id, order_by=...)
+    """
+
+
+    def attach(self, objs, related):
+        remote = self.remote
+        local = self.local
+        by_key = defaultdict(list)
+        for x in related:
+            by_key[remote.valueFor(x)].append(x)
+        for obj in objs:
+            self._setLoaded(obj, list(by_key.get(local.valueFor(obj), ())))
+
+
+    def _mapped(self, value, func):
+        return [func(x) for x in value]
+
+
+
 class _ClassInfo(object):
+    """
+    I am ORM-related information about a class.
+
+    @ivar table: Name of the table the class maps to.
+    @ivar columns: Dictionary of column name to list of L{Property}s.
+    @ivar attributes: Dictionary of attribute name to L{Property}.
+    @ivar primaries: List of the L{Property}s in the primary key.
+    @ivar properties: Tuple of all the L{Property}s ordered by attribute name.
+    @ivar column_names: Tuple of the names of all the columns.
+    @ivar primary_key: Tuple of the L{Property}s in the primary key.
+    @ivar relations: Tuple of the L{Relation}s.
+    """
 
-    _tables = {}
 
     def __init__(self, cls):
         self.cls = cls
         self.table = None
-        self.columns = defaultdict(lambda:[])
+        self.columns = {}
         self.attributes = {}
         self.primaries = []
+        self.properties = ()
+        self.column_names = ()
+        self.primary_key = ()
+        self.relations = ()
         self._getInfo()
 
 
     def _getInfo(self):
         self.table = getattr(self.cls, '__sql_table__', None)
         for k,v in inspect.getmembers(self.cls, lambda x:isinstance(x, Property)):
-            self.columns[v.column_name].append(v)
+            self.columns.setdefault(v.column_name, []).append(v)
             self.attributes[v.attr_name] = v
             if v.primary:
                 self.primaries.append(v)
+        self.properties = tuple(sorted(self.attributes.values(),
+                                       key=lambda x:x.attr_name))
+        self.column_names = tuple(self.columns)
+        self.primary_key = tuple(self.primaries)
+        self.relations = tuple([v for k, v in inspect.getmembers(self.cls,
+                                lambda x:isinstance(x, Relation))])
 
 
 
 def classInfo(cls):
-    # XXX implement caching if it's a big deal
+    """
+    Get ORM-related information about a class (or the class of an instance).
+    See L{_ClassInfo} for more details.
+
+    The information is computed once per class and kept on the class itself.
+    If you add or remove L{Property}s on a class after calling me, call
+    L{invalidateClassInfo} so that the change is seen.
+    """
+    if not inspect.isclass(cls):
+        cls = cls.__class__
+    try:
+        return cls.__dict__['_norm_class_info']
+    except KeyError:
+        info = _ClassInfo(cls)
+        setattr(cls, '_norm_class_info', info)
+        return info
+
+
+
+def compact(cls):
+    """
+    Class decorator which makes a class store the values of its L{Property}s
+    in a list held in a slot on each instance (with a bitmask of which ones
+    have changed) instead of in dictionaries shared by all objects.  This
+    uses less memory per object and makes attribute access faster, which
+    matters when you have lots of objects.
+
+        @compact
+        class Foo(object):
+            id = Int(primary=True)
+
+    The class is rebuilt with C{__slots__}, so unless a base class provides
+    one, instances won't have a C{__dict__} and only L{Property}s and names
+    you list in C{__slots__} can be set on them.  Subclasses of a compact
+    class should also be decorated if they add L{Property}s.
+    """
+    namespace = dict(cls.__dict__)
+    slots = namespace.get('__slots__', ())
+    if isinstance(slots, basestring):
+        slots = (slots,)
+    slots = list(slots)
+    for name in slots + ['__dict__', '__weakref__', '_norm_class_info']:
+        namespace.pop(name, None)
+
+    start = getattr(cls, '_norm_size', None)
+    if start is None:
+        start = 0
+        slots.extend(['_norm_values', '_norm_changed'])
+    if not [x for x in cls.__bases__ if x.__weakrefoffset__]:
+        slots.append('__weakref__')
+
+    own = sorted([(k, v) for k, v in namespace.items()
+                  if isinstance(v, Property)])
+    for i, (name, prop) in enumerate(own):
+        prop._index = start + i
+    namespace['_norm_size'] = start + len(own)
+    namespace['__slots__'] = tuple(slots)
+
+    new_cls = type(cls)(cls.__name__, cls.__bases__, namespace)
+    if own:
+        own[0][1]._cacheAttrName(new_cls)
+    return new_cls
+
+
+
+def invalidateClassInfo(cls):
+    """
+    Forget the cached L{classInfo} for a class, so that it will be recomputed
+    the next time it's asked for.
+    """
     if not inspect.isclass(cls):
         cls = cls.__class__
-    return _ClassInfo(cls)
+    if '_norm_class_info' in cls.__dict__:
+        delattr(cls, '_norm_class_info')
 
 
 
@@ -291,29 +645,33 @@ class _ObjectInfo(object):
         self.obj = obj
 
 
-    def _changed(self):
+    def changed(self):
+        """
+        Get a list of properties on my object that have changed.
+        """
         cls_info = classInfo(self.obj)
         # XXX it's a little weird that you can get to this through any
         # attribute.
-        prop = cls_info.attributes.values()[0]
+        prop = cls_info.properties[0]
         return prop.changes(self.obj)
 
 
-    def changed(self):
+    def resetChangedList(self):
         """
-        Get a list of properties on my object that have changed.
+        Reset the changed status of all properties on my object so that an
+        immediate call to L{changed} will return an empty list.
         """
-        return list(self._changed())
+        for prop in classInfo(self.obj).properties:
+            prop._clearChanged(self.obj)
 
 
-    def resetChangedList(self):
+    def notLoaded(self):
         """
-        Reset the changed status of all properties on my object so that an
-        immediate call to L{changed} will return an empty list.
+        Get a list of properties on my object which weren't loaded from the
+        database (because they were left out of a query's projection).
         """
-        changes = self._changed()
-        while changes:
-            changes.pop()
+        return [prop for prop in classInfo(self.obj).properties
+                if not prop._isLoaded(self.obj)]
 
 
 
@@ -327,6 +685,191 @@ def objectInfo(obj):
 
 
 
+class IdentityMap(object):
+    """
+    I keep track of objects by class and primary key, so that loading the
+    same row more than once gives the same object.
+
+    Objects are held with weak references, so I forget objects nothing else
+    is using.  If C{size} is given, the C{size} most recently used objects
+    are also held strongly so they stay around even if nothing else refers
+    to them.
+
+    Objects without a primary key (or with C{None} in it) aren't tracked.
+
+    I can be used from several threads at once (as in the transactions of a
+    threaded pool).
+    """
+
+
+    def __init__(self, size=None):
+        self.size = size
+        self._objects = weakref.WeakValueDictionary()
+        self._recent = OrderedDict()
+        self._lock = threading.RLock()
+
+
+    def _key(self, obj):
+        primary_key = classInfo(obj).primary_key
+        if not primary_key:
+            return None
+        pk = tuple([prop.valueFor(obj) for prop in primary_key])
+        if None in pk:
+            return None
+        return (obj.__class__, pk)
+
+
+    def _touch(self, key, obj):
+        if not self.size:
+            return
+        self._recent.pop(key, None)
+        self._recent[key] = obj
+        while len(self._recent) > self.size:
+            self._recent.popitem(last=False)
+
+
+    def get(self, cls, *pk):
+        """
+        Get the object of class C{cls} with the given primary key values, or
+        C{None} if I don't have it.
+        """
+        key = (cls, pk)
+        with self._lock:
+            obj = self._objects.get(key, None)
+            if obj is not None:
+                self._touch(key, obj)
+            return obj
+
+
+    def add(self, obj):
+        """
+        Remember an object (replacing any other object with the same primary
+        key).
+
+        @return: C{obj}
+        """
+        key = self._key(obj)
+        if key is not None:
+            with self._lock:
+                self._objects[key] = obj
+                self._touch(key, obj)
+        return obj
+
+
+    def load(self, obj):
+        """
+        Get the object to use for an object just loaded from the database.
+        If I already have an object with the same primary key, its unchanged
+        attributes are updated from C{obj} and it is returned.  Otherwise
+        C{obj} is remembered and returned.
+
+        The objects in C{obj}'s loaded L{Relation}s are loaded too.
+        """
+        with self._lock:
+            return self._load(obj, {})
+
+
+    def _load(self, obj, seen):
+        if obj is None:
+            return None
+        if id(obj) in seen:
+            return seen[id(obj)]
+        ret = obj
+        key = self._key(obj)
+        if key is not None:
+            existing = self._objects.get(key, None)
+            if existing is None or existing is obj:
+                self._objects[key] = obj
+            else:
+                changed = [x.attr_name for x in objectInfo(existing).changed()]
+                for prop in classInfo(existing).properties:
+                    if prop.attr_name not in changed and prop._isLoaded(obj):
+                        prop._setValue(existing, prop.valueFor(obj),
+                                       record_change=False)
+                ret = existing
+            self._touch(key, ret)
+        seen[id(obj)] = ret
+        for relation in classInfo(obj).relations:
+            if relation._isLoaded(obj):
+                value = relation.__get__(obj, obj.__class__)
+                relation._setLoaded(ret, relation._mapped(value,
+                                    lambda x: self._load(x, seen)))
+        return ret
+
+
+    def remove(self, obj):
+        """
+        Forget an object (if I have it).
+        """
+        key = self._key(obj)
+        if key is None:
+            return
+        with self._lock:
+            if self._objects.get(key, None) is obj:
+                del self._objects[key]
+                self._recent.pop(key, None)
+
+
+    def clear(self, cls=None):
+        """
+        Forget all objects, or only those of class C{cls} (and its
+        subclasses).
+        """
+        with self._lock:
+            if cls is None:
+                self._objects.clear()
+                self._recent.clear()
+                return
+            for key in self._objects.keys():
+                if issubclass(key[0], cls):
+                    self._objects.pop(key, None)
+                    self._recent.pop(key, None)
+
+
+    def __len__(self):
+        return len(self._objects)
+
+
+
+def hydrate(obj, props, values, not_loaded=()):
+    """
+    Set attributes of an object to values loaded from the database.  This is
+    faster than calling L{Property.fromDatabase} for each one because the
+    values are trusted: validators aren't run, defaults aren't populated, and
+    the properties are all marked as unchanged at once.
+
+    @param props: A list of L{Property}s.
+    @param values: A list of the database-land value for each property (as
+        converted by an operator's L{Converter}).
+    @param not_loaded: A list of L{Property}s which weren't loaded, so that
+        getting them raises L{NotLoaded} instead of giving a default.
+    """
+    for prop in not_loaded:
+        prop._markNotLoaded(obj)
+    plain = None
+    names = []
+    mask = 0
+    for prop, value in izip(props, values):
+        value = prop._fromDatabase(value)
+        if prop._index is None:
+            if plain is None:
+                plain = prop._values(obj)
+            plain[prop.attr_name] = value
+            names.append(prop.attr_name)
+        else:
+            if not mask:
+                compact_values = _compactValues(obj)
+            compact_values[prop._index] = value
+            mask |= 1 << prop._index
+    if names:
+        changed = Property._changes.get(obj, None)
+        if changed:
+            changed.difference_update(names)
+    if mask:
+        obj._norm_changed &= ~mask
+
+
+
 def reconstitute(data):
     """
     Reconstitute an object or list of objects using data from a database.
@@ -346,16 +889,14 @@ def reconstitute(data):
     
     ret = []
     for cls in classes:
-        obj = cls.__new__(cls)
-        empty_obj = True
-        for prop, value in class_data[cls]:
-            if empty_obj and value is not None:
-                empty_obj = False
-            prop.fromDatabase(obj, value)
-        if empty_obj:
+        props = [x[0] for x in class_data[cls]]
+        values = [x[1] for x in class_data[cls]]
+        if values.count(None) == len(values):
             # No values, None (from a Left Join or the like)
             ret.append(None)
         else:
+            obj = cls.__new__(cls)
+            hydrate(obj, props, values)
             ret.append(obj)
 
     if len(ret) == 1:
@@ -363,6 +904,166 @@ def reconstitute(data):
     return ret
 
 
+class RowMaterializer(object):
+    """
+    I turn the rows returned for a L{Query} into objects (or plain values).
+    Everything that only depends on the query (which columns belong to which
+    class and how each one is converted) is worked out once, when I'm made,
+    instead of for every row.
+
+    @ivar names: The name of each column for the plain result modes: the
+        attribute name if the query involves a single class, or
+        C{ClassName_attribute} otherwise (and see L{Aggregate.columnName}).
+    """
+
+    result_modes = ('tuples', 'namedtuples', 'dicts', 'columns')
+
+
+    def __init__(self, query, converter):
+        """
+        @param query: The L{Query} whose rows I'll be given.
+        @param converter: A L{Converter} for converting values from the
+            database.
+        """
+        self.classes = []
+        self.names = []
+        self._values = []
+        self._namedtuple = None
+        start = 0
+        single = len(query.select) == 1
+        named = set([x.cls if isinstance(x, Property) else x
+                     for x in query.select
+                     if isinstance(x, Property) or inspect.isclass(x)])
+        for cls in query.select:
+            if not inspect.isclass(cls):
+                # an expression, whose value is returned as it is
+                expr = cls
+                prop = expr
+                if not isinstance(expr, Property):
+                    prop = expr.typeProperty()
+                convs = ()
+                if prop is not None:
+                    convs = tuple(converter.converters.get(prop.__class__, ()))
+                    convs += (prop._fromDatabase,)
+                self._values.append((start, convs))
+                if not isinstance(expr, Property):
+                    self.names.append(expr.columnName())
+                elif len(named) == 1:
+                    self.names.append(expr.attr_name)
+                else:
+                    self.names.append('%s_%s' % (expr.cls.__name__,
+                                                 expr.attr_name))
+                self.classes.append((None, (expr,), [(start, convs)], ()))
+                start += 1
+                continue
+            props = query.classProperties(cls)
+            not_loaded = [x for x in classInfo(cls).properties
+                          if not [y for y in props if y is x]]
+            columns = []
+            for i, prop in enumerate(props):
+                convs = tuple(converter.converters.get(prop.__class__, ()))
+                columns.append((start + i, convs))
+                self._values.append((start + i,
+                                     convs + (prop._fromDatabase,)))
+                if len(named) == 1:
+                    self.names.append(prop.attr_name)
+                else:
+                    self.names.append('%s_%s' % (cls.__name__,
+                                                 prop.attr_name))
+            self.classes.append((cls, props, columns, not_loaded))
+            start += len(props)
+        self.single = single
+
+
+    def _build(self, cls, props, columns, not_loaded, row):
+        if cls is None:
+            i, convs = columns[0]
+            value = row[i]
+            for conv in convs:
+                value = conv(value)
+            return value
+        values = []
+        empty = True
+        for i, convs in columns:
+            value = row[i]
+            for conv in convs:
+                value = conv(value)
+            if value is not None:
+                empty = False
+            values.append(value)
+        if empty:
+            # No values, None (from a Left Join or the like)
+            return None
+        obj = cls.__new__(cls)
+        hydrate(obj, props, values, not_loaded)
+        return obj
+
+
+    def __call__(self, rows):
+        """
+        Make objects from rows.
+
+        @return: A list with an object (or C{None}) per row if the query is
+            for a single class, or a list of objects per row otherwise.
+            Selected expressions are given as their values.
+        """
+        build = self._build
+        if self.single:
+            cls, props, columns, not_loaded = self.classes[0]
+            return [build(cls, props, columns, not_loaded, row)
+                    for row in rows]
+        classes = self.classes
+        return [[build(*(item + (row,))) for item in classes]
+                for row in rows]
+
+
+    def _tuples(self, rows):
+        values = self._values
+        ret = []
+        for row in rows:
+            converted = []
+            for i, funcs in values:
+                value = row[i]
+                for func in funcs:
+                    value = func(value)
+                converted.append(value)
+            ret.append(tuple(converted))
+        return ret
+
+
+    def plain(self, rows, as_):
+        """
+        Convert rows to plain python values without making objects.
+
+        @param as_: One of:
+            - C{'tuples'}: A list of tuples.
+            - C{'namedtuples'}: A list of named tuples (the type is made once
+              per query).
+            - C{'dicts'}: A list of dictionaries.
+            - C{'columns'}: An ordered dictionary of column name to a list of
+              the values in that column.
+        """
+        if as_ == 'tuples':
+            return self._tuples(rows)
+        elif as_ == 'namedtuples':
+            if self._namedtuple is None:
+                self._namedtuple = namedtuple('Row', self.names, rename=True)
+            make = self._namedtuple._make
+            return [make(x) for x in self._tuples(rows)]
+        elif as_ == 'dicts':
+            names = self.names
+            return [dict(izip(names, x)) for x in self._tuples(rows)]
+        elif as_ == 'columns':
+            tuples = self._tuples(rows)
+            ret = OrderedDict()
+            for i, name in enumerate(self.names):
+                ret[name] = [x[i] for x in tuples]
+            return ret
+        raise ValueError('as_ must be one of %r, not %r' % (
+                         self.result_modes, as_))
+
+
+
 def updateObjectFromDatabase(data, obj, converter):
     """
     Update an existing object's attributes from a database response row.
@@ -376,16 +1077,28 @@ def updateObjectFromDatabase(data, obj, converter):
     """
     if data is None:
         raise NotFound(obj)
-    for name, props in classInfo(obj).columns.items():
-        if name not in data.keys():
+    keys = set(data.keys())
+    props = []
+    values = []
+    for name, column_props in classInfo(obj).columns.items():
+        if name not in keys:
             continue
-        for prop in props:
-            value = converter.convert(prop.__class__, data[name])
-            prop.fromDatabase(obj, value)
+        for prop in column_props:
+            props.append(prop)
+            values.append(converter.convert(prop.__class__, data[name]))
+    hydrate(obj, props, values)
     return obj
 
 
 
+def _chunks(seq, size):
+    """
+    Split a list into lists of at most C{size} items.
+    """
+    return [seq[i:i+size] for i in xrange(0, len(seq), size)]
+
+
+
 class Converter(object):
     """
     I let you register conversion functions for types, then use the conversion
@@ -425,12 +1138,53 @@ class BaseOperator(object):
     compiler = None
     fromDB = None
     toDB = None
+    plan_cache_size = 256
+    eager_chunk_size = 500
+
+
+    def __init__(self):
+        from norm.orm.expr import PlanCache
+        self.plans = PlanCache(self.compiler, self.plan_cache_size)
+        self._materializers = {}
+        self._materializers_lock = threading.Lock()
 
 
     def insert(self, cursor, obj):
         raise NotImplementedError('Implement insert')
 
 
+    def insertMany(self, cursor, objs, refresh=True):
+        raise NotImplementedError('Implement insertMany')
+
+
+    def _insertGroups(self, objs):
+        """
+        Group objects that can be inserted by the same statement: those of
+        the same class with the same changed properties.
+
+        @return: A list of (class info, changed properties, objects) tuples
+            in the order each group was first seen.
+        """
+        groups = []
+        by_key = {}
+        for obj in objs:
+            props = sorted(objectInfo(obj).changed(), key=lambda x:x.attr_name)
+            key = (obj.__class__, tuple([x.attr_name for x in props]))
+            if key not in by_key:
+                by_key[key] = (classInfo(obj), props, [])
+                groups.append(by_key[key])
+            by_key[key][2].append(obj)
+        return groups
+
+
+    def _insertValues(self, obj, props):
+        """
+        Get database-ready values of the given properties of an object.
+        """
+        return [self.toDB.convert(prop.__class__, prop.toDatabase(obj))
+                for prop in props]
+
+
     def _makeObjects(self, rows, query):
         """
         Reconstitute objects based on a query and the rows returned from the 
@@ -441,48 +1195,170 @@ class BaseOperator(object):
 
         @return: A list of reconstituted rows.
         """
-        ret = []
-        props = query.properties()
-        for row in rows:
-            data = zip(props, row)
-            data = [(x[0], self.fromDB.convert(x[0].__class__, x[1])) for x in data]
-            ret.append(reconstitute(data))
-        return ret
+        return self._materializer(query)(rows)
+
+
+    def _materializer(self, query):
+        """
+        Get a L{RowMaterializer} for the rows of a query.
+        """
+        if len(query.classes()) != len(query.select):
+            # XXX materializers for queries of expressions aren't kept, since
+            # the expressions can't be used as a key.
+            return RowMaterializer(query, self.fromDB)
+        key = tuple([(cls, tuple([x.attr_name
+                                  for x in query.classProperties(cls)]))
+                     for cls in query.classes()])
+        with self._materializers_lock:
+            materializer = self._materializers.get(key, None)
+            if materializer is None:
+                materializer = RowMaterializer(query, self.fromDB)
+                self._materializers[key] = materializer
+            return materializer
 
 
     def _updateObject(self, data, obj):
         return updateObjectFromDatabase(data, obj, self.fromDB)
 
 
-    def query(self, cursor, query):
+    def _updateObjects(self, rows, objs):
+        """
+        Update each object from the corresponding row.
+        """
+        if len(rows) != len(objs):
+            raise Error('Expected %d rows but got %d' % (len(objs), len(rows)))
+        for data, obj in zip(rows, objs):
+            self._updateObject(data, obj)
+        return objs
+
+
+    def query(self, cursor, query, as_=None):
         """
         Query for objects.
 
         @param query: A L{Query} instance.
+        @param as_: C{None} to get objects, or one of
+            L{RowMaterializer.result_modes} to get plain values instead (see
+            L{RowMaterializer.plain}).
         """
-        sql, args = self.compiler.compile(query)
-        d = cursor.execute(sql, tuple([self.toDB.convert(type(x), x) for x in args]))
+        if as_ is not None and as_ not in RowMaterializer.result_modes:
+            raise ValueError('as_ must be one of %r, not %r' % (
+                             RowMaterializer.result_modes, as_))
+        sql, args = self.plans.compile(query)
+        d = cursor.execute(sql, self._queryArgs(args))
         d.addCallback(lambda _: cursor.fetchall())
-        d.addCallback(self._makeObjects, query)
+        if as_ is None:
+            d.addCallback(self._makeObjects, query)
+            if query.eager:
+                d.addCallback(self._loadEager, cursor, query.eager)
+        else:
+            d.addCallback(self._materializer(query).plain, as_)
         return d
 
 
-    def refresh(self, cursor, obj):
+    @defer.inlineCallbacks
+    def _loadEager(self, result, cursor, relations):
+        """
+        Load L{Relation}s of the objects in the result of a query.  A
+        relation of a class loaded by an earlier relation is loaded for
+        those objects too.
+        """
+        loaded = []
+        for item in result:
+            if type(item) is list:
+                loaded.extend(item)
+            else:
+                loaded.append(item)
+        for relation in relations:
+            objs = [x for x in loaded if isinstance(x, relation.cls)]
+            related = yield self.loadRelated(cursor, objs, relation)
+            loaded.extend(related)
+        defer.returnValue(result)
+
+
+    @defer.inlineCallbacks
+    def loadRelated(self, cursor, objs, relation):
+        """
+        Load a L{Relation} of some objects, with one query for every
+        C{eager_chunk_size} distinct keys.
+
+        @return: A C{Deferred} list of the related objects loaded.
+        """
+        local = relation.local
+        keys = []
+        seen = set()
+        for obj in objs:
+            key = local.valueFor(obj)
+            if key is not None and key not in seen:
+                seen.add(key)
+                keys.append(key)
+        related = []
+        for chunk in _chunks(keys, self.eager_chunk_size):
+            found = yield self.query(cursor, relation.query(chunk))
+            related.extend(found)
+        relation.attach(objs, related)
+        defer.returnValue(related)
+
+
+    def count(self, cursor, query):
+        """
+        Count the rows a query would return.
+
+        @param query: A L{Query} instance.
+        """
+        sql, args = self.plans.compile(query)
+        sql = 'SELECT COUNT(*) FROM (%s) AS t' % (sql,)
+        d = cursor.execute(sql, self._queryArgs(args))
+        d.addCallback(lambda _: cursor.fetchone())
+        return d.addCallback(lambda row: row[0])
+
+
+    def _queryArgs(self, args):
+        """
+        Convert the arguments of a compiled query for the database.
+        """
+        return tuple([self.toDB.convert(type(x), x) for x in args])
+
+
+    def iterate(self, cursor, query, func, batch_size=1000):
+        """
+        Query for objects, giving them to C{func} in batches.  The rows are
+        read with the cursor's C{stream}, so only one batch at a time is
+        held in memory.
+
+        @param query: A L{Query} instance.
+        @param func: A function to be called with each list of at most
+            C{batch_size} objects.  If it returns a C{Deferred}, the next
+            batch isn't fetched until it fires.
+        """
+        sql, args = self.plans.compile(query)
+        return cursor.stream(sql, self._queryArgs(args),
+                             lambda rows: func(self._makeObjects(rows, query)),
+                             batch_size)
+
+
+    def refresh(self, cursor, obj, props=None):
         """
         Update an objects attributes from the values in the database.
 
         @param obj: Object to update
+        @param props: If given, only update these L{Property}s.
         """
         info = classInfo(obj)
         
         args = []
         
         where_parts = []
-        for prop in info.primaries:
+        for prop in info.primary_key:
             where_parts.append('%s=?' % (prop.column_name,))
             args.append(self.toDB.convert(prop.__class__, prop.toDatabase(obj)))
         
-        columns = info.columns.keys()
+        columns = info.column_names
+        if props is not None:
+            columns = []
+            for prop in props:
+                if prop.column_name not in columns:
+                    columns.append(prop.column_name)
         select = 'SELECT %s FROM %s WHERE %s' % (','.join(columns),
                   info.table, ' AND '.join(where_parts))
 
@@ -514,7 +1390,7 @@ class BaseOperator(object):
         # XXX REFACTOR
         where_parts = []
         where_args = []
-        for prop in info.primaries:
+        for prop in info.primary_key:
             where_parts.append('%s=?' % (prop.column_name,))
             where_args.append(self.toDB.convert(prop.__class__, prop.toDatabase(obj)))
 
@@ -526,6 +1402,87 @@ class BaseOperator(object):
         return cursor.execute(update, args)
 
 
+    def updateMany(self, cursor, objs):
+        """
+        Update several objects in the database (from their changed
+        attributes).  Objects of the same class with the same changed
+        attributes are updated by a single C{executemany}.  Objects without
+        changes are left alone.
+
+        @return: The list of objects.
+        """
+        objs = list(objs)
+        d = defer.succeed(None)
+        for info, props, group in self._insertGroups(objs):
+            if not props:
+                continue
+            elif not info.primary_key:
+                for obj in group:
+                    d.addCallback(lambda _, obj=obj: self.update(cursor, obj))
+                continue
+            update = 'UPDATE %s SET %s WHERE %s' % (info.table,
+                     ','.join(['%s=?' % (x.column_name,) for x in props]),
+                     ' AND '.join(['%s=?' % (x.column_name,)
+                                   for x in info.primary_key]))
+            rows = [tuple(self._insertValues(obj, props)
+                          + self._insertValues(obj, info.primary_key))
+                    for obj in group]
+            d.addCallback(lambda _, update=update, rows=rows:
+                          cursor.executemany(update, rows))
+        return d.addCallback(lambda _: objs)
+
+
+    def updateWhere(self, cursor, cls, constraints, values):
+        """
+        Update all the rows of a class's table matching some constraints.
+
+        @param constraints: A constraint (or C{None} for all the rows).
+            Constraints on other classes are allowed.
+        @param values: A non-empty dictionary of attribute name to new
+            value.  Values are validated and converted like values set on an
+            object, except that validators are called with C{None} as the
+            object.  A value may also be an expression, such as another
+            L{Property} of C{cls}.
+
+        @return: A C{Deferred} which fires with the number of rows updated.
+        """
+        from norm.orm.expr import Update
+        if not values:
+            raise TypeError('No values given to update %r with' % (cls,))
+        info = classInfo(cls)
+        pairs = []
+        for name, value in sorted(values.items()):
+            try:
+                prop = info.attributes[name]
+            except KeyError:
+                raise TypeError('%r has no property %r' % (cls, name))
+            if not isinstance(value, _Comparable):
+                for validator in prop.validators:
+                    value = validator(prop, None, value)
+                value = prop._toDatabase(value)
+            pairs.append((prop, value))
+        return self._executeCount(cursor, Update(cls, constraints, pairs))
+
+
+    def deleteWhere(self, cursor, cls, constraints):
+        """
+        Delete all the rows of a class's table matching some constraints.
+
+        @param constraints: A constraint (or C{None} for all the rows).
+            Constraints on other classes are allowed.
+
+        @return: A C{Deferred} which fires with the number of rows deleted.
+        """
+        from norm.orm.expr import Delete
+        return self._executeCount(cursor, Delete(cls, constraints))
+
+
+    def _executeCount(self, cursor, statement):
+        sql, args = self.plans.compile(statement)
+        d = cursor.execute(sql, self._queryArgs(args))
+        return d.addCallback(lambda _: cursor.rowCount())
+
+
     def delete(self, cursor, obj):
         """
         Delete an object from the database.
@@ -538,7 +1495,7 @@ class BaseOperator(object):
         # XXX REFACTOR
         where_parts = []
         where_args = []
-        for prop in info.primaries:
+        for prop in info.primary_key:
             where_parts.append('%s=?' % (prop.column_name,))
             where_args.append(self.toDB.convert(prop.__class__, prop.toDatabase(obj)))
 
@@ -5,4 +5,11 @@ from norm.error import Error
 
 
 class NotFound(Error):
-    pass
\ No newline at end of file
+    pass
+
+
+
+class NotLoaded(Error):
+    """
+    An attribute was gotten which wasn't loaded from the database.
+    """
@@ -1,11 +1,12 @@
 # Copyright (c) Matt Haggard.
 # See LICENSE for details.
 
-from norm.orm.base import classInfo, Property
+from norm.orm.base import classInfo, Property, Relation, _Comparable
 
-from collections import defaultdict
-from itertools import product
+from collections import defaultdict, deque, OrderedDict
 from datetime import date, datetime
+import inspect
+import threading
 
 
 class CompileError(Exception):
@@ -22,105 +23,437 @@ class Query(object):
     def __init__(self, select, *constraints, **kwargs):
         """
         @param select: Class(es) to return in the result.  This may either be
-            a single class or a list/tuple of classes.
+            a single class or a list/tuple of classes.  Instead of a class,
+            an expression (such as a L{Property} or an L{Aggregate}) may be
+            given, in which case its value is returned in its place.
         @param constraints: A L{Comparison} or other compileable expression.
+            They're combined with L{And} and made simpler (see
+            L{simplify}).
 
         @param kwargs:
             joins
+            project: A list of L{Property}s to load.  The primary key of
+                each selected class is always loaded.  The other properties
+                are left unloaded (see L{NotLoaded}).  If a selected class has
+                none of its properties listed, all its non-deferred
+                properties are loaded.
+            order_by: A L{Property}, L{Asc} or L{Desc} (or a list of them)
+                to sort the results by.
+            limit: The most rows to return.
+            offset: The number of rows to skip.
+            after: For keyset pagination, the C{order_by} values of the last
+                row seen (or the last object seen, to take them from).  Only
+                the rows which sort after it are returned.  Unlike C{offset},
+                the database doesn't have to go through the skipped rows.
+
+            group_by: An expression (or a list of them) to group the rows by,
+                for use with L{Aggregate}s.
+            having: A constraint on the groups.
+
+            eager: A L{Relation} (or a list of them) to load for the objects
+                found by L{IOperator.query}, with one more query per
+                relation instead of one per object.  A relation of a class
+                loaded by an earlier relation in the list is loaded too.
         """
         if type(select) not in (list, tuple):
             select = (select,)
         self.select = select
         if constraints:
-            self.constraints = And(*constraints)
+            self.constraints = simplify(And(*constraints))
         else:
             self.constraints = None
         self.joins = kwargs.pop('joins', None) or []
+        self.project = tuple(kwargs.pop('project', None) or ())
+        order_by = kwargs.pop('order_by', None)
+        if order_by is None:
+            order_by = ()
+        elif type(order_by) not in (list, tuple):
+            order_by = (order_by,)
+        self.order_by = tuple(order_by)
+        self.limit = kwargs.pop('limit', None)
+        self.offset = kwargs.pop('offset', None)
+        after = kwargs.pop('after', None)
+        if after is not None:
+            classes = tuple([x for x in select if inspect.isclass(x)])
+            if classes and isinstance(after, classes):
+                after = [_orderProperty(x).valueFor(after)
+                         for x in self.order_by]
+            elif type(after) not in (list, tuple):
+                after = (after,)
+            if not after or len(after) > len(self.order_by):
+                raise ValueError('after needs an order_by value for each of '
+                                 'its values')
+            after = tuple(after)
+        self.after = after
+        group_by = kwargs.pop('group_by', None)
+        if group_by is None:
+            group_by = ()
+        elif type(group_by) not in (list, tuple):
+            group_by = (group_by,)
+        self.group_by = tuple(group_by)
+        self.having = simplify(kwargs.pop('having', None))
+        eager = kwargs.pop('eager', None)
+        if eager is None:
+            eager = ()
+        elif type(eager) not in (list, tuple):
+            eager = (eager,)
+        self.eager = tuple(eager)
         self._classes = []
         self._props = []
+        self._class_props = []
+        self._columns = []
         self._process()
 
 
     def _process(self):
         self._classes = []
         self._props = []
+        self._class_props = []
+        self._columns = []
         for item in self.select:
-            info = classInfo(item)
-            keys = sorted(info.attributes.values())
-            self._props.extend(keys)
+            if not inspect.isclass(item):
+                self._columns.append(item)
+                continue
+            props = classInfo(item).properties
+            projected = [x for x in props
+                         if [y for y in self.project if y is x]]
+            if projected:
+                props = [x for x in props
+                         if x.primary or [y for y in projected if y is x]]
+            else:
+                props = [x for x in props if x.primary or not x.deferred]
+            self._props.extend(props)
+            self._columns.extend(props)
+            self._class_props.append(props)
             self._classes.append(item)
 
 
     def properties(self):
         """
-        Get a tuple of the Properties that will be returned by the query.
+        Get a tuple of the Properties of the selected classes that will be
+        returned by the query.
         """
         return tuple(self._props)
 
 
+    def columns(self):
+        """
+        Get a tuple of the expressions for each column the query will return:
+        the Properties of the selected classes and the selected expressions.
+        """
+        return tuple(self._columns)
+
+
+    def classProperties(self, cls):
+        """
+        Get a tuple of the Properties that will be returned by the query for
+        one of its classes.
+        """
+        return tuple(self._class_props[self._classes.index(cls)])
+
+
     def classes(self):
         """
-        Return a list of classes involved in the query.
+        Return a list of the classes selected by the query.
         """
         return self._classes
 
 
-    def find(self, select, constraints=None, joins=None):
+    def keyset(self):
+        """
+        Get the constraint which limits the results to those that sort
+        after C{after}, or C{None} if there's no C{after}.
+        """
+        if self.after is None:
+            return None
+        parts = []
+        for i, value in enumerate(self.after):
+            item = self.order_by[i]
+            earlier = [Eq(_orderProperty(x), v)
+                       for x, v in zip(self.order_by[:i], self.after[:i])]
+            if isinstance(item, Desc):
+                after = Lt(item.prop, value)
+            else:
+                after = Gt(_orderProperty(item), value)
+            parts.append(And(*(earlier + [after])))
+        if len(parts) == 1:
+            return parts[0].items[0]
+        # The redundant first comparison lets the database use an index on
+        # the first column to skip straight to the first row.
+        first = self.order_by[0]
+        if isinstance(first, Desc):
+            start = Lte(first.prop, self.after[0])
+        else:
+            start = Gte(_orderProperty(first), self.after[0])
+        return And(start, Or(*parts))
+
+
+    def find(self, select, constraints=None, joins=None, project=None):
         """
         Search for another kind of object with additional constraints.
         """
         all_constraints = [x for x in [self.constraints, constraints] if x]
         joins = joins or []
-        return Query(select, *all_constraints, joins=self.joins + joins)
+        return Query(select, *all_constraints, joins=self.joins + joins,
+                     project=project)
+
+
+
+class Asc(object):
+    """
+    I sort a query by a property in ascending order.
+    """
+
+    direction = 'ASC'
+
+    def __init__(self, prop):
+        self.prop = prop
+
+
+
+class Desc(Asc):
+    """
+    I sort a query by a property in descending order.
+    """
+
+    direction = 'DESC'
+
+
+
+def _orderProperty(item):
+    """
+    Get the property of an C{order_by} item.
+    """
+    if isinstance(item, Asc):
+        return item.prop
+    return item
+
+
+
+class Aggregate(_Comparable):
+    """
+    I'm an SQL aggregate function of an expression, such as C{SUM(a.x)}.
+    Like a L{Property}, I can be compared to make constraints (for use in a
+    query's C{having}).
+
+    @cvar function: The name of the SQL function.
+    @cvar keeps_type: C{True} if my result is the same type as my expression
+        (and so should be converted from the database like it).
+    """
+
+    function = None
+    keeps_type = False
+
+    def __init__(self, expr=None):
+        """
+        @param expr: The expression to aggregate.
+        """
+        self.expr = expr
+
+
+    def columnName(self):
+        """
+        Get a name for my result in plain results (such as C{'sum_age'}).
+        """
+        expr = self.expr
+        if isinstance(expr, Distinct):
+            expr = expr.expr
+        if isinstance(expr, Property):
+            return '%s_%s' % (self.function.lower(), expr.attr_name)
+        return self.function.lower()
+
+
+    def typeProperty(self):
+        """
+        Get the L{Property} whose conversion from the database applies to my
+        result, or C{None} if my result should be left as it is.
+        """
+        expr = self.expr
+        if isinstance(expr, Distinct):
+            expr = expr.expr
+        if self.keeps_type and isinstance(expr, Property):
+            return expr
+        return None
+
+
+
+class Count(Aggregate):
+    """
+    I count rows (C{COUNT(*)}) or the non-NULL values of an expression.
+    Count the rows of a class's table with C{Count(cls)}.
+    """
+
+    function = 'COUNT'
+
+
+
+class Sum(Aggregate):
+    function = 'SUM'
+
+
+
+class Avg(Aggregate):
+    function = 'AVG'
+
 
 
+class Max(Aggregate):
+    function = 'MAX'
+    keeps_type = True
 
-def _aliases(pool='abcdefghijklmnopqrstuvwxyz'):
-    for i in xrange(1, 255):
-        for item in product(pool, repeat=i):
-            yield ''.join(item)
+
+
+class Min(Aggregate):
+    function = 'MIN'
+    keeps_type = True
+
+
+
+class Distinct(object):
+    """
+    I make an L{Aggregate} only use distinct values of an expression, as in
+    C{Count(Distinct(Book.author_id))}.
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+
+
+
+class Limit(object):
+    """
+    I limit the rows returned by a query.  I'm made by the compiler from a
+    L{Query}'s C{limit} and C{offset}.
+    """
+
+    def __init__(self, limit=None, offset=None):
+        self.limit = limit
+        self.offset = offset
+
+
+def _alias(index, pool='abcdefghijklmnopqrstuvwxyz'):
+    """
+    Get the C{index}th alias of the sequence C{a, b, ..., z, aa, ab, ...}.
+    """
+    size = len(pool)
+    chars = []
+    index += 1
+    while index:
+        index, i = divmod(index - 1, size)
+        chars.append(pool[i])
+    chars.reverse()
+    return ''.join(chars)
+
+
+
+class _Aliases(dict):
+    """
+    I map classes to table aliases, making up the next alias for a class
+    which doesn't have one yet.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.used = 0
+
+
+    def __missing__(self, cls):
+        alias = self[cls] = _alias(self.used)
+        self.used += 1
+        return alias
 
 
 
 class State(object):
     """
     Compilation state and life-line to the whole compilation process.
+
+    @ivar classes: The classes whose tables have been referred to, in the
+        order they were first referred to.
+    @ivar outer: The classes of the query enclosing a subquery, which the
+        subquery refers to (instead of having in its own C{FROM}).
     """
 
     compiler = None
 
 
     def __init__(self):
-        pool = _aliases()
-        self._aliases = defaultdict(lambda:pool.next())
+        self._aliases = _Aliases()
         self.classes = []
+        self._class_set = set()
+        self._touched = None
+        self.outer = []
+
+
+    def subState(self):
+        """
+        Get a state for compiling a subquery.  It uses my aliases (so that
+        it can refer to my classes) but keeps track of its own classes.
+        """
+        state = State()
+        state.compiler = self.compiler
+        state._aliases = self._aliases
+        state.outer = self.outer + self.classes
+        return state
 
 
     def compile(self, thing):
         return self.compiler.compile(thing, self)
 
 
+    def setAlias(self, cls, alias):
+        """
+        Use C{alias} (instead of a generated one) for a class' table.
+        """
+        self._aliases[cls] = alias
+
+
     def tableAlias(self, cls):
         """
         Return a name that can be used (repeatedly) as an alias for a class'
         table.
         """
         alias = self._aliases[cls]
-        if cls not in self.classes:
+        if cls not in self._class_set:
+            self._class_set.add(cls)
             self.classes.append(cls)
+        if self._touched is not None and cls not in self._touched:
+            self._touched.append(cls)
         return alias
 
 
+    def compileTouching(self, thing):
+        """
+        Compile something, also finding out which classes' tables it refers
+        to.
+
+        @return: A tuple of the SQL, args and a list of the classes in the
+            order they were first referred to.
+        """
+        outer = self._touched
+        self._touched = []
+        try:
+            sql, args = self.compile(thing)
+            return sql, args, self._touched
+        finally:
+            self._touched = outer
+
+
 
 class Compiler(object):
     """
     I compile "things" into "other things" (most typically, objects into SQL)
+
+    @ivar binds_lists: If C{True}, the list of literal values of an L{In} is
+        bound to a single parameter whatever its length (so a L{PlanCache}
+        can use the same plan for lists of any length).
     """
 
 
     def __init__(self, fallbacks=None):
         self.classes = {}
         self.fallbacks = fallbacks or []
+        self.binds_lists = False
 
 
     def when(self, *cls):
@@ -154,7 +487,7 @@ compiler = Compiler()
 @compiler.when(Query)
 def compile_Query(query, state):
     # select
-    props = query.properties()
+    props = query.columns()
     columns = []
     select_args = []
     for prop in props:
@@ -162,11 +495,20 @@ def compile_Query(query, state):
         columns.append(s)
         select_args.extend(q)
     select_clause = ['SELECT %s' % (','.join(columns),)]
+    # a subquery's selected classes are its own, even if the enclosing
+    # query has them too
+    selected = list(state.classes)
 
     # where
     where_clause = []
     where_args = []
     constraints = query.constraints
+    keyset = query.keyset()
+    if keyset is not None:
+        if constraints is None:
+            constraints = keyset
+        else:
+            constraints = And(constraints, keyset)
     if constraints:
         s, a = state.compile(constraints)
         where_clause = ['WHERE %s' % (s,)]
@@ -177,37 +519,40 @@ def compile_Query(query, state):
     tables = []
     joins = []
     join_args  = []
-    join_classes = []
+    join_classes = set()
 
     joins_per_table = defaultdict(lambda:[])
 
-    for j in query.joins:        
-        # figure out which tables are involved in this left join for a clue
-        # on where to put the left join.
-        tmp_state = State()
-        compiler.compile(j.on, tmp_state)
-        classes = tmp_state.classes
-        classes.remove(j.cls)
-        
-        join_classes.append(j.cls)
-        s, a = state.compile(j)
+    outer = set(state.outer).difference(selected)
+    compiled_joins = []
+    for j in query.joins:
+        s, a, touched = state.compileTouching(j)
+        join_classes.add(j.cls)
         joins.append(s)
         join_args.extend(a)
-
-        joins_per_table[classes[0]].append((j.cls,s,a))
-
-    classes = [x for x in state.classes]
-    for j in join_classes:
-        if j in classes:
-            classes.remove(j)
+        compiled_joins.append((j, s, a, touched))
+
+    for j, s, a, touched in compiled_joins:
+        # the first other table of this query the join refers to is where
+        # it's put (tables of an enclosing query aren't in this FROM)
+        depends = [x for x in touched if x is not j.cls
+                   and (x in join_classes or x not in outer)]
+        if not depends:
+            raise CompileError("The join of %s doesn't refer to any other "
+                               "table of the query it's in" % (
+                               j.cls.__name__,))
+        joins_per_table[depends[0]].append((j.cls,s,a))
+
+    classes = [x for x in state.classes
+               if x not in outer and x not in join_classes]
 
     for cls in classes:
         s, a = state.compile(Table(cls))
         slist = [s]
         alist = list(a)
-        classes_in_this_from = [cls]
+        classes_in_this_from = deque([cls])
         while classes_in_this_from:
-            this_cls = classes_in_this_from.pop(0)
+            this_cls = classes_in_this_from.popleft()
             # append any joins that depend on this class
             for jcls,js,ja in joins_per_table[this_cls]:
                 slist.append(js)
@@ -218,12 +563,89 @@ def compile_Query(query, state):
 
     from_clause = ['FROM %s' % (','.join(tables)),]    
 
-    sql = ' '.join(select_clause + from_clause + where_clause)
-    args = tuple(select_args + from_args + where_args)
+    # group by
+    group_clause = []
+    group_args = []
+    if query.group_by:
+        parts = []
+        for item in query.group_by:
+            s, a = state.compile(item)
+            parts.append(s)
+            group_args.extend(a)
+        group_clause = ['GROUP BY %s' % (','.join(parts),)]
+        if query.having is not None:
+            s, a = state.compile(query.having)
+            group_clause.append('HAVING %s' % (s,))
+            group_args.extend(a)
+
+    # order by
+    order_clause = []
+    order_args = []
+    if query.order_by:
+        parts = []
+        for item in query.order_by:
+            s, a = state.compile(item)
+            parts.append(s)
+            order_args.extend(a)
+        order_clause = ['ORDER BY %s' % (','.join(parts),)]
+
+    # limit
+    limit_clause = []
+    limit_args = []
+    if query.limit is not None or query.offset is not None:
+        s, a = state.compile(Limit(query.limit, query.offset))
+        limit_clause = [s]
+        limit_args.extend(a)
+
+    sql = ' '.join(select_clause + from_clause + where_clause + group_clause
+                   + order_clause + limit_clause)
+    args = tuple(select_args + from_args + where_args + group_args
+                 + order_args + limit_args)
     return sql, args
 
 
 
+@compiler.when(Aggregate)
+def compile_Aggregate(x, state):
+    if x.expr is None:
+        return '%s(*)' % (x.function,), ()
+    elif inspect.isclass(x.expr):
+        state.tableAlias(x.expr)
+        return '%s(*)' % (x.function,), ()
+    sql, args = state.compile(x.expr)
+    return '%s(%s)' % (x.function, sql), args
+
+
+
+@compiler.when(Distinct)
+def compile_Distinct(x, state):
+    sql, args = state.compile(x.expr)
+    return 'DISTINCT %s' % (sql,), args
+
+
+
+@compiler.when(Asc)
+def compile_Asc(x, state):
+    sql, args = state.compile(x.prop)
+    return '%s %s' % (sql, x.direction), args
+
+
+
+@compiler.when(Limit)
+def compile_Limit(x, state):
+    parts = []
+    args = ()
+    if x.limit is not None:
+        sql, args = state.compile(x.limit)
+        parts.append('LIMIT %s' % (sql,))
+    if x.offset is not None:
+        sql, offset_args = state.compile(x.offset)
+        parts.append('OFFSET %s' % (sql,))
+        args = args + offset_args
+    return ' '.join(parts), args
+
+
+
 @compiler.when(Property)
 def compile_Property(x, state):
     alias = state.tableAlias(x.cls)
@@ -246,7 +668,10 @@ def compile_Table(table, state):
     return '%s AS %s' % (info.table, state.tableAlias(table.cls)), ()
 
 
-@compiler.when(str, unicode, int, bool, date, datetime)
+_literal_types = (str, unicode, int, bool, date, datetime)
+
+
+@compiler.when(*_literal_types)
 def compile_str(x, state):
     return ('?', (x,))
 
@@ -331,6 +756,123 @@ def compile_Neq(x, state):
 
 
 
+class Like(Comparison):
+    """
+    I match an expression against a pattern, where C{%} matches any string
+    and C{_} any one character.  Whether the match is case-sensitive depends
+    on the database (Postgres: yes, SQLite: not for ASCII).
+    """
+    op = 'LIKE'
+
+
+
+class Between(object):
+    """
+    I'm true when an expression is between (and including) two values.
+    """
+
+    def __init__(self, expr, low, high):
+        self.expr = expr
+        self.low = low
+        self.high = high
+
+
+@compiler.when(Between)
+def compile_Between(x, state):
+    expr, expr_args = state.compile(x.expr)
+    low, low_args = state.compile(x.low)
+    high, high_args = state.compile(x.high)
+    return ('%s BETWEEN %s AND %s' % (expr, low, high),
+            expr_args + low_args + high_args)
+
+
+
+class Subquery(_Comparable):
+    """
+    I'm a L{Query} used as an expression in another query, such as
+    C{Subquery(Query(Count(Book), Book.author_id == Author.id)) > 2}.
+
+    Classes of the enclosing query which my constraints mention are
+    correlated with it (they aren't in my C{FROM}) unless I select them or
+    an expression of them.
+    """
+
+    def __init__(self, query):
+        self.query = query
+
+
+@compiler.when(Subquery)
+def compile_Subquery(x, state):
+    sql, args = state.subState().compile(x.query)
+    return '(%s)' % (sql,), args
+
+
+
+class Exists(object):
+    """
+    I'm true when a L{Query} has any results.
+    """
+
+    def __init__(self, query):
+        self.query = query
+
+
+@compiler.when(Exists)
+def compile_Exists(x, state):
+    sql, args = state.compile(Subquery(x.query))
+    return 'EXISTS %s' % (sql,), args
+
+
+
+class In(object):
+    """
+    I'm true when an expression is equal to one of a list of values, or to
+    one of the results of a L{Query} selecting a single column, as in
+    C{In(Book.author_id, Query(Author.id, Author.name == 'Joe'))}.
+    """
+
+    op = 'IN'
+    array_op = '= ANY'
+    empty = '1 = 0'
+
+    def __init__(self, expr, values):
+        if not isinstance(values, Query):
+            values = tuple(values)
+        self.expr = expr
+        self.values = values
+
+
+
+class NotIn(In):
+    """
+    I'm true when an expression isn't equal to any of a list of values (or
+    the results of a L{Query}).
+    """
+
+    op = 'NOT IN'
+    array_op = '!= ALL'
+    empty = '1 = 1'
+
+
+@compiler.when(In)
+def compile_In(x, state):
+    if isinstance(x.values, Query):
+        expr, expr_args = state.compile(x.expr)
+        sql, args = state.compile(Subquery(x.values))
+        return '%s %s %s' % (expr, x.op, sql), expr_args + args
+    if not x.values:
+        return x.empty, ()
+    expr, args = state.compile(x.expr)
+    args = list(args)
+    parts = []
+    for value in x.values:
+        sql, value_args = state.compile(value)
+        parts.append(sql)
+        args.extend(value_args)
+    return '%s %s (%s)' % (expr, x.op, ','.join(parts)), tuple(args)
+
+
+
 class LogicalBinaryOp(object):
 
     join = None
@@ -348,14 +890,16 @@ class Or(LogicalBinaryOp):
 
 @compiler.when(LogicalBinaryOp)
 def compile_Joiner(x, state):
+    # The args are gathered in a list (not by adding tuples) so that
+    # compiling many items takes time in proportion to how many there are.
     parts = []
-    args = ()
+    args = []
     for item in x.items:
         sql, item_args = state.compile(item)
         parts.append(sql)
-        args = args + item_args
+        args.extend(item_args)
 
-    return ('('+x.join.join(parts)+')', args)
+    return ('('+x.join.join(parts)+')', tuple(args))
 
 
 class Join(object):
@@ -382,5 +926,342 @@ def compile_Join(x, state):
 
 
 
+class Update(object):
+    """
+    I update the rows of a class' table which match some constraints.
+    """
+
+    def __init__(self, cls, constraints=None, values=()):
+        """
+        @param values: A list of (L{Property}, value) pairs to set.
+        """
+        self.cls = cls
+        self.constraints = simplify(constraints)
+        self.values = tuple(values)
+
 
 
+class Delete(object):
+    """
+    I delete the rows of a class' table which match some constraints.
+    """
+
+    def __init__(self, cls, constraints=None):
+        self.cls = cls
+        self.constraints = simplify(constraints)
+
+
+
+def _compileTargetWhere(cls, constraints, state):
+    """
+    Compile the WHERE clause of an UPDATE or DELETE of C{cls}' table.  If
+    the constraints involve other classes, they're checked with an
+    C{EXISTS} subquery correlated with the table being changed.
+    """
+    if constraints is None:
+        return '', ()
+    sql, args = state.compile(constraints)
+    others = [x for x in state.classes if x is not cls]
+    if not others:
+        return ' WHERE %s' % (sql,), args
+    tables = [state.compile(Table(x))[0] for x in others]
+    return ' WHERE EXISTS (SELECT 1 FROM %s WHERE %s)' % (
+           ','.join(tables), sql), args
+
+
+@compiler.when(Update)
+def compile_Update(x, state):
+    table = classInfo(x.cls).table
+    # The table can't be aliased in an UPDATE in every database, so its
+    # columns are qualified with the table's name.
+    state.setAlias(x.cls, table)
+    state.tableAlias(x.cls)
+    set_parts = []
+    set_args = []
+    for prop, value in x.values:
+        sql, args = state.compile(value)
+        set_parts.append('%s=%s' % (prop.column_name, sql))
+        set_args.extend(args)
+    where, where_args = _compileTargetWhere(x.cls, x.constraints, state)
+    return ('UPDATE %s SET %s%s' % (table, ','.join(set_parts), where),
+            tuple(set_args) + where_args)
+
+
+@compiler.when(Delete)
+def compile_Delete(x, state):
+    table = classInfo(x.cls).table
+    state.setAlias(x.cls, table)
+    state.tableAlias(x.cls)
+    where, where_args = _compileTargetWhere(x.cls, x.constraints, state)
+    return 'DELETE FROM %s%s' % (table, where), where_args
+
+
+
+class _Param(object):
+    """
+    I stand in for a literal value in a query compiled by L{PlanCache}.
+
+    @ivar index: The index of the literal I stand in for.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+
+@compiler.when(_Param)
+def compile_Param(x, state):
+    return ('?', (x,))
+
+
+_value_types = _literal_types + (_Param,)
+
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+
+def _walk(thing, literals, build, lists=False):
+    """
+    Walk an expression, computing a key that describes its structure but not
+    the values of its literals.
+
+    @param literals: A list to which the literal values are appended, in the
+        order they're walked.
+    @param build: If C{True}, also build a copy of the expression with each
+        literal replaced by a L{_Param}.
+    @param lists: If C{True}, the literal values of an L{In} are walked as a
+        single literal list (see L{Compiler.binds_lists}).
+
+    @raise _Uncacheable: If C{thing} isn't something I know how to walk.
+
+    @return: A tuple of the key and the copy (or C{None}).
+    """
+    t = type(thing)
+    if t in _literal_types:
+        literals.append(thing)
+        if build:
+            return t, _Param(len(literals) - 1)
+        return t, None
+    elif thing is None:
+        return None, None
+    elif isinstance(thing, Property):
+        return (Property, thing.cls, thing.attr_name), thing
+    elif isinstance(thing, Relation):
+        return (Relation, thing.cls, thing.attr_name), thing
+    elif inspect.isclass(thing):
+        return thing, thing
+    elif t in (list, tuple):
+        parts = [_walk(x, literals, build, lists) for x in thing]
+        key = (t,) + tuple([x[0] for x in parts])
+        if build:
+            return key, t([x[1] for x in parts])
+        return key, None
+    elif (not hasattr(thing, '__dict__') or inspect.isroutine(thing)
+          or inspect.ismodule(thing)):
+        raise _Uncacheable(thing)
+    elif (lists and isinstance(thing, In) and type(thing.values) is tuple
+          and thing.values
+          and not [x for x in thing.values if type(x) not in _literal_types]):
+        expr = _walk(thing.expr, literals, build, lists)
+        literals.append(list(thing.values))
+        copy = None
+        if build:
+            copy = t.__new__(t)
+            copy.__dict__.update(vars(thing))
+            copy.expr = expr[1]
+            copy.values = _Param(len(literals) - 1)
+        return (t, expr[0], list), copy
+
+    items = sorted(vars(thing).items())
+    parts = [_walk(v, literals, build, lists) for k,v in items]
+    key = (t,) + tuple([(k, part[0]) for (k,v), part in zip(items, parts)])
+    copy = None
+    if build:
+        copy = t.__new__(t)
+        for (k,v), part in zip(items, parts):
+            copy.__dict__[k] = part[1]
+    return key, copy
+
+
+
+def simplify(expr):
+    """
+    Get a simpler expression which means the same as C{expr}, for shorter
+    SQL and so that more queries share a plan in a L{PlanCache}:
+
+        - L{And}s in L{And}s (and L{Or}s in L{Or}s) are flattened.
+        - An L{And} or L{Or} of one item is replaced by the item.
+        - Repeated items of an L{And} or L{Or} are left out.
+        - In an L{Or}, equalities of the same expression with literal
+          values are combined into an L{In}, so C{Or(x == 1, x == 2)}
+          becomes C{In(x, [1, 2])}.
+
+    @return: The simpler expression, or C{None} for an empty L{And}.
+    """
+    if not isinstance(expr, LogicalBinaryOp):
+        return expr
+    cls = type(expr)
+    items = []
+    for item in expr.items:
+        item = simplify(item)
+        if type(item) is cls:
+            items.extend(item.items)
+        elif item is not None:
+            items.append(item)
+    if isinstance(expr, Or):
+        items = _combineEqualities(items)
+    items = _unique(items)
+    if len(items) == 1:
+        return items[0]
+    if not items and isinstance(expr, And):
+        return None
+    return cls(*items)
+
+
+def _unique(items):
+    """
+    Leave out items which are the same (in structure and literal values) as
+    an earlier item.
+    """
+    seen = set()
+    ret = []
+    for item in items:
+        literals = []
+        try:
+            key = (_walk(item, literals, False)[0], tuple(literals))
+            hash(key)
+        except (_Uncacheable, TypeError):
+            ret.append(item)
+            continue
+        if key not in seen:
+            seen.add(key)
+            ret.append(item)
+    return ret
+
+
+
+class _Equalities(object):
+    """
+    I'm the values an expression is compared to by the L{Eq}s of an L{Or}.
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.values = []
+        self._seen = set()
+        self.first = None
+
+
+    def add(self, eq):
+        if self.first is None:
+            self.first = eq
+        key = (type(eq.right), eq.right)
+        if key not in self._seen:
+            self._seen.add(key)
+            self.values.append(eq.right)
+
+
+    def combined(self):
+        if len(self.values) == 1:
+            return self.first
+        return In(self.expr, self.values)
+
+
+def _combineEqualities(items):
+    """
+    Combine the L{Eq}s among the items of an L{Or} which compare the same
+    expression with literal values into an L{In} (in place of the first).
+    """
+    ret = []
+    by_expr = {}
+    for item in items:
+        if (type(item) is Eq and isinstance(item.left, _Comparable)
+                and type(item.right) in _value_types):
+            group = by_expr.get(id(item.left), None)
+            if group is None:
+                group = by_expr[id(item.left)] = _Equalities(item.left)
+                ret.append(group)
+            group.add(item)
+        else:
+            ret.append(item)
+    if not by_expr:
+        return ret
+    return [x.combined() if type(x) is _Equalities else x for x in ret]
+
+
+
+class PlanCache(object):
+    """
+    I compile L{Query}s, remembering the SQL for queries of the same shape
+    (selected classes, constraints, joins and so on) so that compiling a
+    query that only differs in its literal values is just a lookup.
+
+    I can be used from several threads at once (as an operator is by a
+    threaded pool).
+
+    @ivar hits: Number of compilations answered from the cache.
+    @ivar misses: Number of compilations that had to be done.
+    """
+
+
+    def __init__(self, compiler, size=256):
+        """
+        @param compiler: The L{Compiler} to use on a cache miss.
+        @param size: The most plans to keep.  The least recently used plan is
+            forgotten to make room for a new one.
+        """
+        self.compiler = compiler
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def compile(self, query):
+        """
+        Compile C{query} into SQL and arguments.
+        """
+        literals = []
+        lists = self.compiler.binds_lists
+        try:
+            key = _walk(query, literals, False, lists)[0]
+        except _Uncacheable:
+            return self.compiler.compile(query)
+
+        with self._lock:
+            plan = self._plans.pop(key, None)
+            if plan is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._plans[key] = plan
+        if plan is None:
+            # compiled without the lock so other threads aren't kept waiting
+            plan = self.compiler.compile(_walk(query, [], True, lists)[1])
+            with self._lock:
+                self._plans.pop(key, None)
+                while self._plans and len(self._plans) >= self.size:
+                    self._plans.popitem(last=False)
+                self._plans[key] = plan
+
+        sql, recipe = plan
+        args = []
+        for x in recipe:
+            if type(x) is _Param:
+                x = literals[x.index]
+            elif type(x) is list:
+                # a list of values bound to one placeholder
+                x = [literals[y.index] if type(y) is _Param else y for y in x]
+            args.append(x)
+        return sql, tuple(args)
+
+
+    def clear(self):
+        """
+        Forget all the plans.
+        """
+        with self._lock:
+            self._plans.clear()
@@ -8,8 +8,10 @@ from datetime import datetime, date
 
 from norm.interface import IOperator
 from norm.orm.props import Int, String, Unicode, Date, DateTime, Bool
-from norm.orm.expr import Query, Eq, And, LeftJoin
-from norm.orm.error import NotFound
+from norm.orm.expr import (Query, Eq, And, LeftJoin, Desc, Count, Max, Sum,
+                           In, NotIn, Like, Between, Exists, Subquery)
+from norm.orm.error import NotFound, NotLoaded
+from norm.orm.base import objectInfo, compact, One, Many
 from norm import ormHandle
 
 
@@ -24,6 +26,25 @@ class Empty(object):
     mybool = Bool()
 
 
+@compact
+class CompactEmpty(object):
+    __sql_table__ = 'empty'
+    id = Int(primary=True)
+    name = String()
+    uni = Unicode()
+    date = Date()
+    dtime = DateTime()
+    mybool = Bool()
+
+
+class Lazy(object):
+    __sql_table__ = 'empty'
+    id = Int(primary=True)
+    name = String()
+    uni = Unicode(deferred=True)
+
+
+
 class Defaults(object):
     __sql_table__ = 'with_defaults'
     id = Int(primary=True)
@@ -38,6 +59,7 @@ class Parent(object):
     __sql_table__ = 'parent'
     id = Int(primary=True)
     name = Unicode()
+    children = Many(id, lambda: Child.parent_id, order_by=lambda: Child.id)
 
 
 class Child(object):
@@ -45,6 +67,7 @@ class Child(object):
     id = Int(primary=True)
     name = Unicode()
     parent_id = Int()
+    parent = One(parent_id, lambda: Parent.id)
 
     def __init__(self, name=None):
         self.name = name
@@ -208,6 +231,123 @@ class FunctionalIOperatorTestsMixin(object):
         self.assertEqual(empty.name, '\x00\x01\x02hey\x00')
 
 
+    @defer.inlineCallbacks
+    def test_insertMany(self):
+        """
+        You can insert several objects of several classes at once.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        objs = []
+        for i in xrange(5):
+            e = Empty()
+            e.name = str(i)
+            objs.append(e)
+            objs.append(Book(u'book %d' % (i,)))
+        other = Empty()
+        other.uni = u'different columns'
+        objs.append(other)
+
+        result = yield pool.runInteraction(oper.insertMany, objs)
+        self.assertEqual(result, objs)
+
+        empties = [x for x in objs if isinstance(x, Empty)]
+        self.assertEqual(len(set([x.id for x in empties])), 6,
+                         "Should populate the primary key id")
+        for e in empties[:5]:
+            fresh = Empty()
+            fresh.id = e.id
+            yield pool.runInteraction(oper.refresh, fresh)
+            self.assertEqual(fresh.name, e.name, "Should match the object "
+                             "to the right row")
+        self.assertEqual(other.uni, u'different columns')
+        self.assertEqual(other.name, None)
+
+        books = yield pool.runInteraction(oper.query, Query(Book))
+        self.assertEqual(sorted([x.name for x in books]),
+                         [u'book %d' % (i,) for i in xrange(5)])
+
+
+    @defer.inlineCallbacks
+    def test_insertMany_defaults(self):
+        """
+        Inserted objects should get the default values from the database.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        d1 = Defaults()
+        d2 = Defaults()
+        d3 = Defaults()
+        d3.name = 'something'
+        d4 = Defaults()
+        d4.name = 'another'
+
+        yield pool.runInteraction(oper.insertMany, [d1, d2, d3, d4])
+        self.assertEqual(len(set([d1.id, d2.id, d3.id, d4.id])), 4)
+        self.assertEqual(d1.name, 'hey')
+        self.assertEqual(d2.uni, u'ho')
+        self.assertEqual(d3.name, 'something')
+        self.assertEqual(d3.mybool, True)
+        self.assertEqual(d4.name, 'another')
+        self.assertEqual(objectInfo(d4).changed(), [])
+
+
+    @defer.inlineCallbacks
+    def test_insertMany_primaryKeys(self):
+        """
+        You can insert several objects with given primary keys.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        favs = []
+        for i in xrange(3):
+            fav = FavoriteBook(10, 20 - i)
+            fav.stars = i
+            favs.append(fav)
+        p1 = Parent()
+        p1.id = 12
+        p2 = Parent()
+        p2.id = 3
+
+        yield pool.runInteraction(oper.insertMany, favs + [p1, p2])
+        self.assertEqual([x.book_id for x in favs], [20, 19, 18])
+        self.assertEqual([x.stars for x in favs], [0, 1, 2])
+        self.assertEqual(p1.id, 12)
+        self.assertEqual(p2.id, 3)
+
+        parents = yield pool.runInteraction(oper.query, Query(Parent))
+        self.assertEqual(sorted([x.id for x in parents]), [3, 12])
+
+
+    @defer.inlineCallbacks
+    def test_insertMany_noRefresh(self):
+        """
+        You can skip updating the objects from the database.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        objs = []
+        for i in xrange(4):
+            e = Empty()
+            e.name = '\x00%d' % (i,)
+            e.uni = u'\N{SNOWMAN}\t\\%d' % (i,)
+            e.date = date(2000, 1, i + 1)
+            e.mybool = bool(i % 2)
+            objs.append(e)
+
+        yield pool.runInteraction(oper.insertMany, objs, False)
+        rows = yield pool.runInteraction(oper.query, Query(Empty))
+        rows = sorted(rows, key=lambda x:x.name)
+        self.assertEqual([x.name for x in rows], [x.name for x in objs])
+        self.assertEqual([x.uni for x in rows], [x.uni for x in objs])
+        self.assertEqual([x.date for x in rows], [x.date for x in objs])
+        self.assertEqual([x.mybool for x in rows], [x.mybool for x in objs])
+
+
     @defer.inlineCallbacks
     def test_query_basic(self):
         """
@@ -254,6 +394,453 @@ class FunctionalIOperatorTestsMixin(object):
         self.assertEqual(items[0].name, '1')
 
 
+    @defer.inlineCallbacks
+    def test_query_planCache(self):
+        """
+        Queries of the same shape are only compiled once.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        for name in ['1', '2']:
+            e = Empty()
+            e.name = name
+            yield pool.runInteraction(oper.insert, e)
+
+        for name in ['1', '2']:
+            items = yield pool.runInteraction(oper.query,
+                                              Query(Empty, Empty.name == name))
+            self.assertEqual([x.name for x in items], [name])
+        self.assertEqual(oper.plans.misses, 1)
+        self.assertEqual(oper.plans.hits, 1)
+
+
+    @defer.inlineCallbacks
+    def test_query_as(self):
+        """
+        You can get plain values instead of objects.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        e = Empty()
+        e.name = 'foo'
+        e.uni = u'\N{SNOWMAN}'
+        e.date = date(2000, 1, 1)
+        e.mybool = True
+        yield pool.runInteraction(oper.insert, e)
+
+        query = Query(Empty, Empty.name == 'foo')
+        expected = (date(2000, 1, 1), None, e.id, True, 'foo',
+                    u'\N{SNOWMAN}')
+
+        rows = yield pool.runInteraction(oper.query, query, 'tuples')
+        self.assertEqual(rows, [expected])
+        self.assertEqual(type(rows[0][4]), str)
+
+        rows = yield pool.runInteraction(oper.query, query, 'namedtuples')
+        self.assertEqual(rows[0].name, 'foo')
+        self.assertEqual(rows[0].mybool, True)
+        self.assertEqual(tuple(rows[0]), expected)
+
+        rows = yield pool.runInteraction(oper.query, query, 'dicts')
+        self.assertEqual(rows, [dict(zip(
+            ['date', 'dtime', 'id', 'mybool', 'name', 'uni'], expected))])
+
+        columns = yield pool.runInteraction(oper.query, query, 'columns')
+        self.assertEqual(columns.keys(),
+                         ['date', 'dtime', 'id', 'mybool', 'name', 'uni'])
+        self.assertEqual(columns['name'], ['foo'])
+
+        yield self.assertFailure(
+            pool.runInteraction(oper.query, query, 'foo'), ValueError)
+
+
+    @defer.inlineCallbacks
+    def test_query_as_multiClass(self):
+        """
+        Plain values for several classes are named by class and attribute.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        p = Parent()
+        p.id = 1
+        c = Child(u'child1')
+        c.parent_id = 1
+        yield pool.runInteraction(oper.insertMany, [p, c])
+
+        rows = yield pool.runInteraction(oper.query,
+            Query((Child, Parent), Eq(Child.parent_id, Parent.id)), 'dicts')
+        self.assertEqual(rows, [{
+            'Child_id': c.id,
+            'Child_name': u'child1',
+            'Child_parent_id': 1,
+            'Parent_id': 1,
+            'Parent_name': None,
+        }])
+
+
+    @defer.inlineCallbacks
+    def test_query_orderBy(self):
+        """
+        Results can be sorted, limited and offset by the database.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        for name in ['b', 'c', 'a', 'b']:
+            e = Empty()
+            e.name = name
+            yield pool.runInteraction(oper.insert, e)
+
+        def names(**kwargs):
+            d = pool.runInteraction(oper.query, Query(Empty, **kwargs))
+            return d.addCallback(lambda x: [(y.name, y.id) for y in x])
+
+        items = yield names(order_by=[Empty.name, Empty.id])
+        self.assertEqual(items, [('a', 3), ('b', 1), ('b', 4), ('c', 2)])
+
+        items = yield names(order_by=[Desc(Empty.name), Empty.id])
+        self.assertEqual(items, [('c', 2), ('b', 1), ('b', 4), ('a', 3)])
+
+        items = yield names(order_by=Empty.id, limit=2)
+        self.assertEqual(items, [('b', 1), ('c', 2)])
+
+        items = yield names(order_by=Empty.id, limit=2, offset=1)
+        self.assertEqual(items, [('c', 2), ('a', 3)])
+
+        items = yield names(order_by=Empty.id, offset=3)
+        self.assertEqual(items, [('b', 4)])
+
+
+    @defer.inlineCallbacks
+    def test_query_after(self):
+        """
+        Pages of results can be gotten by giving the last row seen.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        for name in ['b', 'c', 'a', 'b', 'a']:
+            e = Empty()
+            e.name = name
+            yield pool.runInteraction(oper.insert, e)
+
+        order_by = [Desc(Empty.name), Empty.id]
+        seen = []
+        query = Query(Empty, order_by=order_by, limit=2)
+        while True:
+            items = yield pool.runInteraction(oper.query, query)
+            if not items:
+                break
+            seen.extend([(x.name, x.id) for x in items])
+            query = Query(Empty, order_by=order_by, limit=2, after=items[-1])
+        self.assertEqual(seen, [('c', 2), ('b', 1), ('b', 4), ('a', 3),
+                                ('a', 5)])
+
+
+    @defer.inlineCallbacks
+    def test_query_aggregate(self):
+        """
+        Aggregates can be computed by the database, for groups of rows.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        for name, day in [('a', 1), ('b', 2), ('a', 3)]:
+            e = Empty()
+            e.name = name
+            e.date = date(2000, 1, day)
+            yield pool.runInteraction(oper.insert, e)
+
+        query = Query((Empty.name, Count(Empty), Max(Empty.date),
+                       Sum(Empty.id)),
+                      group_by=Empty.name, order_by=Empty.name)
+        rows = yield pool.runInteraction(oper.query, query)
+        self.assertEqual(rows, [
+            ['a', 2, date(2000, 1, 3), 4],
+            ['b', 1, date(2000, 1, 2), 2],
+        ])
+
+        rows = yield pool.runInteraction(oper.query, query, 'dicts')
+        self.assertEqual(rows[0], {'name': 'a', 'count': 2,
+                                   'max_date': date(2000, 1, 3),
+                                   'sum_id': 4})
+
+        counts = yield pool.runInteraction(oper.query, Query(Count(Empty)))
+        self.assertEqual(counts, [3])
+
+
+    @defer.inlineCallbacks
+    def test_query_In(self):
+        """
+        Objects can be matched against a list of values, or the results of a
+        subquery.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        for name in ['a', 'b', 'c', 'd']:
+            e = Empty()
+            e.name = name
+            yield pool.runInteraction(oper.insert, e)
+
+        def names(*constraints):
+            d = pool.runInteraction(oper.query, Query(Empty, *constraints,
+                                                      order_by=Empty.id))
+            return d.addCallback(lambda x: [y.name for y in x])
+
+        items = yield names(In(Empty.id, [1, 3, 5]))
+        self.assertEqual(items, ['a', 'c'])
+        items = yield names(In(Empty.id, [2, 3, 4]))
+        self.assertEqual(items, ['b', 'c', 'd'])
+        items = yield names(In(Empty.name, ['d', 'a']))
+        self.assertEqual(items, ['a', 'd'])
+        items = yield names(NotIn(Empty.id, [1, 3]))
+        self.assertEqual(items, ['b', 'd'])
+        items = yield names(In(Empty.id, []))
+        self.assertEqual(items, [])
+        items = yield names(NotIn(Empty.id, []))
+        self.assertEqual(items, ['a', 'b', 'c', 'd'])
+        items = yield names(In(Empty.id, Query(Empty.id, Empty.id > 2)))
+        self.assertEqual(items, ['c', 'd'])
+
+
+    @defer.inlineCallbacks
+    def test_query_LikeBetween(self):
+        """
+        Objects can be matched against a pattern or a range.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        for name in [u'apple', u'apricot', u'banana']:
+            p = Parent()
+            p.name = name
+            yield pool.runInteraction(oper.insert, p)
+
+        def names(*constraints):
+            d = pool.runInteraction(oper.query, Query(Parent, *constraints,
+                                                      order_by=Parent.id))
+            return d.addCallback(lambda x: [y.name for y in x])
+
+        items = yield names(Like(Parent.name, u'ap%'))
+        self.assertEqual(items, [u'apple', u'apricot'])
+        items = yield names(Like(Parent.name, u'_anana'))
+        self.assertEqual(items, [u'banana'])
+        items = yield names(Between(Parent.id, 2, 3))
+        self.assertEqual(items, [u'apricot', u'banana'])
+
+
+    @defer.inlineCallbacks
+    def test_query_Exists(self):
+        """
+        Objects can be matched with correlated subqueries.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        parents = []
+        for name in [u'a', u'b', u'c']:
+            p = Parent()
+            p.name = name
+            yield pool.runInteraction(oper.insert, p)
+            parents.append(p)
+        for parent, count in zip(parents, [2, 1, 0]):
+            for i in xrange(count):
+                child = Child(u'child')
+                child.parent_id = parent.id
+                yield pool.runInteraction(oper.insert, child)
+
+        def names(*constraints):
+            d = pool.runInteraction(oper.query, Query(Parent, *constraints,
+                                                      order_by=Parent.id))
+            return d.addCallback(lambda x: [y.name for y in x])
+
+        items = yield names(Exists(Query(Child,
+                                         Child.parent_id == Parent.id)))
+        self.assertEqual(items, [u'a', u'b'])
+        children = Subquery(Query(Count(Child), Child.parent_id == Parent.id))
+        items = yield names(children < 2)
+        self.assertEqual(items, [u'b', u'c'])
+
+
+    @defer.inlineCallbacks
+    def test_query_eager(self):
+        """
+        Related objects can be loaded for all the objects found by a query
+        with one more query per relation.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+        oper.eager_chunk_size = 2
+
+        parents = []
+        for name in [u'a', u'b', u'c']:
+            p = Parent()
+            p.name = name
+            yield pool.runInteraction(oper.insert, p)
+            parents.append(p)
+        for parent, count in zip(parents, [2, 1, 0]):
+            for i in xrange(count):
+                child = Child(u'%s%d' % (parent.name, i))
+                child.parent = parent
+                yield pool.runInteraction(oper.insert, child)
+        orphan = Child(u'orphan')
+        yield pool.runInteraction(oper.insert, orphan)
+
+        parents = yield pool.runInteraction(oper.query, Query(Parent,
+                                            order_by=Parent.id,
+                                            eager=Parent.children))
+        self.assertEqual([[x.name for x in y.children] for y in parents],
+                         [[u'a0', u'a1'], [u'b0'], []])
+        self.assertRaises(NotLoaded, getattr, parents[0].children[0],
+                          'parent')
+
+        children = yield pool.runInteraction(oper.query, Query(Child,
+                                             order_by=Child.id,
+                                             eager=Child.parent))
+        self.assertEqual([x.parent and x.parent.name for x in children],
+                         [u'a', u'a', u'b', None])
+
+        parents = yield pool.runInteraction(oper.query, Query(Parent,
+                                            Parent.name == u'a',
+                                            eager=[Parent.children,
+                                                   Child.parent]))
+        self.assertEqual([x.parent.name for x in parents[0].children],
+                         [u'a', u'a'])
+
+        related = yield pool.runInteraction(oper.loadRelated, [orphan],
+                                            Child.parent)
+        self.assertEqual(related, [])
+        self.assertEqual(orphan.parent, None)
+
+
+    @defer.inlineCallbacks
+    def test_count(self):
+        """
+        The rows a query would return can be counted.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        for name in ['a', 'b', 'a']:
+            e = Empty()
+            e.name = name
+            yield pool.runInteraction(oper.insert, e)
+
+        count = yield pool.runInteraction(oper.count, Query(Empty))
+        self.assertEqual(count, 3)
+        count = yield pool.runInteraction(oper.count,
+            Query(Empty, Empty.name == 'a'))
+        self.assertEqual(count, 2)
+        count = yield pool.runInteraction(oper.count,
+            Query(Empty.name, group_by=Empty.name))
+        self.assertEqual(count, 2)
+
+
+    @defer.inlineCallbacks
+    def test_compact(self):
+        """
+        Objects of compact classes can be inserted, queried, updated and
+        deleted.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        e = CompactEmpty()
+        e.name = 'foo'
+        e.uni = u'\N{SNOWMAN}'
+        e.date = date(2000, 1, 1)
+        e.mybool = True
+        yield pool.runInteraction(oper.insert, e)
+        self.assertNotEqual(e.id, None)
+        self.assertEqual(objectInfo(e).changed(), [])
+
+        items = yield pool.runInteraction(oper.query, Query(CompactEmpty))
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0].id, e.id)
+        self.assertEqual(items[0].name, 'foo')
+        self.assertEqual(items[0].uni, u'\N{SNOWMAN}')
+        self.assertEqual(items[0].date, date(2000, 1, 1))
+        self.assertEqual(items[0].mybool, True)
+
+        items[0].name = 'bar'
+        yield pool.runInteraction(oper.update, items[0])
+        yield pool.runInteraction(oper.refresh, e)
+        self.assertEqual(e.name, 'bar')
+
+        yield pool.runInteraction(oper.delete, e)
+        items = yield pool.runInteraction(oper.query, Query(CompactEmpty))
+        self.assertEqual(items, [])
+
+
+    @defer.inlineCallbacks
+    def test_iterate(self):
+        """
+        You can get the results of a query in batches.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        objs = []
+        for i in xrange(7):
+            e = Empty()
+            e.name = str(i)
+            objs.append(e)
+        yield pool.runInteraction(oper.insertMany, objs)
+
+        batches = []
+        def handle(batch):
+            batches.append(batch)
+            return defer.succeed(None)
+        yield pool.runInteraction(oper.iterate,
+                                  Query(Empty, Empty.name != '3'), handle, 2)
+
+        self.assertEqual([len(x) for x in batches], [2, 2, 2])
+        names = sorted([x.name for batch in batches for x in batch])
+        self.assertEqual(names, ['0', '1', '2', '4', '5', '6'])
+
+
+    @defer.inlineCallbacks
+    def test_iterate_multiClass(self):
+        """
+        Queries for several classes give tuples in each batch.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        p = Parent()
+        p.id = 1
+        c = Child(u'child1')
+        c.parent_id = 1
+        yield pool.runInteraction(oper.insertMany, [p, c])
+
+        batches = []
+        yield pool.runInteraction(oper.iterate,
+                                  Query((Child, Parent),
+                                        Eq(Child.parent_id, Parent.id)),
+                                  batches.append)
+        self.assertEqual(len(batches), 1)
+        child, parent = batches[0][0]
+        self.assertEqual(child.name, u'child1')
+        self.assertEqual(parent.id, 1)
+
+
+    @defer.inlineCallbacks
+    def test_iterate_empty(self):
+        """
+        If there are no results, the function is never called.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        batches = []
+        yield pool.runInteraction(oper.iterate, Query(Empty), batches.append)
+        self.assertEqual(batches, [])
+
+
     @defer.inlineCallbacks
     def test_query_Eq_str(self):
         """
@@ -658,6 +1245,58 @@ class FunctionalIOperatorTestsMixin(object):
         self.assertEqual(obj2.name, 'hello', "Should update attributes")
 
 
+    @defer.inlineCallbacks
+    def test_query_project(self):
+        """
+        Only the primary key and the projected properties are loaded.  The
+        others can be loaded later with L{IOperator.refresh}.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        e = Empty()
+        e.name = 'foo'
+        e.uni = u'uni'
+        yield pool.runInteraction(oper.insert, e)
+
+        query = Query(Empty, project=[Empty.name])
+        items = yield pool.runInteraction(oper.query, query)
+        item = items[0]
+        self.assertEqual((item.id, item.name), (e.id, 'foo'))
+        self.assertRaises(NotLoaded, getattr, item, 'uni')
+        self.assertEqual(objectInfo(item).changed(), [])
+
+        rows = yield pool.runInteraction(oper.query, query, 'tuples')
+        self.assertEqual(rows, [(e.id, 'foo')])
+
+        yield pool.runInteraction(oper.refresh, item, [Empty.uni])
+        self.assertEqual(item.uni, u'uni')
+        self.assertRaises(NotLoaded, getattr, item, 'date')
+
+
+    @defer.inlineCallbacks
+    def test_query_deferred(self):
+        """
+        Deferred properties are only loaded if they're projected.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        e = Empty()
+        e.name = 'foo'
+        e.uni = u'uni'
+        yield pool.runInteraction(oper.insert, e)
+
+        items = yield pool.runInteraction(oper.query, Query(Lazy))
+        self.assertEqual(items[0].name, 'foo')
+        self.assertRaises(NotLoaded, getattr, items[0], 'uni')
+
+        items = yield pool.runInteraction(oper.query,
+                                          Query(Lazy, project=[Lazy.uni]))
+        self.assertEqual(items[0].uni, u'uni')
+        self.assertRaises(NotLoaded, getattr, items[0], 'name')
+
+
     @defer.inlineCallbacks
     def test_refresh_multiPrimary(self):
         """
@@ -701,6 +1340,135 @@ class FunctionalIOperatorTestsMixin(object):
         self.assertEqual(obj2.date, date(2000, 1, 1))
 
 
+    @defer.inlineCallbacks
+    def test_updateMany(self):
+        """
+        Several objects, with different changed attributes, can be updated
+        at once.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        objs = []
+        for i in xrange(5):
+            e = Empty()
+            e.name = 'name%d' % (i,)
+            yield pool.runInteraction(oper.insert, e)
+            objs.append(e)
+        for e in objs:
+            objectInfo(e).resetChangedList()
+        objs[0].name = 'a'
+        objs[1].name = 'b'
+        objs[2].date = date(2001, 1, 1)
+        objs[2].uni = u'\N{SNOWMAN}'
+        objs[3].mybool = True
+
+        result = yield pool.runInteraction(oper.updateMany, objs)
+        self.assertEqual(result, objs)
+        items = yield pool.runInteraction(oper.query,
+            Query(Empty, order_by=Empty.id))
+        self.assertEqual([(x.name, x.date, x.uni, x.mybool) for x in items], [
+            ('a', None, None, None),
+            ('b', None, None, None),
+            ('name2', date(2001, 1, 1), u'\N{SNOWMAN}', None),
+            ('name3', None, None, True),
+            ('name4', None, None, None),
+        ])
+
+
+    @defer.inlineCallbacks
+    def test_updateWhere(self):
+        """
+        Many rows can be updated with one statement, which gives the number
+        of rows updated.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        for name in ['a', 'b', 'a']:
+            e = Empty()
+            e.name = name
+            yield pool.runInteraction(oper.insert, e)
+
+        count = yield pool.runInteraction(oper.updateWhere, Empty,
+            Empty.name == 'a', {'name': 'c', 'date': date(2000, 1, 1)})
+        self.assertEqual(count, 2)
+        items = yield pool.runInteraction(oper.query,
+            Query(Empty, order_by=Empty.id))
+        self.assertEqual([(x.name, x.date) for x in items], [
+            ('c', date(2000, 1, 1)),
+            ('b', None),
+            ('c', date(2000, 1, 1)),
+        ])
+
+        self.assertRaises(TypeError, oper.updateWhere, None, Empty, None,
+                          {'name': 12})
+        self.assertRaises(TypeError, oper.updateWhere, None, Empty, None,
+                          {'foo': 'a'})
+        self.assertRaises(TypeError, oper.updateWhere, None, Empty, None, {})
+
+
+    @defer.inlineCallbacks
+    def test_updateWhere_validators(self):
+        """
+        Validators are run on the values given to updateWhere, with C{None}
+        as the object since there isn't one.
+        """
+        called = []
+        def upper(prop, obj, value):
+            called.append(obj)
+            return value.upper()
+
+        class Validated(object):
+            __sql_table__ = 'empty'
+            id = Int(primary=True)
+            name = String(validators=[upper])
+
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        e = Empty()
+        e.name = 'a'
+        yield pool.runInteraction(oper.insert, e)
+
+        count = yield pool.runInteraction(oper.updateWhere, Validated,
+            None, {'name': 'b'})
+        self.assertEqual(count, 1)
+        self.assertEqual(called, [None])
+        items = yield pool.runInteraction(oper.query, Query(Empty))
+        self.assertEqual([x.name for x in items], ['B'])
+
+
+    @defer.inlineCallbacks
+    def test_deleteWhere(self):
+        """
+        Many rows can be deleted with one statement, which gives the number
+        of rows deleted.  The constraints can involve other classes.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        parents = []
+        for i in xrange(3):
+            parent = yield pool.runInteraction(oper.insert, Parent())
+            parents.append(parent)
+        child = Child()
+        child.parent_id = parents[1].id
+        child.name = u'kid'
+        yield pool.runInteraction(oper.insert, child)
+
+        count = yield pool.runInteraction(oper.deleteWhere, Parent,
+            And(Parent.id == Child.parent_id, Child.name == u'kid'))
+        self.assertEqual(count, 1)
+        items = yield pool.runInteraction(oper.query,
+            Query(Parent, order_by=Parent.id))
+        self.assertEqual([x.id for x in items],
+                         [parents[0].id, parents[2].id])
+
+        count = yield pool.runInteraction(oper.deleteWhere, Parent, None)
+        self.assertEqual(count, 2)
+
+
     @defer.inlineCallbacks
     def test_delete(self):
         """
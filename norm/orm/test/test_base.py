@@ -3,9 +3,14 @@
 
 from twisted.trial.unittest import TestCase
 
+import threading
+
 from norm.orm.base import (Property, classInfo, objectInfo, reconstitute,
-                           Converter)
-from norm.orm.expr import Eq, Neq, Gt, Gte, Lt, Lte
+                           Converter, invalidateClassInfo, compact,
+                           IdentityMap, RowMaterializer, hydrate,
+                           One, Many)
+from norm.orm.expr import Eq, Neq, Gt, Gte, Lt, Lte, Query, Count, Max
+from norm.orm.error import NotLoaded
 
 
 
@@ -290,6 +295,69 @@ class classInfoTest(TestCase):
 
 
 
+    def test_ordered(self):
+        """
+        Properties, column names and the primary key are available as
+        tuples, with properties in attribute name order.
+        """
+        class Foo(object):
+            b = Property('bee', primary=True)
+            c = Property()
+            a = Property(primary=True)
+
+
+        info = classInfo(Foo)
+        self.assertEqual(info.properties, (Foo.a, Foo.b, Foo.c))
+        self.assertEqual(set(info.column_names), set(['a', 'bee', 'c']))
+        self.assertEqual(info.primary_key, (Foo.a, Foo.b))
+
+
+    def test_cached(self):
+        """
+        The same info is returned each time for a class and its instances.
+        """
+        class Foo(object):
+            a = Property()
+
+
+        info = classInfo(Foo)
+        self.assertIdentical(classInfo(Foo), info)
+        self.assertIdentical(classInfo(Foo()), info)
+
+
+    def test_subclass(self):
+        """
+        Subclasses get their own info.
+        """
+        class Foo(object):
+            a = Property()
+
+        classInfo(Foo)
+
+        class Bar(Foo):
+            b = Property()
+
+        self.assertEqual(classInfo(Foo).properties, (Foo.a,))
+        self.assertEqual(classInfo(Bar).properties, (Foo.a, Bar.b))
+
+
+    def test_invalidate(self):
+        """
+        If a class is changed, you can invalidate the cached info.
+        """
+        class Foo(object):
+            a = Property()
+
+
+        self.assertEqual(classInfo(Foo).properties, (Foo.a,))
+        Foo.b = Property()
+        invalidateClassInfo(Foo)
+        self.assertEqual(classInfo(Foo).properties, (Foo.a, Foo.b))
+        invalidateClassInfo(Foo())
+        self.assertEqual(classInfo(Foo).properties, (Foo.a, Foo.b))
+
+
+
 class objectInfoTest(TestCase):
 
 
@@ -335,6 +403,495 @@ class objectInfoTest(TestCase):
 
 
 
+class compactTest(TestCase):
+
+
+    def test_values(self):
+        """
+        Compact classes keep their values on the instance instead of in the
+        shared dictionary.
+        """
+        @compact
+        class Foo(object):
+            a = Property()
+            b = Property(default_factory=lambda:10)
+
+        foo = Foo()
+        self.assertEqual(foo.a, None)
+        self.assertEqual(foo.b, 10)
+        foo.a = 'hey'
+        self.assertEqual(foo.a, 'hey')
+        self.assertFalse(foo in Property._value_dict)
+        self.assertFalse(hasattr(foo, '__dict__'))
+        self.assertEqual(Foo.a.attr_name, 'a')
+        self.assertEqual(Foo.a.cls, Foo)
+        self.assertEqual(Foo.__name__, 'Foo')
+
+
+    def test_separateInstances(self):
+        """
+        Each instance has its own values.
+        """
+        @compact
+        class Foo(object):
+            a = Property()
+
+        foo1 = Foo()
+        foo2 = Foo()
+        foo1.a = 1
+        foo2.a = 2
+        self.assertEqual((foo1.a, foo2.a), (1, 2))
+
+
+    def test_changed(self):
+        """
+        Changes are tracked on compact objects the same way.
+        """
+        @compact
+        class Foo(object):
+            a = Property()
+            b = Property()
+            c = Property(default_factory=lambda:10)
+
+        foo = Foo()
+        info = objectInfo(foo)
+        self.assertEqual(info.changed(), [Foo.c])
+        info.resetChangedList()
+        self.assertEqual(info.changed(), [])
+
+        foo.b = 'hey'
+        self.assertEqual(info.changed(), [Foo.b])
+        Foo.b.fromDatabase(foo, 'ho')
+        self.assertEqual(foo.b, 'ho')
+        self.assertEqual(info.changed(), [])
+
+
+    def test_init(self):
+        """
+        The class's methods and other attributes are kept.
+        """
+        @compact
+        class Foo(object):
+            __sql_table__ = 'foo'
+            __slots__ = ('other',)
+            a = Property(primary=True)
+
+            def __init__(self, a):
+                self.a = a
+                self.other = 'other'
+
+            def double(self):
+                return self.a * 2
+
+        foo = Foo(3)
+        self.assertEqual(foo.double(), 6)
+        self.assertEqual(foo.other, 'other')
+        self.assertEqual(classInfo(Foo).table, 'foo')
+        self.assertEqual(classInfo(Foo).primary_key, (Foo.a,))
+        self.assertRaises(AttributeError, setattr, foo, 'missing', 1)
+
+
+    def test_reconstitute(self):
+        """
+        Compact objects can be reconstituted.
+        """
+        @compact
+        class Foo(object):
+            a = Property()
+            b = Property()
+
+        foo = reconstitute([(Foo.a, 1), (Foo.b, 2)])
+        self.assertTrue(isinstance(foo, Foo))
+        self.assertEqual((foo.a, foo.b), (1, 2))
+        self.assertEqual(objectInfo(foo).changed(), [])
+
+
+    def test_subclass(self):
+        """
+        Compact classes can be subclassed, and the subclasses made compact
+        too.
+        """
+        @compact
+        class Foo(object):
+            a = Property()
+
+        @compact
+        class Bar(Foo):
+            b = Property()
+
+        bar = Bar()
+        bar.a = 1
+        bar.b = 2
+        self.assertEqual((bar.a, bar.b), (1, 2))
+        self.assertEqual(objectInfo(bar).changed(), [Foo.a, Bar.b])
+
+
+class IdentityMapTest(TestCase):
+
+
+    class Foo(object):
+        id = Property(primary=True)
+        name = Property()
+
+
+    def foo(self, id, name=None):
+        foo = self.Foo()
+        foo.id = id
+        foo.name = name
+        return foo
+
+
+    def test_get(self):
+        """
+        Objects added can be gotten by class and primary key.
+        """
+        imap = IdentityMap()
+        foo = self.foo(1)
+        self.assertEqual(imap.add(foo), foo)
+        self.assertTrue(imap.get(self.Foo, 1) is foo)
+        self.assertEqual(imap.get(self.Foo, 2), None)
+        self.assertEqual(len(imap), 1)
+
+
+    def test_threads(self):
+        """
+        Several threads can use the same map at once.
+        """
+        imap = IdentityMap(size=16)
+        errors = []
+        def work():
+            try:
+                for i in xrange(50):
+                    for id in xrange(40):
+                        imap.load(self.foo(id, 'a'))
+                        imap.get(self.Foo, id + 1)
+                        if id % 3 == 0:
+                            imap.remove(imap.add(self.foo(id)))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=work) for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(len(imap._recent) <= 16)
+
+
+    def test_multiPrimary(self):
+        """
+        Classes with several primary key columns are keyed by all of them.
+        """
+        class Bar(object):
+            a = Property(primary=True)
+            b = Property(primary=True)
+        bar = Bar()
+        bar.a = 1
+        bar.b = 2
+        imap = IdentityMap()
+        imap.add(bar)
+        self.assertTrue(imap.get(Bar, 1, 2) is bar)
+
+
+    def test_noPrimaryKey(self):
+        """
+        Objects without a primary key value aren't tracked.
+        """
+        imap = IdentityMap()
+        imap.add(self.foo(None))
+        self.assertEqual(len(imap), 0)
+
+
+    def test_load(self):
+        """
+        Loading an object with the same primary key as one already known
+        gives the known object, updated with the loaded values for
+        attributes which haven't been changed.
+        """
+        imap = IdentityMap()
+        foo = self.foo(1, 'foo')
+        objectInfo(foo).resetChangedList()
+        imap.add(foo)
+
+        loaded = imap.load(self.foo(1, 'bar'))
+        self.assertTrue(loaded is foo)
+        self.assertEqual(foo.name, 'bar')
+        self.assertEqual(objectInfo(foo).changed(), [])
+
+        foo.name = 'changed'
+        imap.load(self.foo(1, 'baz'))
+        self.assertEqual(foo.name, 'changed', "Should keep local changes")
+
+        other = self.foo(2)
+        self.assertTrue(imap.load(other) is other)
+        self.assertTrue(imap.get(self.Foo, 2) is other)
+        self.assertEqual(imap.load(None), None)
+
+
+    def test_load_notLoaded(self):
+        """
+        Attributes which weren't loaded don't replace the known values.
+        """
+        imap = IdentityMap()
+        foo = self.foo(1, 'foo')
+        objectInfo(foo).resetChangedList()
+        imap.add(foo)
+
+        partial = self.Foo.__new__(self.Foo)
+        hydrate(partial, [self.Foo.id], [1], [self.Foo.name])
+        self.assertTrue(imap.load(partial) is foo)
+        self.assertEqual(foo.name, 'foo')
+
+
+    def test_clear(self):
+        """
+        All objects, or just those of one class, can be forgotten.
+        """
+        class Sub(self.Foo):
+            pass
+        class Other(object):
+            id = Property(primary=True)
+        imap = IdentityMap(size=10)
+        foo = imap.add(self.foo(1))
+        sub = Sub()
+        sub.id = 2
+        imap.add(sub)
+        other = Other()
+        other.id = 1
+        imap.add(other)
+
+        imap.clear(self.Foo)
+        self.assertEqual(imap.get(self.Foo, 1), None)
+        self.assertEqual(imap.get(Sub, 2), None)
+        self.assertTrue(imap.get(Other, 1) is other)
+        imap.add(foo)
+        imap.clear()
+        self.assertEqual(len(imap), 0)
+
+
+    def test_weak(self):
+        """
+        Objects are forgotten when nothing else refers to them.
+        """
+        imap = IdentityMap()
+        imap.add(self.foo(1))
+        self.assertEqual(imap.get(self.Foo, 1), None)
+
+
+    def test_size(self):
+        """
+        The C{size} most recently used objects are kept even if nothing else
+        refers to them.
+        """
+        imap = IdentityMap(size=2)
+        imap.add(self.foo(1))
+        imap.add(self.foo(2))
+        imap.get(self.Foo, 1)
+        imap.add(self.foo(3))
+        self.assertNotEqual(imap.get(self.Foo, 1), None)
+        self.assertEqual(imap.get(self.Foo, 2), None)
+        self.assertNotEqual(imap.get(self.Foo, 3), None)
+
+
+    def test_remove(self):
+        """
+        Objects can be forgotten.
+        """
+        imap = IdentityMap(size=2)
+        foo = self.foo(1)
+        imap.add(foo)
+        imap.remove(foo)
+        self.assertEqual(imap.get(self.Foo, 1), None)
+        imap.add(foo)
+        imap.clear()
+        self.assertEqual(imap.get(self.Foo, 1), None)
+
+
+
+class RelationTest(TestCase):
+
+
+    class Parent(object):
+        id = Property(primary=True)
+        kids = Many(id, lambda: RelationTest.Kid.parent_id)
+
+
+    class Kid(object):
+        id = Property(primary=True)
+        parent_id = Property()
+        parent = One(parent_id, lambda: RelationTest.Parent.id)
+
+
+    def make(self, cls, **values):
+        obj = cls()
+        for k, v in values.items():
+            setattr(obj, k, v)
+        objectInfo(obj).resetChangedList()
+        return obj
+
+
+    def test_class(self):
+        """
+        Relations know their name, class and properties, and are listed in
+        the class' info.
+        """
+        Parent = self.Parent
+        Kid = self.Kid
+        self.assertEqual(Parent.kids.attr_name, 'kids')
+        self.assertEqual(Parent.kids.cls, Parent)
+        self.assertTrue(Parent.kids.local is Parent.id)
+        self.assertTrue(Parent.kids.remote is Kid.parent_id)
+        self.assertEqual(classInfo(Kid).relations, (Kid.parent,))
+
+
+    def test_notLoaded(self):
+        """
+        Getting a relation before it's loaded is an error.
+        """
+        self.assertRaises(NotLoaded, getattr, self.Parent(), 'kids')
+        self.assertRaises(AttributeError, setattr, self.Parent(), 'kids', [])
+
+
+    def test_attach(self):
+        """
+        Related objects are matched up by their keys.
+        """
+        parents = [self.make(self.Parent, id=1), self.make(self.Parent, id=2)]
+        kids = [self.make(self.Kid, id=1, parent_id=1),
+                self.make(self.Kid, id=2, parent_id=1)]
+        self.Parent.kids.attach(parents, kids)
+        self.assertEqual(parents[0].kids, kids)
+        self.assertEqual(parents[1].kids, [])
+
+        self.Kid.parent.attach(kids, parents[1:])
+        self.assertEqual(kids[0].parent, None)
+
+
+    def test_setOne(self):
+        """
+        Setting a L{One} sets the key to match.
+        """
+        parent = self.make(self.Parent, id=3)
+        kid = self.make(self.Kid, id=1)
+        kid.parent = parent
+        self.assertTrue(kid.parent is parent)
+        self.assertEqual(kid.parent_id, 3)
+        self.assertEqual(objectInfo(kid).changed(), [self.Kid.parent_id])
+        kid.parent = None
+        self.assertEqual(kid.parent_id, None)
+
+
+    def test_identityMap(self):
+        """
+        Related objects are loaded into an L{IdentityMap} with the objects
+        they're related to, even when they refer back to them.
+        """
+        imap = IdentityMap()
+        parent = imap.add(self.make(self.Parent, id=1))
+        kid = imap.add(self.make(self.Kid, id=1, parent_id=1))
+
+        parent2 = self.make(self.Parent, id=1)
+        kid2 = self.make(self.Kid, id=1, parent_id=1)
+        self.Parent.kids.attach([parent2], [kid2])
+        self.Kid.parent.attach([kid2], [parent2])
+
+        self.assertTrue(imap.load(parent2) is parent)
+        self.assertEqual(len(parent.kids), 1)
+        self.assertTrue(parent.kids[0] is kid)
+        self.assertTrue(kid.parent is parent)
+
+
+
+class hydrateTest(TestCase):
+
+
+    def test_trusted(self):
+        """
+        Values are set without running validators or populating defaults,
+        and the properties are marked unchanged.
+        """
+        validated = []
+        def validate(prop, obj, value):
+            validated.append(value)
+            return value
+        class Foo(object):
+            a = Property(validators=[validate])
+            b = Property(fromDatabase=lambda x: x * 2)
+            c = Property(default_factory=lambda: 10)
+
+        foo = Foo.__new__(Foo)
+        hydrate(foo, [Foo.a, Foo.b], ['a', 2])
+        self.assertEqual((foo.a, foo.b), ('a', 4))
+        self.assertEqual(validated, [], "Should not validate")
+        self.assertEqual(objectInfo(foo).changed(), [Foo.c])
+        hydrate(foo, [Foo.c], [3])
+        self.assertEqual(foo.c, 3)
+        self.assertEqual(objectInfo(foo).changed(), [])
+
+
+    def test_partial(self):
+        """
+        Only the properties given are marked unchanged.
+        """
+        class Foo(object):
+            a = Property()
+            b = Property()
+
+        foo = Foo()
+        foo.a = 1
+        foo.b = 2
+        hydrate(foo, [Foo.a], [3])
+        self.assertEqual(foo.a, 3)
+        self.assertEqual(objectInfo(foo).changed(), [Foo.b])
+
+
+    def test_compact(self):
+        """
+        Compact objects can be hydrated too.
+        """
+        @compact
+        class Foo(object):
+            a = Property()
+            b = Property()
+
+        foo = Foo()
+        foo.a = 1
+        foo.b = 2
+        hydrate(foo, [Foo.a], [3])
+        self.assertEqual(foo.a, 3)
+        self.assertEqual(objectInfo(foo).changed(), [Foo.b])
+
+        foo2 = Foo.__new__(Foo)
+        hydrate(foo2, [Foo.a, Foo.b], [4, 5])
+        self.assertEqual((foo2.a, foo2.b), (4, 5))
+        self.assertEqual(objectInfo(foo2).changed(), [])
+
+
+
+    def test_notLoaded(self):
+        """
+        Properties can be marked as not loaded, so that getting them raises
+        L{NotLoaded} instead of giving a default, and they aren't changed.
+        """
+        for decorate in [lambda x: x, compact]:
+            class Foo(object):
+                a = Property()
+                b = Property(default_factory=lambda: 10)
+            Foo = decorate(Foo)
+
+            foo = Foo.__new__(Foo)
+            hydrate(foo, [Foo.a], [1], [Foo.b])
+            self.assertEqual(foo.a, 1)
+            self.assertRaises(NotLoaded, getattr, foo, 'b')
+            self.assertEqual(objectInfo(foo).changed(), [])
+            self.assertEqual(objectInfo(foo).notLoaded(), [Foo.b])
+
+            foo.b = 2
+            self.assertEqual(foo.b, 2)
+            self.assertEqual(objectInfo(foo).notLoaded(), [])
+            self.assertEqual(objectInfo(foo).changed(), [Foo.b])
+
+
 class reconstituteTest(TestCase):
 
 
@@ -403,6 +960,108 @@ class reconstituteTest(TestCase):
 
 
 
+class RowMaterializerTest(TestCase):
+
+
+    class Foo(object):
+        a = Property()
+        b = Property()
+
+
+    class Bar(object):
+        c = Property()
+
+
+    def test_single(self):
+        """
+        Rows for a single class become objects of that class.
+        """
+        m = RowMaterializer(Query(self.Foo), Converter())
+        foos = m([(1, 2), (3, 4)])
+        self.assertEqual([(x.a, x.b) for x in foos], [(1, 2), (3, 4)])
+        self.assertTrue(isinstance(foos[0], self.Foo))
+        self.assertEqual(objectInfo(foos[0]).changed(), [])
+
+
+    def test_multiple(self):
+        """
+        Rows for several classes become lists of objects, with C{None} for
+        classes with no values.
+        """
+        m = RowMaterializer(Query((self.Foo, self.Bar)), Converter())
+        rows = m([(1, 2, 3), (4, 5, None)])
+        foo, bar = rows[0]
+        self.assertEqual((foo.a, foo.b, bar.c), (1, 2, 3))
+        self.assertEqual(rows[1][1], None)
+
+
+    def test_converter(self):
+        """
+        Values are converted with the converter for the kind of property.
+        """
+        class Double(Property):
+            pass
+        class Baz(object):
+            a = Double()
+            b = Property()
+        conv = Converter()
+        conv.when(Double)(lambda x: x * 2)
+        m = RowMaterializer(Query(Baz), conv)
+        baz = m([(2, 2)])[0]
+        self.assertEqual((baz.a, baz.b), (4, 2))
+
+
+    def test_subclass(self):
+        """
+        Properties inherited from a base class go on the subclass object.
+        """
+        class Sub(self.Foo):
+            d = Property()
+        m = RowMaterializer(Query(Sub), Converter())
+        sub = m([(1, 2, 3)])[0]
+        self.assertTrue(isinstance(sub, Sub))
+        self.assertEqual((sub.a, sub.b, sub.d), (1, 2, 3))
+
+
+
+    def test_project(self):
+        """
+        Properties left out of the query's projection aren't loaded.
+        """
+        m = RowMaterializer(Query(self.Foo, project=[self.Foo.b]),
+                            Converter())
+        foo = m([(2,)])[0]
+        self.assertEqual(foo.b, 2)
+        self.assertRaises(NotLoaded, getattr, foo, 'a')
+        self.assertEqual(m.names, ['b'])
+
+
+    def test_expressions(self):
+        """
+        Selected expressions are given as values.  Properties and
+        aggregates which keep their property's type are converted like the
+        property.
+        """
+        class Double(Property):
+            pass
+        class Baz(object):
+            a = Double()
+        conv = Converter()
+        conv.when(Double)(lambda x: x * 2)
+        m = RowMaterializer(Query((self.Foo, Baz.a, Max(Baz.a), Count())),
+                            conv)
+        foo, a, biggest, count = m([(1, 2, 3, 4, 5)])[0]
+        self.assertEqual((foo.a, foo.b), (1, 2))
+        self.assertEqual((a, biggest, count), (6, 8, 5))
+        self.assertEqual(m.names, ['Foo_a', 'Foo_b', 'Baz_a', 'max_a',
+                                   'count'])
+        self.assertEqual(m.plain([(1, 2, 3, 4, 5)], 'tuples'),
+                         [(1, 2, 6, 8, 5)])
+
+        m = RowMaterializer(Query(Count()), conv)
+        self.assertEqual(m([(3,)]), [3])
+
+
 class ConverterTest(TestCase):
 
 
@@ -4,10 +4,15 @@
 from twisted.trial.unittest import TestCase
 
 from datetime import date, datetime
+import threading
 
 from norm.orm.base import Property
 from norm.orm.expr import (Compiler, State, CompileError, Comparison,
                            Eq, Neq, And, Or, Join, Table, Lt, Lte, Gt, Gte,
+                           Query, LeftJoin, PlanCache, Asc, Desc,
+                           Count, Sum, Avg, Max, Min, Distinct,
+                           Update, Delete, In, NotIn, Like, Between,
+                           Exists, Subquery, simplify,
                            compiler as base_compiler)
 
 
@@ -53,6 +58,42 @@ class StateTest(TestCase):
         self.assertEqual(state.tableAlias(Bar), 'b')
         self.assertEqual(state.tableAlias(Foo), 'a')
         self.assertEqual(state.tableAlias(Bar), 'b')
+        self.assertEqual(state.classes, [Foo, Bar])
+
+
+    def test_tableAlias_many(self):
+        """
+        After z, aliases get longer: aa, ab, ..., az, ba, ...
+        """
+        state = State()
+        classes = [type('C%d' % i, (object,), {}) for i in xrange(26 * 27 + 1)]
+        aliases = [state.tableAlias(x) for x in classes]
+        self.assertEqual(aliases[:3], ['a', 'b', 'c'])
+        self.assertEqual(aliases[25:29], ['z', 'aa', 'ab', 'ac'])
+        self.assertEqual(aliases[51:53], ['az', 'ba'])
+        self.assertEqual(aliases[-2:], ['zz', 'aaa'])
+        self.assertEqual(len(set(aliases)), len(aliases))
+
+
+    def test_compileTouching(self):
+        """
+        You can find out which classes' tables something refers to when
+        it's compiled, even ones which were referred to before.
+        """
+        class Foo(object):
+            __sql_table__ = 'foo'
+            id = Property()
+        class Bar(object):
+            __sql_table__ = 'bar'
+            id = Property()
+
+        state = State()
+        state.compiler = base_compiler
+        state.tableAlias(Foo)
+        sql, args, touched = state.compileTouching(Eq(Bar.id, Foo.id))
+        self.assertEqual(sql, 'b.id = a.id')
+        self.assertEqual(touched, [Bar, Foo])
+        self.assertEqual(state.classes, [Foo, Bar])
 
 
 
@@ -173,6 +214,252 @@ class CompilerTest(TestCase):
 
 
 
+class QueryTest(TestCase):
+
+
+    class Foo(object):
+        __sql_table__ = 'foo'
+        id = Property(primary=True)
+        name = Property()
+        body = Property(deferred=True)
+
+
+    class Bar(object):
+        __sql_table__ = 'bar'
+        id = Property(primary=True)
+        foo_id = Property()
+
+
+    def test_properties(self):
+        """
+        By default, all the properties but deferred ones are selected.
+        """
+        query = Query((self.Foo, self.Bar))
+        self.assertEqual([x.attr_name for x in query.properties()],
+                         ['id', 'name', 'foo_id', 'id'])
+        self.assertEqual([x.attr_name
+                          for x in query.classProperties(self.Foo)],
+                         ['id', 'name'])
+
+
+    def test_project(self):
+        """
+        Only the primary key and projected properties are selected for a
+        class with properties in the projection.
+        """
+        Foo = self.Foo
+        query = Query((Foo, self.Bar), project=[Foo.body])
+        self.assertEqual([x.attr_name for x in query.classProperties(Foo)],
+                         ['body', 'id'])
+        self.assertEqual([x.attr_name
+                          for x in query.classProperties(self.Bar)],
+                         ['foo_id', 'id'])
+        sql, args = base_compiler.compile(query)
+        self.assertEqual(sql, 'SELECT a.body,a.id,b.foo_id,b.id '
+                              'FROM foo AS a,bar AS b')
+
+
+    def test_find(self):
+        """
+        The projection can be given to L{Query.find}.
+        """
+        query = Query(self.Foo).find(self.Foo, project=[self.Foo.name])
+        self.assertEqual([x.attr_name for x in query.properties()],
+                         ['id', 'name'])
+
+
+    def test_orderBy(self):
+        """
+        Results can be sorted by properties.
+        """
+        Foo = self.Foo
+        sql, args = base_compiler.compile(Query(Foo, order_by=Foo.name))
+        self.assertEqual(sql, 'SELECT a.id,a.name FROM foo AS a '
+                              'ORDER BY a.name')
+        sql, args = base_compiler.compile(Query(Foo,
+            order_by=[Desc(Foo.name), Asc(Foo.id)]))
+        self.assertEqual(sql, 'SELECT a.id,a.name FROM foo AS a '
+                              'ORDER BY a.name DESC,a.id ASC')
+
+
+    def test_limit(self):
+        """
+        The limit and offset are passed as arguments.
+        """
+        Foo = self.Foo
+        self.assertEqual(base_compiler.compile(Query(Foo, limit=10)),
+            ('SELECT a.id,a.name FROM foo AS a LIMIT ?', (10,)))
+        self.assertEqual(base_compiler.compile(Query(Foo, offset=5)),
+            ('SELECT a.id,a.name FROM foo AS a OFFSET ?', (5,)))
+        self.assertEqual(base_compiler.compile(Query(Foo, Foo.id > 2,
+                                                     order_by=Foo.id,
+                                                     limit=10, offset=5)),
+            ('SELECT a.id,a.name FROM foo AS a WHERE a.id > ? '
+             'ORDER BY a.id LIMIT ? OFFSET ?', (2, 10, 5)))
+
+
+    def test_after(self):
+        """
+        Keyset pagination constrains the results to those which sort after
+        the given values.
+        """
+        Foo = self.Foo
+        sql, args = base_compiler.compile(Query(Foo, order_by=Foo.id,
+                                                after=10, limit=5))
+        self.assertEqual(sql, 'SELECT a.id,a.name FROM foo AS a '
+                              'WHERE a.id > ? ORDER BY a.id LIMIT ?')
+        self.assertEqual(args, (10, 5))
+
+        sql, args = base_compiler.compile(Query(Foo, Foo.name != None,
+            order_by=[Desc(Foo.name), Foo.id], after=('joe', 10)))
+        self.assertEqual(sql, 'SELECT a.id,a.name FROM foo AS a '
+                              'WHERE (a.name IS NOT NULL AND '
+                              '(a.name <= ? AND '
+                              '((a.name < ?) OR (a.name = ? AND a.id > ?)))) '
+                              'ORDER BY a.name DESC,a.id')
+        self.assertEqual(args, ('joe', 'joe', 'joe', 10))
+
+
+    def test_after_object(self):
+        """
+        The keyset can be taken from the last object seen.
+        """
+        Foo = self.Foo
+        foo = Foo()
+        foo.id = 3
+        foo.name = 'joe'
+        query = Query(Foo, order_by=[Foo.name, Foo.id], after=foo)
+        self.assertEqual(query.after, ('joe', 3))
+
+
+    def test_after_expressions(self):
+        """
+        Keyset pagination works when expressions are selected.
+        """
+        Foo = self.Foo
+        query = Query((Foo.name, Count(Foo)), group_by=Foo.name,
+                      order_by=Foo.name, after='joe')
+        self.assertEqual(query.after, ('joe',))
+        self.assertEqual(base_compiler.compile(query),
+            ('SELECT a.name,COUNT(*) FROM foo AS a WHERE a.name > ? '
+             'GROUP BY a.name ORDER BY a.name', ('joe',)))
+
+        foo = Foo()
+        foo.id = 3
+        foo.name = 'joe'
+        query = Query((Foo, Foo.name), order_by=Foo.id, after=foo)
+        self.assertEqual(query.after, (3,))
+
+
+    def test_after_orderBy(self):
+        """
+        There must be an C{order_by} item for each C{after} value.
+        """
+        Foo = self.Foo
+        self.assertRaises(ValueError, Query, Foo, after=1)
+        self.assertRaises(ValueError, Query, Foo, order_by=Foo.id,
+                          after=(1, 2))
+
+
+    def test_aggregate(self):
+        """
+        Aggregates of expressions can be selected instead of classes.
+        """
+        Foo = self.Foo
+        query = Query((Foo.name, Count(Foo), Count(Distinct(Foo.body)),
+                       Sum(Foo.id), Avg(Foo.id), Max(Foo.id), Min(Foo.id)))
+        self.assertEqual(query.classes(), [])
+        self.assertEqual(len(query.columns()), 7)
+        self.assertEqual(base_compiler.compile(query),
+            ('SELECT a.name,COUNT(*),COUNT(DISTINCT a.body),SUM(a.id),'
+             'AVG(a.id),MAX(a.id),MIN(a.id) FROM foo AS a', ()))
+
+
+    def test_groupBy(self):
+        """
+        Rows can be grouped, and the groups constrained.
+        """
+        Foo = self.Foo
+        Bar = self.Bar
+        query = Query((Foo, Count(Bar.id)), Foo.id == Bar.foo_id,
+                      group_by=[Foo.id, Foo.name], having=Count(Bar.id) > 2,
+                      order_by=Desc(Count(Bar.id)))
+        self.assertEqual(base_compiler.compile(query),
+            ('SELECT a.id,a.name,COUNT(b.id) FROM foo AS a,bar AS b '
+             'WHERE a.id = b.foo_id GROUP BY a.id,a.name '
+             'HAVING COUNT(b.id) > ? ORDER BY COUNT(b.id) DESC', (2,)))
+
+
+    def test_columnName(self):
+        """
+        Aggregates are named after their function and property.
+        """
+        self.assertEqual(Count().columnName(), 'count')
+        self.assertEqual(Count(self.Foo).columnName(), 'count')
+        self.assertEqual(Sum(self.Foo.id).columnName(), 'sum_id')
+        self.assertEqual(Count(Distinct(self.Foo.id)).columnName(),
+                         'count_id')
+
+
+class UpdateDeleteTest(TestCase):
+
+
+    class Foo(object):
+        __sql_table__ = 'foo'
+        id = Property(primary=True)
+        name = Property()
+        other = Property()
+
+
+    class Bar(object):
+        __sql_table__ = 'bar'
+        id = Property(primary=True)
+        foo_id = Property()
+
+
+    def test_update(self):
+        """
+        Rows of a class' table can be updated, with columns qualified by the
+        table name.
+        """
+        Foo = self.Foo
+        self.assertEqual(base_compiler.compile(Update(Foo, Foo.id > 2,
+                [(Foo.name, 'joe'), (Foo.other, None)])),
+            ('UPDATE foo SET name=?,other=NULL WHERE foo.id > ?',
+             ('joe', 2)))
+        self.assertEqual(base_compiler.compile(Update(Foo, None,
+                [(Foo.name, Foo.other)])),
+            ('UPDATE foo SET name=foo.other', ()))
+
+
+    def test_delete(self):
+        """
+        Rows of a class' table can be deleted.
+        """
+        Foo = self.Foo
+        self.assertEqual(base_compiler.compile(Delete(Foo, Foo.name == 'a')),
+                         ('DELETE FROM foo WHERE foo.name = ?', ('a',)))
+        self.assertEqual(base_compiler.compile(Delete(Foo)),
+                         ('DELETE FROM foo', ()))
+
+
+    def test_otherClasses(self):
+        """
+        Constraints on other classes are checked with an EXISTS subquery.
+        """
+        Foo = self.Foo
+        Bar = self.Bar
+        self.assertEqual(base_compiler.compile(Delete(Foo,
+                And(Foo.id == Bar.foo_id, Bar.id == 3))),
+            ('DELETE FROM foo WHERE EXISTS (SELECT 1 FROM bar AS a WHERE '
+             '(foo.id = a.foo_id AND a.id = ?))', (3,)))
+        self.assertEqual(base_compiler.compile(Update(Foo,
+                Foo.id == Bar.foo_id, [(Foo.name, 'x')])),
+            ('UPDATE foo SET name=? WHERE EXISTS (SELECT 1 FROM bar AS a '
+             'WHERE foo.id = a.foo_id)', ('x',)))
+
+
+
 class compilerTest(TestCase):
     """
     I test the global, default compiler
@@ -291,4 +578,542 @@ class compilerTest(TestCase):
         self.assertEqual(sql, 'foo AS a')
 
 
+    def test_In(self):
+        self.assertEqual(base_compiler.compile(In('a', [1, 2, None])),
+                         ('? IN (?,?,NULL)', ('a', 1, 2)))
+        self.assertEqual(base_compiler.compile(In('a', [])), ('1 = 0', ()))
+
+
+    def test_NotIn(self):
+        self.assertEqual(base_compiler.compile(NotIn('a', (1, 2))),
+                         ('? NOT IN (?,?)', ('a', 1, 2)))
+        self.assertEqual(base_compiler.compile(NotIn('a', [])),
+                         ('1 = 1', ()))
+
+
+    def test_Like(self):
+        self.assertEqual(base_compiler.compile(Like('a', 'b%')),
+                         ('? LIKE ?', ('a', 'b%')))
+
+
+    def test_Between(self):
+        self.assertEqual(base_compiler.compile(Between('a', 1, 2)),
+                         ('? BETWEEN ? AND ?', ('a', 1, 2)))
+
+
+
+class CompileScalingTest(TestCase):
+
+
+    def compileCounting(self, joiner, count):
+        """
+        Compile a C{joiner} of C{count} terms, counting how many times each
+        term is compiled and how many times its arguments are copied.
+
+        @return: A tuple of the number of compilations and copies.
+        """
+        counts = {'compiled': 0, 'copied': 0}
+
+        class Args(tuple):
+
+            def __iter__(self):
+                counts['copied'] += len(self)
+                return tuple.__iter__(self)
+
+            def __add__(self, other):
+                counts['copied'] += len(self) + len(other)
+                return Args(tuple.__add__(self, other))
+
+            def __radd__(self, other):
+                counts['copied'] += len(self) + len(other)
+                return Args(tuple.__add__(tuple(other), self))
+
+        class Term(object):
+
+            def __init__(self, value):
+                self.value = value
+
+        compiler = Compiler([base_compiler])
+
+        @compiler.when(Term)
+        def compile_Term(x, state):
+            counts['compiled'] += 1
+            return '?', Args((x.value,))
+
+        sql, args = compiler.compile(joiner(*[Term(i)
+                                              for i in xrange(count)]))
+        self.assertEqual(args, tuple(xrange(count)))
+        return counts['compiled'], counts['copied']
+
+
+    def test_linear(self):
+        """
+        Compiling an C{And} or C{Or} compiles each term once and copies each
+        term's arguments once, so it takes time in proportion to the number
+        of terms (when the args were added up tuple by tuple, the copies grew
+        with the square of the number of terms).
+        """
+        for joiner in [And, Or]:
+            for count in [10, 100, 1000, 10000]:
+                self.assertEqual(self.compileCounting(joiner, count),
+                                 (count, count))
+
+
+
+class SubqueryTest(TestCase):
+
 
+    class Parent(object):
+        __sql_table__ = 'parent'
+        id = Property(primary=True)
+        name = Property()
+
+
+    class Child(object):
+        __sql_table__ = 'child'
+        id = Property(primary=True)
+        parent_id = Property()
+
+
+    def test_In(self):
+        """
+        An expression can be compared with the results of a query.
+        """
+        Parent = self.Parent
+        Child = self.Child
+        query = Query(Parent.name, In(Parent.id, Query(Child.parent_id,
+                                                       Child.id > 2)))
+        self.assertEqual(base_compiler.compile(query),
+            ('SELECT a.name FROM parent AS a WHERE a.id IN '
+             '(SELECT b.parent_id FROM child AS b WHERE b.id > ?)', (2,)))
+
+
+    def test_Exists(self):
+        """
+        Classes of the enclosing query are correlated with it.
+        """
+        Parent = self.Parent
+        Child = self.Child
+        query = Query(Parent.name, Parent.name == 'a',
+                      Exists(Query(Child.id, Child.parent_id == Parent.id)))
+        self.assertEqual(base_compiler.compile(query),
+            ('SELECT a.name FROM parent AS a WHERE (a.name = ? AND EXISTS '
+             '(SELECT b.id FROM child AS b WHERE b.parent_id = a.id))',
+             ('a',)))
+
+
+    def test_join(self):
+        """
+        A join in a subquery is put in the subquery's FROM, even if it also
+        refers to a class of the enclosing query.
+        """
+        Parent = self.Parent
+        Child = self.Child
+
+        class Toy(object):
+            __sql_table__ = 'toy'
+            id = Property(primary=True)
+            parent_id = Property()
+            child_id = Property()
+
+        query = Query(Parent.name, Exists(Query(Child.id,
+            Child.parent_id == Parent.id,
+            joins=[Join(Toy, And(Toy.parent_id == Parent.id,
+                                 Toy.child_id == Child.id))])))
+        self.assertEqual(base_compiler.compile(query),
+            ('SELECT a.name FROM parent AS a WHERE EXISTS '
+             '(SELECT b.id FROM child AS b JOIN toy AS c '
+             'ON (c.parent_id = a.id AND c.child_id = b.id) '
+             'WHERE b.parent_id = a.id)', ()))
+
+        query = Query(Parent.name, Exists(Query(Child.id,
+            Child.parent_id == Parent.id,
+            joins=[Join(Toy, Toy.parent_id == Parent.id)])))
+        self.assertRaises(CompileError, base_compiler.compile, query)
+
+
+    def test_comparison(self):
+        """
+        A subquery can be compared like a property.
+        """
+        Parent = self.Parent
+        Child = self.Child
+        count = Subquery(Query(Count(Child), Child.parent_id == Parent.id))
+        query = Query(Parent.name, count > 2)
+        self.assertEqual(base_compiler.compile(query),
+            ('SELECT a.name FROM parent AS a WHERE (SELECT COUNT(*) FROM '
+             'child AS b WHERE b.parent_id = a.id) > ?', (2,)))
+
+
+    def test_selectedClass(self):
+        """
+        A subquery selecting a class of the enclosing query has it in its own
+        C{FROM}.
+        """
+        Parent = self.Parent
+        query = Query(Parent.name, In(Parent.id, Query(Parent.id,
+                                                       Parent.name == 'a')))
+        self.assertEqual(base_compiler.compile(query),
+            ('SELECT a.name FROM parent AS a WHERE a.id IN '
+             '(SELECT a.id FROM parent AS a WHERE a.name = ?)', ('a',)))
+
+
+    def test_delete(self):
+        """
+        The table being changed is correlated with subqueries.
+        """
+        Parent = self.Parent
+        Child = self.Child
+        self.assertEqual(base_compiler.compile(Delete(Parent,
+                Exists(Query(Child.id, Child.parent_id == Parent.id)))),
+            ('DELETE FROM parent WHERE EXISTS (SELECT a.id FROM child AS a '
+             'WHERE a.parent_id = parent.id)', ()))
+
+
+
+class PlanCacheTest(TestCase):
+
+
+    class Parent(object):
+        __sql_table__ = 'parent'
+        id = Property(primary=True)
+        name = Property()
+
+
+    class Child(object):
+        __sql_table__ = 'child'
+        id = Property(primary=True)
+        parent_id = Property()
+        name = Property()
+
+
+    def assertSame(self, cache, query):
+        """
+        The cache should compile to the same thing as the compiler.
+        """
+        self.assertEqual(cache.compile(query), base_compiler.compile(query))
+
+
+    def test_compile(self):
+        """
+        The first time a query is compiled, it's compiled by the compiler.
+        """
+        cache = PlanCache(base_compiler)
+        self.assertSame(cache, Query(self.Parent, self.Parent.name == 'joe'))
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 0)
+
+
+    def test_sameShape(self):
+        """
+        Queries which only differ by their literal values share a plan.
+        """
+        Parent = self.Parent
+        cache = PlanCache(base_compiler)
+        cache.compile(Query(Parent, Parent.name == 'joe', Parent.id > 2))
+        self.assertSame(cache, Query(Parent, Parent.name == 'bob',
+                                     Parent.id > 0))
+        self.assertSame(cache, Query(Parent, Parent.name == '',
+                                     Parent.id > 10))
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 2)
+
+
+    def test_differentShape(self):
+        """
+        Queries of different shapes get different plans.
+        """
+        Parent = self.Parent
+        Child = self.Child
+        cache = PlanCache(base_compiler)
+        queries = [
+            Query(Parent),
+            Query(Child),
+            Query((Parent, Child)),
+            Query(Parent, Parent.name == 'joe'),
+            Query(Parent, Parent.name == None),
+            Query(Parent, Parent.name != 'joe'),
+            Query(Parent, Parent.id == 1),
+            Query(Parent, Parent.id == True),
+            Query(Parent, Parent.id == Child.parent_id),
+            Query(Parent, Or(Parent.name == 'joe', Parent.name == 'bob')),
+            Query(Parent, Parent.name == 'joe', Parent.name == 'bob'),
+            Query(Parent, order_by=Parent.name),
+            Query(Parent, order_by=Desc(Parent.name)),
+            Query(Parent, limit=10),
+            Query(Parent, order_by=Parent.id, after=2),
+            Query(Count(Parent)),
+            Query((Parent.name, Count(Parent)), group_by=Parent.name),
+            Query(Parent, In(Parent.id, [1])),
+            Query(Parent, In(Parent.id, [1, 2])),
+            Query(Parent, NotIn(Parent.id, [1, 2])),
+            Query(Parent, In(Parent.id, Query(Child.parent_id))),
+        ]
+        for query in queries:
+            self.assertSame(cache, query)
+        self.assertEqual(cache.misses, len(queries))
+        for query in queries:
+            self.assertSame(cache, query)
+        self.assertEqual(cache.hits, len(queries))
+
+
+    def test_limit(self):
+        """
+        Queries which only differ by their limit, offset and keyset share a
+        plan.
+        """
+        Parent = self.Parent
+        cache = PlanCache(base_compiler)
+        cache.compile(Query(Parent, order_by=Parent.id, after=1, limit=2,
+                            offset=3))
+        self.assertSame(cache, Query(Parent, order_by=Parent.id, after=7,
+                                     limit=8, offset=9))
+        self.assertEqual(cache.hits, 1)
+
+
+    def test_listArgs(self):
+        """
+        A list of values bound to one placeholder has its values replaced
+        too.
+        """
+        Parent = self.Parent
+        compiler = Compiler([base_compiler])
+
+        @compiler.when(In)
+        def compile_In(x, state):
+            expr, args = state.compile(x.expr)
+            values = []
+            for value in x.values:
+                values.extend(state.compile(value)[1])
+            return '%s = ANY(?)' % (expr,), args + (values,)
+
+        cache = PlanCache(compiler)
+        cache.compile(Query(Parent.id, In(Parent.id, [1, 2])))
+        self.assertEqual(cache.compile(Query(Parent.id, In(Parent.id, [3, 4]))),
+                         ('SELECT a.id FROM parent AS a WHERE a.id = ANY(?)',
+                          ([3, 4],)))
+        self.assertEqual(cache.hits, 1)
+
+
+    def test_joinArgs(self):
+        """
+        Arguments are put in the right order even when joins and constraints
+        are rearranged by the compiler.
+        """
+        Parent = self.Parent
+        Child = self.Child
+        cache = PlanCache(base_compiler)
+
+        def query(a, b, c):
+            return Query((Parent, Child), Parent.name == a,
+                         joins=[LeftJoin(Child, And(Child.parent_id == Parent.id,
+                                                    Child.name == b,
+                                                    Child.id > c))])
+        cache.compile(query('a', 'b', 1))
+        self.assertSame(cache, query('x', 'y', 2))
+        sql, args = cache.compile(query('x', 'y', 2))
+        self.assertEqual(args, ('y', 2, 'x'))
+        self.assertEqual(cache.hits, 2)
+
+
+    def test_lru(self):
+        """
+        Only the most recently used plans are kept.
+        """
+        Parent = self.Parent
+        cache = PlanCache(base_compiler, size=2)
+        q1 = Query(Parent, Parent.id == 1)
+        q2 = Query(Parent, Parent.name == 'a')
+        q3 = Query(Parent, Parent.name == None)
+
+        cache.compile(q1)
+        cache.compile(q2)
+        cache.compile(q1)
+        cache.compile(q3)
+        self.assertEqual(cache.misses, 3)
+
+        cache.compile(q1)
+        self.assertEqual(cache.hits, 2, "q1 should still be cached")
+        cache.compile(q2)
+        self.assertEqual(cache.misses, 4, "q2 should have been forgotten")
+
+
+    def test_threads(self):
+        """
+        Several threads can compile with the same cache at once.
+        """
+        Parent = self.Parent
+        cache = PlanCache(base_compiler, 16)
+        queries = [Query(Parent, And(*[Parent.id == i for i in xrange(n)]))
+                   for n in xrange(1, 41)]
+        errors = []
+        def work():
+            try:
+                for i in xrange(10):
+                    for query in queries:
+                        cache.compile(query)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=work) for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(cache._plans), 16)
+        self.assertEqual(cache.hits + cache.misses, 8 * 10 * 40)
+        for query in queries:
+            self.assertSame(cache, query)
+
+
+    def test_clear(self):
+        """
+        You can forget all the plans.
+        """
+        cache = PlanCache(base_compiler)
+        query = Query(self.Parent)
+        cache.compile(query)
+        cache.clear()
+        cache.compile(query)
+        self.assertEqual(cache.misses, 2)
+
+
+    def test_uncacheable(self):
+        """
+        Things the cache doesn't understand are compiled every time.
+        """
+        compiler = Compiler([base_compiler])
+
+        @compiler.when(dict)
+        def compile_dict(x, state):
+            return 'dict', ()
+
+        cache = PlanCache(compiler)
+        self.assertEqual(cache.compile({}), ('dict', ()))
+        self.assertEqual(cache.compile({}), ('dict', ()))
+        self.assertEqual(cache.hits, 0)
+
+
+
+class SimplifyTest(TestCase):
+
+
+    class Foo(object):
+        __sql_table__ = 'foo'
+        id = Property(primary=True)
+        name = Property()
+
+
+    def assertCompiles(self, expr, sql, args):
+        self.assertEqual(base_compiler.compile(expr, State()), (sql, args))
+
+
+    def test_literal(self):
+        """
+        Things which aren't an L{And} or L{Or} are left alone.
+        """
+        eq = self.Foo.id == 1
+        self.assertIdentical(simplify(eq), eq)
+        self.assertEqual(simplify(None), None)
+
+
+    def test_flatten(self):
+        """
+        An L{And} in an L{And} (or L{Or} in an L{Or}) is flattened.
+        """
+        Foo = self.Foo
+        expr = simplify(And(Foo.id > 1, And(Foo.id < 5, Foo.name == 'a')))
+        self.assertEqual(type(expr), And)
+        self.assertEqual(len(expr.items), 3)
+        self.assertCompiles(expr, '(a.id > ? AND a.id < ? AND a.name = ?)',
+                            (1, 5, 'a'))
+
+        expr = simplify(Or(Foo.id > 1, Or(Foo.id < 5, Foo.name == 'a')))
+        self.assertCompiles(expr, '(a.id > ? OR a.id < ? OR a.name = ?)',
+                            (1, 5, 'a'))
+
+
+    def test_mixed(self):
+        """
+        An L{Or} in an L{And} is kept.
+        """
+        Foo = self.Foo
+        expr = simplify(And(Foo.id > 1, Or(Foo.id < 5, Foo.name > 'a')))
+        self.assertCompiles(expr, '(a.id > ? AND (a.id < ? OR a.name > ?))',
+                            (1, 5, 'a'))
+
+
+    def test_single(self):
+        """
+        An L{And} or L{Or} of one thing is the thing, and an empty L{And}
+        is C{None}.
+        """
+        eq = self.Foo.id == 1
+        self.assertIdentical(simplify(And(eq)), eq)
+        self.assertIdentical(simplify(Or(And(eq))), eq)
+        self.assertEqual(simplify(And()), None)
+        self.assertEqual(simplify(And(And(), And())), None)
+
+
+    def test_repeated(self):
+        """
+        Items which are repeated are only included once.
+        """
+        Foo = self.Foo
+        expr = simplify(And(Foo.id > 1, Foo.name == 'a', Foo.id > 1))
+        self.assertCompiles(expr, '(a.id > ? AND a.name = ?)', (1, 'a'))
+
+        expr = simplify(And(Foo.id > 1, Foo.id > 2))
+        self.assertCompiles(expr, '(a.id > ? AND a.id > ?)', (1, 2))
+
+
+    def test_orEqualities(self):
+        """
+        Equalities of the same thing with literal values in an L{Or} are
+        combined into an L{In}.
+        """
+        Foo = self.Foo
+        expr = simplify(Or(Foo.id == 1, Foo.name == 'a', Foo.id == 2,
+                           Foo.id == 1))
+        self.assertCompiles(expr, '(a.id IN (?,?) OR a.name = ?)',
+                            (1, 2, 'a'))
+
+        expr = simplify(Or(Foo.id == 1, Foo.id == 1))
+        self.assertEqual(type(expr), Eq)
+        self.assertCompiles(expr, 'a.id = ?', (1,))
+
+
+    def test_orEqualitiesNotLiteral(self):
+        """
+        Equalities with things that aren't literal values are left alone.
+        """
+        Foo = self.Foo
+        expr = simplify(Or(Foo.id == Foo.name, Foo.id == 2))
+        self.assertCompiles(expr, '(a.id = a.name OR a.id = ?)', (2,))
+
+
+    def test_query(self):
+        """
+        A L{Query}'s constraints are simplified.
+        """
+        Foo = self.Foo
+        sql, args = base_compiler.compile(Query(Foo, Foo.id == 1,
+                                                Or(Foo.name == 'a',
+                                                   Foo.name == 'b')))
+        self.assertEqual(sql, 'SELECT a.id,a.name FROM foo AS a '
+                              'WHERE (a.id = ? AND a.name IN (?,?))')
+        self.assertEqual(args, (1, 'a', 'b'))
+
+
+    def test_planShared(self):
+        """
+        Queries which simplify to the same shape share a plan.
+        """
+        Foo = self.Foo
+        cache = PlanCache(base_compiler)
+        cache.compile(Query(Foo, And(Foo.id > 1, Foo.name == 'a')))
+        self.assertEqual(cache.compile(Query(Foo, Foo.id > 2,
+                                             Foo.name == 'b')),
+            ('SELECT a.id,a.name FROM foo AS a '
+             'WHERE (a.id > ? AND a.name = ?)', (2, 'b')))
+        self.assertEqual(cache.hits, 1)
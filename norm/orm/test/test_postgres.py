@@ -7,7 +7,11 @@ from twisted.internet import defer
 from norm.patch import Patcher
 from norm.porcelain import makePool
 from norm.postgres import PostgresOperator
-from norm.orm.test.mixin import FunctionalIOperatorTestsMixin
+from norm.orm.test.mixin import FunctionalIOperatorTestsMixin, Empty
+from norm.orm.expr import Query, In, NotIn
+from norm.orm.base import objectInfo
+
+from mock import MagicMock
 from norm.test.util import skip_postgres, postgres_url
 
 
@@ -77,3 +81,132 @@ class PostgresFunctionalOperatorTest(FunctionalIOperatorTestsMixin, TestCase):
         yield self.patcher.upgrade(pool)
         defer.returnValue(pool)
 
+
+    @defer.inlineCallbacks
+    def test_insertMany_copy(self):
+        """
+        Without refreshing, rows are loaded with COPY.
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+
+        def interaction(cursor):
+            cursor = MagicMock(wraps=cursor)
+            objs = []
+            for i in xrange(3):
+                e = Empty()
+                e.name = str(i)
+                objs.append(e)
+            d = oper.insertMany(cursor, objs, refresh=False)
+            return d.addCallback(lambda _: cursor.copyFrom.call_count)
+
+        called = yield pool.runInteraction(interaction)
+        self.assertEqual(called, 1)
+        rows = yield pool.runInteraction(oper.query, Query(Empty))
+        self.assertEqual(sorted([x.name for x in rows]), ['0', '1', '2'])
+
+
+
+
+class PostgresOperatorTest(TestCase):
+
+
+    def test_updateMany(self):
+        """
+        Objects of the same class with the same changed attributes are
+        updated by one statement, whose rows get the types of the table's
+        columns from an empty SELECT.
+        """
+        objs = []
+        for i in xrange(3):
+            e = Empty()
+            e.id = i
+            objectInfo(e).resetChangedList()
+            e.name = str(i)
+            objs.append(e)
+        objs[2].uni = u'x'
+        cursor = MagicMock()
+        cursor.execute.side_effect = lambda *args: defer.succeed(None)
+
+        oper = PostgresOperator()
+        oper.update_chunk_size = 2
+        oper.updateMany(cursor, objs)
+        statements = [x for x, kw in cursor.execute.call_args_list]
+        self.assertEqual(statements[0], (
+            'UPDATE empty SET name=norm_v.name FROM (SELECT id,name '
+            'FROM empty WHERE false UNION ALL VALUES (?,?),(?,?)) AS norm_v '
+            'WHERE empty.id=norm_v.id',
+            (0, buffer('0'), 1, buffer('1'))))
+        self.assertEqual(statements[1], (
+            'UPDATE empty SET name=norm_v.name,uni=norm_v.uni FROM (SELECT '
+            'id,name,uni FROM empty WHERE false UNION ALL VALUES (?,?,?)) '
+            'AS norm_v WHERE empty.id=norm_v.id',
+            (2, buffer('2'), u'x')))
+        self.assertEqual(len(statements), 2)
+
+
+    def test_updateMany_primaryOnly(self):
+        """
+        Objects whose only changes are to the primary key are updated one at
+        a time, like L{PostgresOperator.update} would, rather than dropped.
+        """
+        e = Empty()
+        e.id = 1
+        cursor = MagicMock()
+        cursor.execute.side_effect = lambda *args: defer.succeed(None)
+
+        oper = PostgresOperator()
+        oper.updateMany(cursor, [e])
+        statements = [x for x, kw in cursor.execute.call_args_list]
+        self.assertEqual(statements, [
+            ('UPDATE empty SET id=? WHERE id=?', (1, 1)),
+        ])
+
+
+    def test_In(self):
+        """
+        A list of values is bound to a single array parameter, so the SQL is
+        the same however many values there are.
+        """
+        oper = PostgresOperator()
+        sql, args = oper.plans.compile(Query(Empty.id,
+                                             In(Empty.name, ['a', 'b'])))
+        self.assertEqual(sql, 'SELECT a.id FROM empty AS a '
+                              'WHERE a.name = ANY(?)')
+        self.assertEqual(oper._queryArgs(args),
+                         ([buffer('a'), buffer('b')],))
+        sql2, args = oper.plans.compile(Query(Empty.id,
+                                              In(Empty.name, ['c'])))
+        self.assertEqual(sql2, sql)
+        self.assertEqual(args, (['c'],))
+
+        sql, args = oper.plans.compile(Query(Empty.id,
+                                             NotIn(Empty.id, [1, 2])))
+        self.assertEqual(sql, 'SELECT a.id FROM empty AS a '
+                              'WHERE a.id != ALL(?)')
+        self.assertEqual(args, ([1, 2],))
+
+        sql, args = oper.plans.compile(Query(Empty.id,
+                                             In(Empty.id, [1, Empty.id])))
+        self.assertEqual(sql, 'SELECT a.id FROM empty AS a '
+                              'WHERE a.id IN (?,a.id)')
+
+
+    def test_In_plans(self):
+        """
+        Queries with lists of values of any length share a plan.
+        """
+        oper = PostgresOperator()
+        for values in [[1], [1, 2], [1, 2, 3], range(10), range(100)]:
+            sql, args = oper.plans.compile(Query(Empty.id,
+                                                 In(Empty.id, values),
+                                                 Empty.name == 'a'))
+            self.assertEqual(sql, 'SELECT a.id FROM empty AS a '
+                                  'WHERE (a.id = ANY(?) AND a.name = ?)')
+            self.assertEqual(args, (list(values), 'a'))
+        self.assertEqual(oper.plans.misses, 1)
+        self.assertEqual(oper.plans.hits, 4)
+
+        # lists with things that aren't literal values aren't shared
+        oper.plans.compile(Query(Empty.id, In(Empty.id, [1, Empty.id])))
+        self.assertEqual(oper.plans.misses, 2)
@@ -4,11 +4,13 @@
 from twisted.trial.unittest import TestCase
 from twisted.internet import defer
 
+from mock import MagicMock
 
 from norm.patch import Patcher
 from norm.porcelain import makePool
 from norm.sqlite import SqliteOperator
-from norm.orm.test.mixin import FunctionalIOperatorTestsMixin
+from norm.orm.test.mixin import FunctionalIOperatorTestsMixin, Child
+from norm.orm.expr import Query
 
 
 
@@ -64,3 +66,65 @@ class SqliteFunctionalOperatorTest(FunctionalIOperatorTestsMixin, TestCase):
         yield self.patcher.upgrade(pool)
         defer.returnValue(pool)
 
+
+    @defer.inlineCallbacks
+    def test_insertMany_chunks(self):
+        """
+        Inserts are split up so as not to use too many variables in a single
+        statement.
+        """
+        oper = yield self.getOperator()
+        oper.max_variables = 5
+        pool = yield self.getPool()
+
+        objs = [Child(u'child %d' % (i,)) for i in xrange(7)]
+        for i, child in enumerate(objs):
+            child.parent_id = i
+        yield pool.runInteraction(oper.insertMany, objs)
+
+        self.assertEqual([x.id for x in objs], range(1, 8))
+        rows = yield pool.runInteraction(oper.query, Query(Child))
+        self.assertEqual(sorted([(x.id, x.name, x.parent_id) for x in rows]),
+                         [(x.id, x.name, x.parent_id) for x in objs])
+
+
+    @defer.inlineCallbacks
+    def test_insertMany_maxRows(self):
+        """
+        Inserts are also split up so as not to have too many rows in a single
+        statement, whatever the number of variables.
+        """
+        oper = yield self.getOperator()
+        oper.max_rows = 2
+        cursor = MagicMock()
+        cursor.execute.side_effect = lambda *args: defer.succeed(None)
+
+        objs = [Child(u'child %d' % (i,)) for i in xrange(5)]
+        yield oper.insertMany(cursor, objs, refresh=False)
+        statements = [x[0] for x, kw in cursor.execute.call_args_list]
+        self.assertEqual(statements, [
+            'INSERT INTO child (name) VALUES (?),(?)',
+            'INSERT INTO child (name) VALUES (?),(?)',
+            'INSERT INTO child (name) VALUES (?)',
+        ])
+
+
+    @defer.inlineCallbacks
+    def test_insertMany_rowids(self):
+        """
+        Objects are refreshed from the rows that were inserted for them even
+        when SQLite doesn't give those rows consecutive rowids (as happens
+        once the largest rowid has been used).
+        """
+        oper = yield self.getOperator()
+        pool = yield self.getPool()
+        yield pool.runOperation('INSERT INTO child (id, name) VALUES (?, ?)',
+                                (2 ** 63 - 1, u'last'))
+
+        objs = [Child(u'child %d' % (i,)) for i in xrange(5)]
+        yield pool.runInteraction(oper.insertMany, objs)
+
+        rows = yield pool.runInteraction(oper.query,
+            Query(Child, Child.name != u'last'))
+        self.assertEqual(sorted([(x.id, x.name) for x in rows]),
+                         sorted([(x.id, x.name) for x in objs]))
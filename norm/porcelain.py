@@ -5,49 +5,108 @@ __all__ = ['makePool', 'insert']
 
 
 
+from collections import OrderedDict
+from functools import partial
 from twisted.internet import defer
-from norm.common import BlockingRunner, BlockingCursor, ConnectionPool
+from norm.common import BlockingRunner, ConnectionPool, ThreadedRunner
 from norm.uri import parseURI, mkConnStr
+from norm.orm.base import IdentityMap, Relation, classInfo, objectInfo
 from norm.orm.expr import Query
 
 
 
-def _makeSqlite(parsed):
+def _makeSqlite(parsed, connections=1, threaded=False, pool_options=None):
     from norm.sqlite import sqlite
     connstr = mkConnStr(parsed)
-    db = sqlite.connect(connstr)
-    db.row_factory = sqlite.Row
-    runner = BlockingRunner(db)
-    runner.db_scheme = 'sqlite'
-    return defer.succeed(runner)
+
+    def connect():
+        db = sqlite.connect(connstr)
+        db.row_factory = sqlite.Row
+        return db
+
+    if not threaded:
+        runner = BlockingRunner(connect())
+        runner.db_scheme = 'sqlite'
+        return defer.succeed(runner)
+
+    if connstr == ':memory:' and connections != 1:
+        raise ValueError('Each connection to an in-memory SQLite database '
+                         'gets its own database; use connections=1')
+    pool = ConnectionPool(**(pool_options or {}))
+    pool.db_scheme = 'sqlite'
+    if connstr != ':memory:':
+        pool.setConnect(ThreadedRunner, connect)
+    for i in xrange(connections):
+        pool.add(ThreadedRunner(connect))
+    return defer.succeed(pool)
+
+
+
+def _postgresCursor(cursor, statements=None):
+    from norm.postgres import PostgresCursorWrapper, BlockingPostgresCursor
+    return PostgresCursorWrapper(BlockingPostgresCursor(cursor), statements)
 
 
 
 class PostgresRunner(BlockingRunner):
+    """
+    @ivar statements: An optional L{StatementCache} for my connection.
+    """
+
+
+    statements = None
 
 
     def cursorFactory(self, cursor):
-        from norm.postgres import PostgresCursorWrapper
-        return PostgresCursorWrapper(BlockingCursor(cursor))
+        return _postgresCursor(cursor, self.statements)
+
+
+
+class ThreadedPostgresRunner(ThreadedRunner):
+    """
+    @ivar statements: An optional L{StatementCache} for my connection.
+    """
 
 
+    statements = None
 
-def _makePostgres(parsed, connections=1):
+
+    def cursorFactory(self, cursor):
+        return _postgresCursor(cursor, self.statements)
+
+
+
+def _statementCache(prepare):
+    if not prepare:
+        return None
+    from norm.postgres import StatementCache
+    return StatementCache()
+
+
+def _makePostgres(parsed, connections=1, threaded=False, prepare=False,
+                  pool_options=None):
+    if threaded:
+        return _makeThreadedPostgres(parsed, connections, prepare,
+                                     pool_options)
     try:
-        return _makeTxPostgres(parsed, connections)
+        return _makeTxPostgres(parsed, connections, prepare, pool_options)
     except ImportError:
-        return _makeBlockingPostgres(parsed, connections)
+        return _makeBlockingPostgres(parsed, connections, prepare,
+                                     pool_options)
 
 
-def _makeBlockingPostgres(parsed, connections=1):    
+def _makeBlockingPostgres(parsed, connections=1, prepare=False,
+                          pool_options=None):
     import psycopg2
     from psycopg2.extras import DictCursor
     connstr = mkConnStr(parsed)
 
     def connect():
-        return PostgresRunner(psycopg2.connect(connstr,
-                                               cursor_factory=DictCursor))
-    pool = ConnectionPool()
+        runner = PostgresRunner(psycopg2.connect(connstr,
+                                                 cursor_factory=DictCursor))
+        runner.statements = _statementCache(prepare)
+        return runner
+    pool = ConnectionPool(**(pool_options or {}))
     pool.db_scheme = 'postgres'
     pool.setConnect(connect)
 
@@ -56,16 +115,38 @@ def _makeBlockingPostgres(parsed, connections=1):
     return defer.succeed(pool)
 
 
-def _makeTxPostgres(parsed, connections=1):
+def _makeThreadedPostgres(parsed, connections=1, prepare=False,
+                          pool_options=None):
+    import psycopg2
+    from psycopg2.extras import DictCursor
+    connstr = mkConnStr(parsed)
+
+    def connect():
+        runner = ThreadedPostgresRunner(partial(psycopg2.connect, connstr,
+                                                cursor_factory=DictCursor))
+        runner.statements = _statementCache(prepare)
+        return runner
+    pool = ConnectionPool(**(pool_options or {}))
+    pool.db_scheme = 'postgres'
+    pool.setConnect(connect)
+
+    for i in xrange(connections):
+        pool.add(connect())
+    return defer.succeed(pool)
+
+
+def _makeTxPostgres(parsed, connections=1, prepare=False,
+                    pool_options=None):
     from norm.tx_postgres import DictConnection
     connstr = mkConnStr(parsed)
 
     def connect():
         conn = DictConnection()
+        conn.statements = _statementCache(prepare)
         d = conn.connect(connstr)
         return d.addCallback(lambda _: conn)
 
-    pool = ConnectionPool()
+    pool = ConnectionPool(**(pool_options or {}))
     pool.db_scheme = 'postgres'
     pool.setConnect(connect)
 
@@ -79,12 +160,36 @@ def _makeTxPostgres(parsed, connections=1):
 
 
 
-def makePool(uri, connections=1):
+def makePool(uri, connections=1, threaded=False, prepare=False,
+             **pool_options):
+    """
+    Make a connection pool for the database at C{uri}.
+
+    @param connections: Number of connections to make.  This is ignored for
+        SQLite unless C{threaded} is C{True}.
+    @param threaded: If C{True}, each connection is pinned to its own worker
+        thread and interactions are run in that thread instead of blocking
+        the reactor.
+    @param prepare: If C{True}, frequently executed statements are prepared
+        on each Postgres connection (see L{norm.postgres.StatementCache}).
+        This is ignored for SQLite, which caches statements itself.
+    @param pool_options: Other keyword arguments are given to the
+        L{ConnectionPool} to let it grow, shrink and check its connections
+        (C{min_size}, C{max_size}, C{idle_timeout}, C{max_lifetime},
+        C{check_interval}, C{check_timeout}) and to report how it's used
+        (C{sink}).
+        C{min_size} defaults to C{connections}.  These are ignored for
+        SQLite unless C{threaded} is C{True}.
+
+    @return: A C{Deferred} which fires with an L{IRunner}.
+    """
+    pool_options.setdefault('min_size', connections)
     parsed = parseURI(uri)
     if parsed['scheme'] == 'sqlite':
-        return _makeSqlite(parsed)
+        return _makeSqlite(parsed, connections, threaded, pool_options)
     elif parsed['scheme'] == 'postgres':
-        return _makePostgres(parsed, connections)
+        return _makePostgres(parsed, connections, threaded, prepare,
+                             pool_options)
     else:
         raise Exception('%s is not supported' % (parsed['scheme'],))
 
@@ -103,40 +208,261 @@ def insert(runner, qry, params=()):
 
 
 
+def _loaded(result, identity_map, query):
+    """
+    Replace objects in the result of a query with the ones in an
+    L{IdentityMap}.
+    """
+    if identity_map is None:
+        return result
+    classes = tuple(query.classes())
+    def load(x):
+        if isinstance(x, classes):
+            return identity_map.load(x)
+        return x
+    ret = []
+    for item in result:
+        if type(item) is list:
+            ret.append([load(x) for x in item])
+        else:
+            ret.append(load(item))
+    return ret
+
+
+def _added(result, identity_map):
+    """
+    Add the object(s) in C{result} to an L{IdentityMap}.
+    """
+    if identity_map is not None:
+        if type(result) is list:
+            for obj in result:
+                identity_map.add(obj)
+        else:
+            identity_map.add(result)
+    return result
+
+
+def _removed(result, obj, identity_map):
+    if identity_map is not None:
+        identity_map.remove(obj)
+    return result
+
+
+def _forgotten(result, cls, identity_map):
+    """
+    Forget the objects of a class in an L{IdentityMap} after rows of its
+    table were changed without going through them.
+    """
+    if identity_map is not None:
+        identity_map.clear(cls)
+    return result
+
+
+def _identityFunc(func, identity_map, query):
+    return lambda batch: func(_loaded(batch, identity_map, query))
+
+
+def _getQuery(cls, pk):
+    primary_key = classInfo(cls).primary_key
+    if len(primary_key) != len(pk):
+        raise TypeError('%r has %d primary key columns, but %d values were '
+                        'given' % (cls, len(primary_key), len(pk)))
+    return Query(cls, *[prop == value for prop, value in zip(primary_key, pk)])
+
+
+def _first(result):
+    if result:
+        return result[0]
+    return None
+
+
+def _toLoad(obj, props):
+    """
+    Get the properties of C{obj} that L{ORMHandle.load} should load.
+    """
+    if props:
+        return props
+    return objectInfo(obj).notLoaded()
+
+
+@defer.inlineCallbacks
+def _loadAttributes(cursor, operator, obj, props):
+    """
+    Load the properties and L{Relation}s of C{obj} for L{ORMHandle.load}.
+    """
+    relations = [x for x in props if isinstance(x, Relation)]
+    props = [x for x in props if not isinstance(x, Relation)]
+    if props or not relations:
+        props = _toLoad(obj, props)
+        if props:
+            yield operator.refresh(cursor, obj, props)
+    for relation in relations:
+        yield operator.loadRelated(cursor, [obj], relation)
+    defer.returnValue(obj)
+
+
+def _loadedObject(obj, identity_map):
+    if identity_map is not None:
+        return identity_map.load(obj)
+    return obj
+
+
+
 class ORMHandle(object):
     """
     I am a nicer interface for ORMing
+
+    @ivar identity_map: An optional L{IdentityMap} used for everything done
+        through me, so that each row is represented by a single object.
+    @ivar transaction_identity: If C{True} (and there's no C{identity_map})
+        each transaction gets its own L{IdentityMap}.
+    @ivar unit_of_work: If C{True}, objects updated in a transaction (see
+        L{transact}) are collected and updated together, with as few
+        statements as possible, before anything else is done in the
+        transaction and at its end.
     """
 
 
-    def __init__(self, pool, operator):
+    def __init__(self, pool, operator, identity_map=None,
+                 transaction_identity=False, unit_of_work=False):
         self.pool = pool
         self.operator = operator
+        self.identity_map = identity_map
+        self.transaction_identity = transaction_identity
+        self.unit_of_work = unit_of_work
 
 
     def insert(self, obj):
-        return self.pool.runInteraction(self.operator.insert, obj)
+        d = self.pool.runInteraction(self.operator.insert, obj)
+        return d.addCallback(_added, self.identity_map)
+
+
+    def insertMany(self, objs, refresh=True):
+        d = self.pool.runInteraction(self.operator.insertMany, objs,
+                                     refresh)
+        if refresh:
+            d.addCallback(_added, self.identity_map)
+        return d
 
 
     def update(self, obj):
         return self.pool.runInteraction(self.operator.update, obj)
 
 
+    def updateMany(self, objs):
+        return self.pool.runInteraction(self.operator.updateMany, objs)
+
+
     def refresh(self, obj):
         return self.pool.runInteraction(self.operator.refresh, obj)
 
 
+    def load(self, obj, *props):
+        """
+        Load properties of an object which weren't loaded by the query that
+        found it (because they're deferred or were left out of the query's
+        projection), or its L{Relation}s.
+
+        @param props: The L{Property}s and L{Relation}s to load.  If none are
+            given, all the object's unloaded properties are loaded.
+
+        @return: A C{Deferred} which fires with C{obj}.
+        """
+        d = self.pool.runInteraction(_loadAttributes, self.operator, obj,
+                                     props)
+        return d.addCallback(_loadedObject, self.identity_map)
+
+
     def delete(self, obj):
-        return self.pool.runInteraction(self.operator.delete, obj)
+        d = self.pool.runInteraction(self.operator.delete, obj)
+        return d.addCallback(_removed, obj, self.identity_map)
 
 
-    def query(self, query):
-        return self.pool.runInteraction(self.operator.query, query)
+    def updateWhere(self, cls, constraints, **values):
+        """
+        Update all the rows of C{cls}' table which match C{constraints} with
+        a single statement.  Objects already loaded aren't changed, but
+        they're forgotten by my L{IdentityMap} so they'll be loaded again.
+
+        @param values: The new value for each attribute to change.
+
+        @return: A C{Deferred} which fires with the number of rows updated.
+        """
+        d = self.pool.runInteraction(self.operator.updateWhere, cls,
+                                     constraints, values)
+        return d.addCallback(_forgotten, cls, self.identity_map)
+
+
+    def deleteWhere(self, cls, constraints):
+        """
+        Delete all the rows of C{cls}' table which match C{constraints} with
+        a single statement.
+
+        @return: A C{Deferred} which fires with the number of rows deleted.
+        """
+        d = self.pool.runInteraction(self.operator.deleteWhere, cls,
+                                     constraints)
+        return d.addCallback(_forgotten, cls, self.identity_map)
+
+
+    def query(self, query, as_=None):
+        """
+        Query for objects.
+
+        @param as_: If given, get plain values instead of objects (see
+            L{IOperator.query}).
+        """
+        d = self.pool.runInteraction(self.operator.query, query, as_)
+        if as_ is None:
+            d.addCallback(_loaded, self.identity_map, query)
+        return d
 
 
     def find(self, *args, **kwargs):
-        return self.pool.runInteraction(self.operator.query,
-                                        Query(*args, **kwargs))
+        as_ = kwargs.pop('as_', None)
+        return self.query(Query(*args, **kwargs), as_)
+
+
+    def count(self, query):
+        """
+        Count the rows a query would return.  The counting is done by the
+        database.
+
+        @return: A C{Deferred} which fires with the number of rows.
+        """
+        return self.pool.runInteraction(self.operator.count, query)
+
+
+    def get(self, cls, *pk):
+        """
+        Get the object of class C{cls} with the given primary key values.
+        If I have an L{IdentityMap} which already has the object, the
+        database isn't queried.
+
+        @return: A C{Deferred} firing with the object, or C{None} if there
+            isn't one.
+        """
+        if self.identity_map is not None:
+            obj = self.identity_map.get(cls, *pk)
+            if obj is not None:
+                return defer.succeed(obj)
+        d = self.query(_getQuery(cls, pk))
+        return d.addCallback(_first)
+
+
+    def iterate(self, query, func, batch_size=1000):
+        """
+        Query for objects, giving them to C{func} in lists of at most
+        C{batch_size} objects, without loading all of them at once.  If
+        C{func} returns a C{Deferred}, the next batch waits for it.
+
+        With a threaded pool C{func} is called in the database thread, so it
+        should not return a C{Deferred} that depends on the reactor.
+        """
+        if self.identity_map is not None:
+            func = _identityFunc(func, self.identity_map, query)
+        return self.pool.runInteraction(self.operator.iterate, query, func,
+                                        batch_size)
 
 
     def transact(self, func, *args, **kwargs):
@@ -144,48 +470,162 @@ class ORMHandle(object):
 
 
     def _transact(self, cursor, func, *args, **kwargs):
-        inner_handle = _InTransactionORMHandle(cursor, self.operator)
-        return func(inner_handle, *args, **kwargs)
+        identity_map = self.identity_map
+        if identity_map is None and self.transaction_identity:
+            identity_map = IdentityMap()
+        inner_handle = _InTransactionORMHandle(cursor, self.operator,
+                                               identity_map,
+                                               self.unit_of_work)
+        if not self.unit_of_work:
+            return func(inner_handle, *args, **kwargs)
+        d = defer.maybeDeferred(func, inner_handle, *args, **kwargs)
+        return d.addCallback(self._flushTransaction, inner_handle)
+
+
+    def _flushTransaction(self, result, inner_handle):
+        d = inner_handle.flush()
+        return d.addCallback(lambda _: result)
 
 
 
 class _InTransactionORMHandle(object):
     """
     I am a nice interface
+
+    @ivar unit_of_work: If C{True}, objects given to L{update} aren't
+        updated right away.  They're updated together (see
+        L{IOperator.updateMany}) by L{flush}, which is done before anything
+        else is done through me and at the end of the transaction.
     """
 
 
-    def __init__(self, cursor, operator):
+    def __init__(self, cursor, operator, identity_map=None,
+                 unit_of_work=False):
         self.operator = operator
         self.cursor = cursor
+        self.identity_map = identity_map
+        self.unit_of_work = unit_of_work
+        self._dirty = OrderedDict()
+
+
+    def _flushed(self, func, *args):
+        """
+        Call an operator method with my cursor once any pending updates are
+        flushed.
+        """
+        if not self._dirty:
+            return func(self.cursor, *args)
+        d = self.flush()
+        return d.addCallback(lambda _: func(self.cursor, *args))
+
+
+    def flush(self):
+        """
+        Update the objects given to L{update} since the last flush.
+        """
+        objs = self._dirty.values()
+        self._dirty.clear()
+        if not objs:
+            return defer.succeed([])
+        return self.operator.updateMany(self.cursor, objs)
 
 
     def insert(self, obj):
-        return self.operator.insert(self.cursor, obj)
+        d = self._flushed(self.operator.insert, obj)
+        return d.addCallback(_added, self.identity_map)
+
+
+    def insertMany(self, objs, refresh=True):
+        d = self._flushed(self.operator.insertMany, objs, refresh)
+        if refresh:
+            d.addCallback(_added, self.identity_map)
+        return d
 
 
     def update(self, obj):
+        if self.unit_of_work:
+            self._dirty[id(obj)] = obj
+            return defer.succeed(None)
         return self.operator.update(self.cursor, obj)
 
 
+    def updateMany(self, objs):
+        if self.unit_of_work:
+            for obj in objs:
+                self._dirty[id(obj)] = obj
+            return defer.succeed(objs)
+        return self.operator.updateMany(self.cursor, objs)
+
+
     def delete(self, obj):
-        return self.operator.delete(self.cursor, obj)
+        self._dirty.pop(id(obj), None)
+        d = self._flushed(self.operator.delete, obj)
+        return d.addCallback(_removed, obj, self.identity_map)
+
+
+    def updateWhere(self, cls, constraints, **values):
+        d = self._flushed(self.operator.updateWhere, cls, constraints, values)
+        return d.addCallback(_forgotten, cls, self.identity_map)
 
 
-    def query(self, query):
-        return self.operator.query(self.cursor, query)
+    def deleteWhere(self, cls, constraints):
+        d = self._flushed(self.operator.deleteWhere, cls, constraints)
+        return d.addCallback(_forgotten, cls, self.identity_map)
+
+
+    def query(self, query, as_=None):
+        d = self._flushed(self.operator.query, query, as_)
+        if as_ is None:
+            d.addCallback(_loaded, self.identity_map, query)
+        return d
 
 
     def find(self, *args, **kwargs):
-        return self.operator.query(self.cursor, Query(*args, **kwargs))
+        as_ = kwargs.pop('as_', None)
+        return self.query(Query(*args, **kwargs), as_)
+
+
+    def count(self, query):
+        return self._flushed(self.operator.count, query)
+
+
+    def get(self, cls, *pk):
+        if self.identity_map is not None:
+            obj = self.identity_map.get(cls, *pk)
+            if obj is not None:
+                return defer.succeed(obj)
+        d = self.query(_getQuery(cls, pk))
+        return d.addCallback(_first)
+
+
+    def iterate(self, query, func, batch_size=1000):
+        if self.identity_map is not None:
+            func = _identityFunc(func, self.identity_map, query)
+        return self._flushed(self.operator.iterate, query, func, batch_size)
 
 
     def refresh(self, obj):
-        return self.operator.refresh(self.cursor, obj)
+        return self._flushed(self.operator.refresh, obj)
 
 
+    def load(self, obj, *props):
+        d = self._flushed(_loadAttributes, self.operator, obj, props)
+        return d.addCallback(_loadedObject, self.identity_map)
 
-def ormHandle(pool):
+
+
+def ormHandle(pool, identity_map=None, transaction_identity=False,
+              unit_of_work=False):
+    """
+    Make an L{ORMHandle} for a pool made by L{makePool}.
+
+    @param identity_map: An L{IdentityMap} to use for everything done with
+        the handle.
+    @param transaction_identity: If C{True} (and no C{identity_map} is
+        given) each transaction gets its own L{IdentityMap}.
+    @param unit_of_work: If C{True}, updates done in a transaction are
+        batched until the end of it (or until something else is done).
+    """
     operator = None
     if pool.db_scheme == 'sqlite':
         from norm.sqlite import SqliteOperator
@@ -193,7 +633,5 @@ def ormHandle(pool):
     elif pool.db_scheme == 'postgres':
         from norm.postgres import PostgresOperator
         operator = PostgresOperator()
-    return ORMHandle(pool, operator)
-
-
-
+    return ORMHandle(pool, operator, identity_map, transaction_identity,
+                     unit_of_work)
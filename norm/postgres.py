@@ -2,11 +2,22 @@
 # See LICENSE for details.
 
 from zope.interface import implements
+from twisted.internet import defer
 
 from norm.interface import IAsyncCursor
-from norm.orm.base import (classInfo, objectInfo, Converter, BaseOperator)
-from norm.orm.props import String, Unicode
-from norm.orm.expr import compiler, Compiler
+from norm.common import BlockingCursor
+from norm.orm.base import (classInfo, objectInfo, Converter, BaseOperator,
+                           _chunks)
+from norm.orm.props import String, Unicode, Bool
+from norm.orm.expr import compiler, Compiler, In, Query, _Param
+
+from collections import OrderedDict
+from cStringIO import StringIO
+from datetime import date, datetime
+from itertools import count
+
+
+_cursor_names = count()
 
 
 def translateSQL(sql):
@@ -15,28 +26,177 @@ def translateSQL(sql):
 
 
 
+def numberParams(sql):
+    """
+    Replace the C{%s} placeholders in some (translated) SQL with the
+    C{$1}, C{$2}, ... placeholders used by C{PREPARE}.
+    """
+    parts = sql.split('%s')
+    ret = [parts[0]]
+    for i, part in enumerate(parts[1:]):
+        ret.append('$%d' % (i+1,))
+        ret.append(part)
+    return ''.join(ret)
+
+
+
+class StatementCache(object):
+    """
+    I prepare statements which are executed frequently on a single
+    connection, and execute them with C{EXECUTE} from then on, so that
+    Postgres doesn't have to parse and plan them every time.
+
+    Only C{SELECT}, C{INSERT}, C{UPDATE} and C{DELETE} statements with
+    parameters are prepared.  C{PREPARE} is done within a C{SAVEPOINT}, so
+    if it fails (for instance because the type of a parameter can't be
+    inferred) the transaction isn't aborted: the statement is executed as
+    usual and won't be prepared again.
+
+    @ivar size: The most statements to keep prepared.  When there are more,
+        the least recently used one is C{DEALLOCATE}d.
+    @ivar threshold: How many times a statement must be executed before it's
+        prepared.
+    """
+
+    prepared_commands = ('select', 'insert', 'update', 'delete')
+
+
+    def __init__(self, size=100, threshold=2):
+        self.size = size
+        self.threshold = threshold
+        self._prepared = OrderedDict()
+        self._counts = {}
+        self._names = count()
+
+
+    def execute(self, execute, sql, params=()):
+        """
+        Execute some SQL, preparing it if it's been used enough.
+
+        @param execute: A function which executes SQL (with C{%s}
+            placeholders) and parameters on my connection, returning a
+            C{Deferred}.
+        """
+        if not self._preparable(sql, params):
+            return execute(sql, params)
+        name = self._prepared.pop(sql, None)
+        if name is not None:
+            self._prepared[sql] = name
+            return execute(self._executeSQL(name, params), params)
+        uses = self._counts.get(sql, 0)
+        if uses is None:
+            # it couldn't be prepared
+            return execute(sql, params)
+        uses += 1
+        if uses < self.threshold:
+            if len(self._counts) >= self.size * 10:
+                self._counts.clear()
+            self._counts[sql] = uses
+            return execute(sql, params)
+        return self._prepare(execute, sql, params)
+
+
+    def _preparable(self, sql, params):
+        if not params or '%%' in sql or sql.count('%s') != len(params):
+            return False
+        command = sql.lstrip()[:6].lower()
+        return command in self.prepared_commands
+
+
+    def _executeSQL(self, name, params):
+        return 'EXECUTE %s (%s)' % (name, ','.join(['%s'] * len(params)))
+
+
+    def _prepare(self, execute, sql, params):
+        name = 'norm_stmt_%d' % (self._names.next(),)
+        d = defer.succeed(None)
+        if len(self._prepared) >= self.size:
+            old_sql, old_name = self._prepared.popitem(last=False)
+            d.addCallback(lambda _: execute('DEALLOCATE %s' % (old_name,), ()))
+        # Outside a transaction there's nothing for a failed PREPARE to abort
+        # and SAVEPOINT fails, in which case PREPARE is done without one.
+        d.addCallback(lambda _: execute('SAVEPOINT norm_prepare', ()))
+        d.addCallbacks(lambda _: True, lambda _: False)
+        d.addCallback(self._prepareInSavepoint, execute, sql, params, name)
+        return d
+
+
+    def _prepareInSavepoint(self, savepoint, execute, sql, params, name):
+        d = execute('PREPARE %s AS %s' % (name, numberParams(sql)), ())
+        d.addCallbacks(self._didPrepare, self._prepareFailed,
+                       callbackArgs=(savepoint, execute, sql, params, name),
+                       errbackArgs=(savepoint, execute, sql, params))
+        return d
+
+
+    def _didPrepare(self, result, savepoint, execute, sql, params, name):
+        self._counts.pop(sql, None)
+        self._prepared[sql] = name
+        d = defer.succeed(None)
+        if savepoint:
+            d.addCallback(lambda _: execute('RELEASE SAVEPOINT norm_prepare',
+                                            ()))
+        return d.addCallback(lambda _: execute(self._executeSQL(name, params),
+                                               params))
+
+
+    def _prepareFailed(self, err, savepoint, execute, sql, params):
+        self._counts[sql] = None
+        d = defer.succeed(None)
+        if savepoint:
+            d.addCallback(lambda _: execute(
+                'ROLLBACK TO SAVEPOINT norm_prepare', ()))
+            d.addCallback(lambda _: execute('RELEASE SAVEPOINT norm_prepare',
+                                            ()))
+        return d.addCallback(lambda _: execute(sql, params))
+
+
+    def prepared(self):
+        """
+        Get the list of SQL statements currently prepared, least recently
+        used first.
+        """
+        return list(self._prepared)
+
+
+
 class PostgresCursorWrapper(object):
 
 
     implements(IAsyncCursor)
 
 
-    def __init__(self, cursor):
+    def __init__(self, cursor, statements=None):
+        """
+        @param statements: An optional L{StatementCache} for the connection
+            C{cursor} belongs to.
+        """
         self.cursor = cursor
+        self.statements = statements
 
 
     def execute(self, sql, params=()):
         sql = translateSQL(sql)
+        if self.statements is not None:
+            return self.statements.execute(self.cursor.execute, sql, params)
         ret = self.cursor.execute(sql, params)
         return ret
 
 
+    def executemany(self, sql, param_list):
+        return self.cursor.executemany(translateSQL(sql), param_list)
+
+
     def lastRowId(self):
         d = self.cursor.execute('select lastval()')
         d.addCallback(lambda _: self.cursor.fetchone())
         return d.addCallback(lambda row: row[0])
 
 
+    def rowCount(self):
+        return self.cursor.rowCount()
+
+
     def fetchone(self):
         return self.cursor.fetchone()
 
@@ -45,11 +205,100 @@ class PostgresCursorWrapper(object):
         return self.cursor.fetchall()
 
 
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+
+    def stream(self, sql, params, func, size=1000):
+        return self.cursor.stream(translateSQL(sql), params, func, size)
+
+
+    def copyFrom(self, table, columns, rows):
+        """
+        Load rows into a table with C{COPY ... FROM STDIN}.  This is only
+        possible if the wrapped cursor is a L{BlockingPostgresCursor}.
+        """
+        return self.cursor.copyFrom(table, columns, rows)
+
+
     def close(self):
         return self.cursor.close()
 
 
 
+def _copyValue(value):
+    """
+    Format a database-ready value for COPY's text format.
+    """
+    if value is None:
+        return '\\N'
+    elif type(value) is bool:
+        return value and 't' or 'f'
+    elif type(value) is buffer:
+        # bytea hex format, with COPY's escaping of the backslash
+        return '\\\\x' + str(value).encode('hex')
+    elif type(value) is unicode:
+        value = value.encode('utf-8')
+    elif isinstance(value, (date, datetime)):
+        value = value.isoformat()
+    else:
+        value = str(value)
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def copyData(rows):
+    """
+    Format rows of database-ready values as the data for
+    C{COPY ... FROM STDIN}.
+    """
+    return ''.join(['\t'.join(map(_copyValue, row)) + '\n' for row in rows])
+
+
+
+class BlockingPostgresCursor(BlockingCursor):
+    """
+    I am a L{BlockingCursor} for a psycopg2 cursor, and I can also do COPY.
+    """
+
+
+    def executemany(self, sql, param_list):
+        """
+        Execute C{sql} for each set of params, sending them to the database
+        in pages of several statements (with psycopg2's C{execute_batch} if
+        it's new enough to have it) instead of one statement at a time.
+        """
+        try:
+            from psycopg2.extras import execute_batch
+        except ImportError:
+            return BlockingCursor.executemany(self, sql, param_list)
+        return defer.maybeDeferred(execute_batch, self.cursor, sql,
+                                   param_list)
+
+
+    @defer.inlineCallbacks
+    def stream(self, sql, params, func, size=1000):
+        """
+        Execute C{sql} with a named (server-side) psycopg2 cursor, so that
+        only C{size} rows at a time are sent from the database.
+
+        This must be run inside a transaction (which any interaction is).
+        """
+        name = 'norm_stream_%d' % (_cursor_names.next(),)
+        named = self.cursor.connection.cursor(name)
+        try:
+            yield BlockingCursor(named).stream(sql, params, func, size)
+        finally:
+            named.close()
+
+
+    def copyFrom(self, table, columns, rows):
+        sql = 'COPY %s (%s) FROM STDIN' % (table, ','.join(columns))
+        return defer.maybeDeferred(self.cursor.copy_expert, sql,
+                                   StringIO(copyData(rows)))
+
+
+
 toDB = Converter()
 
 @toDB.when(str)
@@ -59,6 +308,10 @@ def stringToDB(pythonval):
         return None
     return buffer(pythonval)
 
+@toDB.when(list)
+def listToDB(pythonval):
+    return [toDB.convert(type(x), x) for x in pythonval]
+
 
 fromDB = Converter()
 
@@ -80,8 +333,37 @@ def unicodeToString(dbval):
         return str(dbval).decode('utf-8')
     return dbval
 
+@fromDB.when(Bool)
+def toBool(dbval):
+    if dbval is None:
+        return None
+    return bool(dbval)
+
 
 postgres_compiler = Compiler([compiler])
+postgres_compiler.binds_lists = True
+
+
+@postgres_compiler.when(In)
+def compile_In(x, state):
+    """
+    Compare with a list of values bound to a single array parameter, so
+    that the SQL is the same however many values there are.
+    """
+    if type(x.values) is _Param:
+        # the whole list is a parameter of a plan (see PlanCache)
+        expr, args = state.compile(x.expr)
+        return '%s %s(?)' % (expr, x.array_op), args + (x.values,)
+    if isinstance(x.values, Query) or not x.values:
+        return compiler.compile(x, state)
+    values = []
+    for value in x.values:
+        sql, args = state.compile(value)
+        if sql != '?':
+            return compiler.compile(x, state)
+        values.extend(args)
+    expr, args = state.compile(x.expr)
+    return '%s %s(?)' % (expr, x.array_op), args + (values,)
 
 
 
@@ -124,7 +406,7 @@ class PostgresOperator(BaseOperator):
 
 
         # returning
-        columns = cls_info.columns.keys()
+        columns = cls_info.column_names
         returning = ['RETURNING %s' % (','.join(columns),)]
 
         sql = ' '.join(insert + returning)
@@ -136,4 +418,106 @@ class PostgresOperator(BaseOperator):
         return d
 
 
+    insert_chunk_size = 1000
+    update_chunk_size = 1000
+
 
+    def insertMany(self, cursor, objs, refresh=True):
+        """
+        Insert several objects into the database.  Objects of the same class
+        with the same changed attributes are inserted by multi-row INSERTs
+        (of at most C{insert_chunk_size} rows each) which return the inserted
+        rows.
+
+        If C{refresh} is C{False} and the cursor can do it, the rows are
+        loaded with C{COPY} instead, and the objects are left as they are.
+        """
+        objs = list(objs)
+        copy = getattr(cursor, 'copyFrom', None)
+        d = defer.succeed(None)
+        for info, props, group in self._insertGroups(objs):
+            if not props:
+                for obj in group:
+                    d.addCallback(lambda _, obj=obj: self.insert(cursor, obj))
+            elif not refresh and copy is not None:
+                d.addCallback(lambda _, info=info, props=props, group=group:
+                              copy(info.table,
+                                   [x.column_name for x in props],
+                                   [self._insertValues(obj, props)
+                                    for obj in group]))
+            else:
+                for chunk in _chunks(group, self.insert_chunk_size):
+                    d.addCallback(lambda _, info=info, props=props, chunk=chunk:
+                                  self._insertChunk(cursor, info, props, chunk,
+                                                    refresh))
+        return d.addCallback(lambda _: objs)
+
+
+    def _insertChunk(self, cursor, info, props, objs, refresh):
+        row = '(%s)' % (','.join(['?'] * len(props)),)
+        insert = 'INSERT INTO %s (%s) VALUES %s' % (info.table,
+                    ','.join([x.column_name for x in props]),
+                    ','.join([row] * len(objs)))
+        insert_args = []
+        for obj in objs:
+            insert_args.extend(self._insertValues(obj, props))
+
+        if not refresh:
+            return cursor.execute(insert, tuple(insert_args))
+
+        returning = 'RETURNING %s' % (','.join(info.column_names),)
+        d = cursor.execute(' '.join([insert, returning]), tuple(insert_args))
+        d.addCallback(lambda _: cursor.fetchall())
+        d.addCallback(self._updateObjects, objs)
+        return d
+
+
+    def updateMany(self, cursor, objs):
+        """
+        Update several objects in the database.  Objects of the same class
+        with the same changed attributes are updated by a single
+        C{UPDATE ... FROM} a list of rows (of at most C{update_chunk_size}
+        rows each).  Objects whose only changes are to primary key
+        attributes are updated one at a time with L{update}.
+        """
+        objs = list(objs)
+        d = defer.succeed(None)
+        for info, props, group in self._insertGroups(objs):
+            if not props:
+                continue
+            elif (not info.primary_key
+                  or not [x for x in props if not x.primary]):
+                # Without a primary key to find rows by, or with nothing but
+                # the primary key to set, there's no row list to join on.
+                for obj in group:
+                    d.addCallback(lambda _, obj=obj: self.update(cursor, obj))
+                continue
+            for chunk in _chunks(group, self.update_chunk_size):
+                d.addCallback(lambda _, info=info, props=props, chunk=chunk:
+                              self._updateChunk(cursor, info, props, chunk))
+        return d.addCallback(lambda _: objs)
+
+
+    def _updateChunk(self, cursor, info, props, objs):
+        keys = list(info.primary_key)
+        props = keys + [x for x in props if not x.primary]
+        columns = [x.column_name for x in props]
+        # The rows are given the types of the table's columns by the empty
+        # SELECT they're a UNION with.
+        row = '(%s)' % (','.join(['?'] * len(props)),)
+        update = ('UPDATE %(table)s SET %(set)s FROM (SELECT %(columns)s '
+                  'FROM %(table)s WHERE false UNION ALL VALUES %(rows)s) '
+                  'AS norm_v WHERE %(where)s') % {
+            'table': info.table,
+            'set': ','.join(['%s=norm_v.%s' % (x, x)
+                             for x in columns[len(keys):]]),
+            'columns': ','.join(columns),
+            'rows': ','.join([row] * len(objs)),
+            'where': ' AND '.join(['%s.%s=norm_v.%s' % (info.table,
+                                   x.column_name, x.column_name)
+                                   for x in keys]),
+        }
+        args = []
+        for obj in objs:
+            args.extend(self._insertValues(obj, props))
+        return cursor.execute(update, tuple(args))
@@ -4,11 +4,13 @@
 __all__ = ['sqlite']
 
 from zope.interface import implements
+from twisted.internet import defer
 
 from norm.interface import IAsyncCursor, IOperator
-from norm.orm.base import (classInfo, objectInfo, Converter, BaseOperator)
-from norm.orm.props import String, Date, DateTime
-from norm.orm.expr import compiler, Compiler
+from norm.orm.base import (classInfo, objectInfo, Converter, BaseOperator,
+                           _chunks)
+from norm.orm.props import String, Date, DateTime, Bool
+from norm.orm.expr import compiler, Compiler, Limit
 
 from datetime import datetime
 
@@ -39,6 +41,10 @@ class SqliteCursorWrapper(object):
         return self.cursor.execute(*args, **kwargs)
 
 
+    def executemany(self, *args, **kwargs):
+        return self.cursor.executemany(*args, **kwargs)
+
+
     def fetchone(self):
         return self.cursor.fetchone()
 
@@ -47,10 +53,22 @@ class SqliteCursorWrapper(object):
         return self.cursor.fetchall()
 
 
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+
+    def stream(self, *args, **kwargs):
+        return self.cursor.stream(*args, **kwargs)
+
+
     def lastRowId(self):
         return self.cursor.lastRowId()
 
 
+    def rowCount(self):
+        return self.cursor.rowCount()
+
+
     def close(self):
         return self.cursor.close()
 
@@ -77,6 +95,13 @@ def toString(dbval):
     return dbval
 
 
+@fromDB.when(Bool)
+def toBool(dbval):
+    if dbval is None:
+        return None
+    return bool(dbval)
+
+
 @fromDB.when(DateTime)
 def toDateTime(dbval):
     if type(dbval) is unicode:
@@ -95,6 +120,16 @@ def toDate(dbval):
 sqlite_compiler = Compiler([compiler])
 
 
+@sqlite_compiler.when(Limit)
+def compile_Limit(x, state):
+    """
+    SQLite only allows an OFFSET after a LIMIT (where a negative limit means
+    no limit).
+    """
+    if x.limit is None:
+        x = Limit(-1, x.offset)
+    return compiler.compile(x, state)
+
 
 
 class SqliteOperator(BaseOperator):
@@ -137,7 +172,7 @@ class SqliteOperator(BaseOperator):
 
 
         # select
-        columns = cls_info.columns.keys()
+        columns = cls_info.column_names
         select = 'SELECT %s FROM %s WHERE rowid=?' % (','.join(columns),
                   cls_info.table)
 
@@ -149,4 +184,79 @@ class SqliteOperator(BaseOperator):
         return d
 
 
+    max_variables = 999
+    max_rows = 500
+
+
+    def insertMany(self, cursor, objs, refresh=True):
+        """
+        Insert several objects into the database.  Objects of the same class
+        with the same changed attributes are inserted by multi-row INSERTs
+        (of at most C{max_variables} values and C{max_rows} rows each).
+
+        The rows of one INSERT aren't promised consecutive rowids, so when
+        refreshing objects whose primary key isn't given each row is
+        inserted alone to learn its rowid.  The objects are then updated
+        from a single SELECT of those rowids.
+        """
+        objs = list(objs)
+        d = defer.succeed(None)
+        for info, props, group in self._insertGroups(objs):
+            if not props:
+                for obj in group:
+                    d.addCallback(lambda _, obj=obj: self.insert(cursor, obj))
+                continue
+            size = max(1, min(self.max_rows,
+                              self.max_variables // len(props)))
+            for chunk in _chunks(group, size):
+                d.addCallback(lambda _, info=info, props=props, chunk=chunk:
+                              self._insertChunk(cursor, info, props, chunk,
+                                                refresh))
+        return d.addCallback(lambda _: objs)
+
+
+    def _insertChunk(self, cursor, info, props, objs, refresh):
+        row = '(%s)' % (','.join(['?'] * len(props)),)
+        insert = 'INSERT INTO %s (%s) VALUES ' % (info.table,
+                    ','.join([x.column_name for x in props]))
+        names = set([x.attr_name for x in props])
+        given = [x for x in info.primary_key if x.attr_name in names]
+
+        if refresh and not given:
+            rowids = []
+            d = defer.succeed(None)
+            for obj in objs:
+                d.addCallback(lambda _, obj=obj: cursor.execute(insert + row,
+                              tuple(self._insertValues(obj, props))))
+                d.addCallback(lambda _: cursor.lastRowId())
+                d.addCallback(rowids.append)
+            select = ('SELECT rowid AS norm_rowid,%s FROM %s '
+                      'WHERE rowid IN (%s)') % (
+                      ','.join(info.column_names), info.table,
+                      ','.join(['?'] * len(objs)))
+            d.addCallback(lambda _: cursor.execute(select, tuple(rowids)))
+            d.addCallback(lambda _: cursor.fetchall())
+            d.addCallback(self._inRowidOrder, rowids)
+            d.addCallback(self._updateObjects, objs)
+            return d
+
+        insert_args = []
+        for obj in objs:
+            insert_args.extend(self._insertValues(obj, props))
+        d = cursor.execute(insert + ','.join([row] * len(objs)),
+                           tuple(insert_args))
+        if refresh:
+            for obj in objs:
+                d.addCallback(lambda _, obj=obj: self.refresh(cursor, obj))
+        return d
+
+
+    def _inRowidOrder(self, rows, rowids):
+        """
+        Put rows selected with their C{norm_rowid} in the order of
+        C{rowids}.
+        """
+        by_rowid = dict([(x['norm_rowid'], x) for x in rows])
+        return [by_rowid[x] for x in rowids if x in by_rowid]
+
 
@@ -2,15 +2,17 @@
 # See LICENSE for details.
 
 from twisted.trial.unittest import TestCase
-from twisted.internet import defer
+from twisted.internet import defer, task
 from zope.interface.verify import verifyObject
 
+from twisted.python import threadable
 from mock import MagicMock, create_autospec
 import sqlite3
 
 from norm.interface import IAsyncCursor, IRunner, IPool
+from norm.error import Error
 from norm.common import (BlockingCursor, BlockingRunner, ConnectionPool,
-                         NextAvailablePool)
+                         NextAvailablePool, ThreadedRunner, PoolMetrics)
 
 
 
@@ -40,6 +42,24 @@ class BlockingCursorTest(TestCase):
         return d
 
 
+    def test_executemany(self):
+        """
+        You can execute a query for each of several sets of params.
+        """
+        db = sqlite3.connect(':memory:')
+        cursor = BlockingCursor(db.cursor())
+        d = cursor.execute('create table foo (name text)')
+        d.addCallback(lambda _: cursor.executemany(
+                      'insert into foo (name) values(?)',
+                      [('name1',), ('name2',)]))
+        d.addCallback(lambda _: cursor.execute('select name from foo'))
+        d.addCallback(lambda _: cursor.fetchall())
+        def check(result):
+            self.assertEqual(result, [('name1',), ('name2',)])
+        d.addCallback(check)
+        return d
+
+
     def test_fetchall(self):
         """
         You can fetch all
@@ -56,6 +76,45 @@ class BlockingCursorTest(TestCase):
         return d
 
 
+    def test_stream(self):
+        """
+        You can have the results given to a function a few rows at a time.
+        """
+        db = sqlite3.connect(':memory:')
+        db.execute('create table foo (id integer)')
+        db.executemany('insert into foo (id) values (?)',
+                       [(i,) for i in xrange(5)])
+        cursor = BlockingCursor(db.cursor())
+        batches = []
+        d = cursor.stream('select id from foo where id > ? order by id',
+                          (0,), batches.append, 3)
+        self.successResultOf(d)
+        self.assertEqual(batches, [[(1,), (2,), (3,)], [(4,)]])
+
+
+    def test_stream_waits(self):
+        """
+        If the function returns a C{Deferred}, the next batch isn't fetched
+        until it fires.
+        """
+        db = sqlite3.connect(':memory:')
+        db.execute('create table foo (id integer)')
+        db.executemany('insert into foo (id) values (?)', [(1,), (2,)])
+        cursor = BlockingCursor(db.cursor())
+        pending = []
+        def handle(rows):
+            pending.append((rows, defer.Deferred()))
+            return pending[-1][1]
+        d = cursor.stream('select id from foo order by id', (), handle, 1)
+        self.assertNoResult(d)
+        self.assertEqual([x[0] for x in pending], [[(1,)]])
+        pending[0][1].callback(None)
+        self.assertEqual([x[0] for x in pending], [[(1,)], [(2,)]])
+        self.assertNoResult(d)
+        pending[1][1].callback(None)
+        self.successResultOf(d)
+
+
     def test_lastrowid(self):
         """
         You can get the lastrowid (which may be meaningless for some db cursors)
@@ -68,6 +127,18 @@ class BlockingCursorTest(TestCase):
         return d
 
 
+    def test_rowCount(self):
+        """
+        You can get the number of rows changed by the last statement.
+        """
+        mock = MagicMock()
+        mock.rowcount = 3
+        cursor = BlockingCursor(mock)
+        d = cursor.rowCount()
+        d.addCallback(lambda count: self.assertEqual(count, 3))
+        return d
+
+
     def test_close(self):
         """
         You can close the cursor
@@ -184,6 +255,174 @@ class BlockingRunnerTest(TestCase):
         return d.addCallback(done)
 
 
+    def test_runMany(self):
+        """
+        Should run an interaction that runs the query for each set of
+        params.
+        """
+        db = sqlite3.connect(':memory:')
+        db.execute('create table foo (name text)')
+
+        runner = BlockingRunner(db)
+
+        d = runner.runMany('insert into foo (name) values (?)',
+                           [('name1',), ('name2',)])
+        def check(_):
+            rows = db.execute('select name from foo order by name').fetchall()
+            self.assertEqual(rows, [('name1',), ('name2',)])
+        return d.addCallback(check)
+
+
+
+class ThreadedRunnerTest(TestCase):
+
+
+    timeout = 2
+
+
+    def runner(self, connect):
+        runner = ThreadedRunner(connect)
+        self.addCleanup(runner.close)
+        return runner
+
+
+    def test_IRunner(self):
+        verifyObject(IRunner, self.runner(lambda: None))
+
+
+    def test_cursorFactory(self):
+        self.assertEqual(ThreadedRunner.cursorFactory, BlockingCursor)
+
+
+    @defer.inlineCallbacks
+    def test_connectInThread(self):
+        """
+        The connection should be made in the worker thread the first time
+        it's needed.
+        """
+        called = []
+        def connect():
+            called.append(threadable.isInIOThread())
+            return sqlite3.connect(':memory:')
+
+        runner = self.runner(connect)
+        self.assertEqual(called, [], "Should not connect until used")
+        yield runner.runQuery('select 1')
+        yield runner.runQuery('select 1')
+        self.assertEqual(called, [False], "Should connect once, in the "
+                         "worker thread")
+
+
+    @defer.inlineCallbacks
+    def test_runInteraction(self):
+        """
+        The interaction should be run in the worker thread with an instance
+        of cursorFactory, and then committed.
+        """
+        db = create_autospec(sqlite3.connect(':memory:'))
+        runner = self.runner(lambda: db)
+
+        def interaction(cursor, *args, **kwargs):
+            self.assertTrue(isinstance(cursor, BlockingCursor))
+            self.assertEqual(args, (1,2,3))
+            self.assertEqual(kwargs, {'foo': 'bar'})
+            return threadable.isInIOThread()
+
+        result = yield runner.runInteraction(interaction, 1, 2, 3, foo='bar')
+        self.assertEqual(result, False, "Should not run in the reactor thread")
+        db.commit.assert_called_once_with()
+
+
+    @defer.inlineCallbacks
+    def test_runInteraction_deferred(self):
+        """
+        Interactions may return C{Deferred}s (which fire synchronously
+        because the cursor is blocking).
+        """
+        runner = self.runner(lambda: sqlite3.connect(':memory:'))
+
+        def interaction(cursor):
+            d = cursor.execute('create table foo (name text)')
+            d.addCallback(lambda _: cursor.execute(
+                          'insert into foo (name) values (?)', ('name1',)))
+            d.addCallback(lambda _: cursor.execute('select name from foo'))
+            d.addCallback(lambda _: cursor.fetchall())
+            return d
+
+        result = yield runner.runInteraction(interaction)
+        self.assertEqual(result, [('name1',)])
+
+
+    @defer.inlineCallbacks
+    def test_runInteraction_error(self):
+        """
+        If there's an error in the interaction, do a rollback
+        """
+        db = create_autospec(sqlite3.connect(':memory:'))
+        runner = self.runner(lambda: db)
+
+        def interaction(cursor):
+            return defer.fail(Exception('foo'))
+
+        yield self.assertFailure(runner.runInteraction(interaction), Exception)
+        db.rollback.assert_called_once_with()
+        self.assertEqual(db.commit.call_count, 0)
+
+
+    def test_runInteraction_notSynchronous(self):
+        """
+        Interactions that wait on something other than the cursor can't be
+        run in the worker thread.
+        """
+        db = create_autospec(sqlite3.connect(':memory:'))
+        runner = self.runner(lambda: db)
+
+        d = runner.runInteraction(lambda cursor: defer.Deferred())
+        d = self.assertFailure(d, Error)
+        return d.addCallback(lambda _: db.rollback.assert_called_once_with())
+
+
+    @defer.inlineCallbacks
+    def test_runQuery_runOperation(self):
+        """
+        You can run queries and operations.
+        """
+        runner = self.runner(lambda: sqlite3.connect(':memory:'))
+
+        yield runner.runOperation('create table foo (name text)')
+        yield runner.runOperation('insert into foo (name) values (?)',
+                                  ('name1',))
+        rows = yield runner.runQuery('select name from foo where name = ?',
+                                     ('name1',))
+        self.assertEqual(rows, [('name1',)])
+        yield runner.runMany('insert into foo (name) values (?)',
+                             [('name2',), ('name3',)])
+        rows = yield runner.runQuery('select count(*) from foo')
+        self.assertEqual(rows, [(3,)])
+
+
+    @defer.inlineCallbacks
+    def test_close(self):
+        """
+        Closing should close the connection and stop the worker thread.
+        """
+        db = MagicMock()
+        runner = ThreadedRunner(lambda: db)
+        yield runner.runQuery('select 1')
+        yield runner.close()
+        db.close.assert_called_once_with()
+        self.assertEqual(runner.threadpool.started, False)
+        yield runner.close()
+
+
+    def test_close_unused(self):
+        """
+        You can close a runner that never made a connection.
+        """
+        runner = ThreadedRunner(lambda: self.fail("Should not connect"))
+        return runner.close()
+
+
 
 class ConnectionPoolTest(TestCase):
 
@@ -239,9 +478,20 @@ class ConnectionPoolTest(TestCase):
         pool = ConnectionPool()
         pool.add(mock)
 
-        d = pool.runInteraction('my interaction')
+        called = []
+        def interaction(cursor, *args, **kwargs):
+            called.append((cursor.execute, args, kwargs))
+        d = pool.runInteraction(interaction, 'a', b='c')
         self.assertEqual(self.successResultOf(d), 'success')
-        mock.runInteraction.assert_called_once_with('my interaction')
+        self.assertEqual(mock.runInteraction.call_count, 1)
+
+        # the interaction is wrapped to count the statements it executes
+        args, kwargs = mock.runInteraction.call_args
+        self.assertEqual(args[1:], ('a',))
+        self.assertEqual(kwargs, {'b': 'c'})
+        cursor = MagicMock()
+        args[0](cursor, *args[1:], **kwargs)
+        self.assertEqual(called, [(cursor.execute, ('a',), {'b': 'c'})])
 
 
     def test_runQuery(self):
@@ -274,6 +524,21 @@ class ConnectionPoolTest(TestCase):
         mock.runOperation.assert_called_once_with('my query')
 
 
+    def test_runMany(self):
+        """
+        You can run a query for several sets of params
+        """
+        mock = MagicMock()
+        mock.runMany = MagicMock(return_value=defer.succeed('success'))
+
+        pool = ConnectionPool()
+        pool.add(mock)
+
+        d = pool.runMany('my query', [(1,), (2,)])
+        self.assertEqual(self.successResultOf(d), 'success')
+        mock.runMany.assert_called_once_with('my query', [(1,), (2,)])
+
+
     def test_returnToPool(self):
         """
         After a successful query, interaction or operation, the connection
@@ -315,17 +580,21 @@ class ConnectionPoolTest(TestCase):
     @defer.inlineCallbacks
     def test_reconnect(self):
         """
-        If a query fails, make sure it wasn't just closed, reconnect and retry
-        if it was.
+        If a query fails because the connection was closed, the connection
+        is replaced and the query is tried again on the new one.
         """
         class BadConn(object):
 
             def __init__(self):
                 self.called = []
+                self.closed = False
 
             def runQuery(self, *args):
                 self.called.append(args)
-                return defer.fail(Exception('foo'))
+                return defer.fail(sqlite3.InterfaceError('closed'))
+
+            def close(self):
+                self.closed = True
 
         c1 = BadConn()
 
@@ -337,14 +606,177 @@ class ConnectionPoolTest(TestCase):
         pool.setConnect(lambda:c2)
 
         result = yield pool.runQuery('something', 'ran')
-        self.assertEqual(len(c1.called), 2)
-        self.assertIn(('something', 'ran'), c1.called)
+        self.assertEqual(c1.called, [('something', 'ran'), ('select 1',)])
+        self.assertTrue(c1.closed, "Should close the broken conn")
         c2.runQuery.assert_any_call('something', 'ran')
         self.assertEqual(pool.pool.list(), [c2], "Should have the new conn "
                          "in the pool")
         self.assertEqual(result, 'success', "Should have eventually succeeded")
 
 
+    def interactionConn(self, broken=False, error=sqlite3.OperationalError):
+        """
+        Make a connection whose cursor's C{execute} records what it's given,
+        failing with C{error} if C{broken} is C{True}.
+        """
+        conn = MagicMock()
+        conn.executed = []
+        conn.broken = broken
+        def execute(sql, params=()):
+            if conn.broken:
+                return defer.fail(error('lost'))
+            conn.executed.append(sql)
+            return defer.succeed(None)
+        cursor = MagicMock()
+        cursor.execute.side_effect = execute
+        conn.runInteraction.side_effect = lambda f, *a, **kw: (
+            defer.maybeDeferred(f, cursor, *a, **kw))
+        conn.runQuery.side_effect = lambda sql: execute(sql)
+        conn.close.return_value = None
+        return conn
+
+
+    def test_reconnect_sqlError(self):
+        """
+        Failures which aren't from a lost connection aren't retried, and the
+        connection isn't tested.
+        """
+        exc = sqlite3.IntegrityError('foo')
+        conn = MagicMock()
+        conn.runQuery.return_value = defer.fail(exc)
+        new = self.interactionConn()
+        pool = ConnectionPool()
+        pool.add(conn)
+        pool.setConnect(lambda: new)
+
+        result = pool.runQuery('something')
+        self.assertEqual(self.failureResultOf(result).value, exc)
+        conn.runQuery.assert_called_once_with('something')
+        self.assertEqual(pool.pool.list(), [conn])
+
+
+    def test_reconnect_healthy(self):
+        """
+        If the connection still works after a failure that looks like a lost
+        connection, the failure is returned and the connection kept.
+        """
+        conn = self.interactionConn()
+        conn.runOperation.return_value = defer.fail(
+            sqlite3.OperationalError('locked'))
+        new = self.interactionConn()
+        pool = ConnectionPool()
+        pool.add(conn)
+        pool.setConnect(lambda: new)
+
+        result = pool.runOperation('something')
+        self.failureResultOf(result, sqlite3.OperationalError)
+        self.assertEqual(conn.executed, ['select 1'])
+        self.assertFalse(conn.close.called)
+        self.assertEqual(pool.pool.list(), [conn])
+
+
+    def test_reconnect_mayHaveRun(self):
+        """
+        A single statement which failed with an error that doesn't show it
+        wasn't sent isn't tried again (it may have been run), but the broken
+        connection is still replaced.
+        """
+        conn = self.interactionConn(broken=True)
+        conn.runOperation.return_value = defer.fail(
+            sqlite3.OperationalError('lost'))
+        new = self.interactionConn()
+        pool = ConnectionPool()
+        pool.add(conn)
+        pool.setConnect(lambda: new)
+
+        result = pool.runOperation('insert')
+        self.failureResultOf(result, sqlite3.OperationalError)
+        self.assertFalse(new.runOperation.called)
+        conn.close.assert_called_once_with()
+        self.assertEqual(pool.pool.list(), [new])
+
+
+    def test_reconnect_interaction(self):
+        """
+        An interaction which failed on its first statement because the
+        connection was lost is tried again on a new connection.
+        """
+        conn = self.interactionConn(broken=True)
+        new = self.interactionConn()
+        pool = ConnectionPool()
+        pool.add(conn)
+        pool.setConnect(lambda: new)
+
+        calls = []
+        def interaction(cursor):
+            calls.append(cursor)
+            d = cursor.execute('insert 1')
+            d.addCallback(lambda _: cursor.execute('insert 2'))
+            return d.addCallback(lambda _: 'done')
+
+        result = pool.runInteraction(interaction)
+        self.assertEqual(self.successResultOf(result), 'done')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(new.executed, ['insert 1', 'insert 2'])
+        conn.close.assert_called_once_with()
+        self.assertEqual(pool.pool.list(), [new])
+
+
+    def test_reconnect_interactionStarted(self):
+        """
+        An interaction which lost its connection after running a statement
+        isn't tried again, but the connection is replaced.
+        """
+        conn = self.interactionConn()
+        new = self.interactionConn()
+        pool = ConnectionPool()
+        pool.add(conn)
+        pool.setConnect(lambda: new)
+
+        calls = []
+        def interaction(cursor):
+            calls.append(cursor)
+            d = cursor.execute('insert 1')
+            def lose(_):
+                conn.broken = True
+                return cursor.execute('insert 2')
+            return d.addCallback(lose)
+
+        result = pool.runInteraction(interaction)
+        self.failureResultOf(result, sqlite3.OperationalError)
+        self.assertEqual(len(calls), 1, "Should not have been retried")
+        self.assertEqual(conn.executed, ['insert 1'])
+        self.assertEqual(new.executed, [])
+        conn.close.assert_called_once_with()
+        self.assertEqual(pool.pool.list(), [new])
+
+
+    def test_reconnect_commit(self):
+        """
+        An interaction whose commit failed because the connection was lost
+        isn't tried again.
+        """
+        conn = self.interactionConn()
+        def runInteraction(f, *args, **kwargs):
+            d = defer.maybeDeferred(f, MagicMock(), *args, **kwargs)
+            def commit(_):
+                conn.broken = True
+                raise sqlite3.OperationalError('lost')
+            return d.addCallback(commit)
+        conn.runInteraction.side_effect = runInteraction
+        new = self.interactionConn()
+        pool = ConnectionPool()
+        pool.add(conn)
+        pool.setConnect(lambda: new)
+
+        calls = []
+        result = pool.runInteraction(calls.append)
+        self.failureResultOf(result, sqlite3.OperationalError)
+        self.assertEqual(len(calls), 1, "Should not have been retried")
+        self.assertFalse(new.runInteraction.called)
+        self.assertEqual(pool.pool.list(), [new])
+
+
     def test_reconnect_noConnectionMethod(self):
         """
         Reconnection is not possible is the setConnect method hasn't been
@@ -372,6 +804,370 @@ class ConnectionPoolTest(TestCase):
         self.assertIn(('something', 'ran'), c1.called)
 
 
+class ElasticConnectionPoolTest(TestCase):
+
+
+    timeout = 2
+
+
+    def conn(self, result='success'):
+        conn = MagicMock()
+        conn.runQuery.side_effect = lambda *args: defer.succeed(result)
+        conn.close.return_value = defer.succeed(None)
+        return conn
+
+
+    def busyConn(self):
+        conn = self.conn()
+        conn.runInteraction.return_value = defer.Deferred()
+        return conn
+
+
+    def test_grow(self):
+        """
+        If something has to wait for a connection, a new one is made (up to
+        C{max_size}).
+        """
+        made = []
+        def connect():
+            made.append(self.busyConn())
+            return made[-1]
+        pool = ConnectionPool(max_size=2, clock=task.Clock())
+        pool.setConnect(connect)
+        pool.add(self.busyConn())
+
+        pool.runInteraction('a')
+        self.assertEqual(len(made), 0, "Shouldn't make one if one is idle")
+        pool.runInteraction('b')
+        self.assertEqual(len(made), 1, "Should have made a new connection")
+        self.assertEqual(made[0].runInteraction.call_count, 1)
+        self.assertEqual(made[0].runInteraction.call_args[0][0].function, 'b')
+
+        d = pool.runInteraction('c')
+        self.assertEqual(len(made), 1, "Should not exceed max_size")
+        self.assertFalse(d.called)
+        self.assertEqual(pool.size(), 2)
+
+
+    def test_grow_empty(self):
+        """
+        If there are no connections, one is made even without a
+        C{max_size}.
+        """
+        conn = self.conn()
+        pool = ConnectionPool()
+        pool.setConnect(lambda: conn)
+        d = pool.runQuery('foo')
+        self.assertEqual(self.successResultOf(d), 'success')
+        self.assertEqual(pool.pool.list(), [conn])
+
+
+    def test_grow_noConnect(self):
+        """
+        Connections aren't made if there's no way to make them.
+        """
+        pool = ConnectionPool(max_size=2)
+        pool.add(self.busyConn())
+        pool.runInteraction('a')
+        d = pool.runInteraction('b')
+        self.assertFalse(d.called)
+        self.assertEqual(pool.size(), 1)
+
+
+    def test_idleTimeout(self):
+        """
+        Connections idle for too long are closed, leaving at least
+        C{min_size}.
+        """
+        clock = task.Clock()
+        pool = ConnectionPool(min_size=1, idle_timeout=10, check_interval=5,
+                              clock=clock)
+        conns = [self.conn() for i in xrange(3)]
+        for conn in conns:
+            pool.add(conn)
+
+        clock.advance(5)
+        self.assertEqual(len(pool.pool.list()), 3)
+        pool.runQuery('foo')
+
+        clock.advance(5)
+        self.assertEqual(len(pool.pool.list()), 1)
+        closed = [x for x in conns if x.close.called]
+        self.assertEqual(len(closed), 2)
+        self.assertEqual(pool.pool.list(), [conns[0]],
+                         "Should keep the recently used one")
+
+
+    def test_maxLifetime(self):
+        """
+        Connections older than C{max_lifetime} are replaced.
+        """
+        clock = task.Clock()
+        old = self.conn()
+        new = self.conn()
+        pool = ConnectionPool(min_size=1, max_lifetime=60, check_interval=30,
+                              clock=clock)
+        pool.setConnect(lambda: new)
+        pool.add(old)
+
+        clock.advance(30)
+        self.assertEqual(pool.pool.list(), [old])
+        clock.advance(30)
+        old.close.assert_called_once_with()
+        self.assertEqual(pool.pool.list(), [new])
+
+
+    def test_healthCheck(self):
+        """
+        Idle connections are tested, and broken ones are replaced.
+        """
+        good = self.conn()
+        bad = self.conn()
+        bad.runQuery.side_effect = lambda *args: defer.fail(Exception('foo'))
+        new = self.conn()
+        pool = ConnectionPool(min_size=2)
+        pool.setConnect(lambda: new)
+        pool.add(good)
+        pool.add(bad)
+
+        self.successResultOf(pool.check())
+        good.runQuery.assert_called_once_with('select 1')
+        bad.close.assert_called_once_with()
+        self.assertEqual(set(pool.pool.list()), set([good, new]))
+
+
+    def test_healthCheck_size(self):
+        """
+        Connections being checked are counted, so a new one isn't made for
+        something that waits for the check to finish.
+        """
+        made = []
+        def connect():
+            made.append(self.conn())
+            return made[-1]
+        checked = defer.Deferred()
+        conn = self.conn()
+        conn.runQuery.side_effect = lambda *args: checked
+        pool = ConnectionPool(min_size=1)
+        pool.setConnect(connect)
+        pool.add(conn)
+
+        check = pool.check()
+        self.assertEqual(pool.size(), 1)
+        conn.runQuery.side_effect = lambda *args: defer.succeed('success')
+        d = pool.runQuery('foo')
+        self.assertEqual(made, [], "Should not make a new connection")
+        self.assertFalse(d.called)
+
+        checked.callback(None)
+        self.successResultOf(check)
+        self.assertEqual(self.successResultOf(d), 'success')
+        self.assertEqual(pool.pool.list(), [conn])
+
+
+    def test_healthCheck_timeout(self):
+        """
+        A connection which doesn't answer the check within C{check_timeout}
+        seconds is replaced.
+        """
+        clock = task.Clock()
+        stuck = self.conn()
+        stuck.runQuery.side_effect = lambda *args: defer.Deferred()
+        new = self.conn()
+        pool = ConnectionPool(min_size=1, check_timeout=5, clock=clock)
+        pool.setConnect(lambda: new)
+        pool.add(stuck)
+
+        d = pool.check()
+        self.assertFalse(d.called)
+        clock.advance(5)
+        self.successResultOf(d)
+        stuck.close.assert_called_once_with()
+        self.assertEqual(pool.pool.list(), [new])
+        self.assertEqual(pool.size(), 1)
+
+
+    def test_reconnect_timeout(self):
+        """
+        If the check after a failure that looks like a lost connection
+        doesn't answer in time, the connection is treated as broken.
+        """
+        clock = task.Clock()
+        conn = self.conn()
+        conn.runQuery.side_effect = lambda *args: defer.Deferred()
+        conn.runOperation.return_value = defer.fail(
+            sqlite3.OperationalError('lost'))
+        new = self.conn()
+        pool = ConnectionPool(check_timeout=5, clock=clock)
+        pool.setConnect(lambda: new)
+        pool.add(conn)
+
+        d = pool.runOperation('insert')
+        clock.advance(5)
+        self.failureResultOf(d, sqlite3.OperationalError)
+        conn.close.assert_called_once_with()
+        self.assertEqual(pool.pool.list(), [new])
+
+
+    def test_close(self):
+        """
+        Closing the pool stops the periodic checks.
+        """
+        clock = task.Clock()
+        pool = ConnectionPool(check_interval=5, clock=clock)
+        conn = self.conn()
+        pool.add(conn)
+        self.successResultOf(pool.close())
+        clock.advance(5)
+        self.assertFalse(conn.runQuery.called)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+
+class PoolMetricsTest(TestCase):
+
+
+    def test_histogram(self):
+        """
+        Wait times are counted in buckets.
+        """
+        metrics = PoolMetrics()
+        metrics.wait_buckets = (1, 10)
+        metrics.wait_counts = [0, 0, 0]
+        for wait in [0, 1, 2, 10, 11, 100]:
+            metrics.checkedOut('conn', wait)
+        self.assertEqual(metrics.waitHistogram(),
+                         [(1, 2), (10, 2), (None, 2)])
+        self.assertEqual(metrics.checkouts, 6)
+        self.assertEqual(metrics.wait_total, 124)
+        self.assertEqual(metrics.wait_max, 100)
+
+
+    def test_queries(self):
+        """
+        The statements executed are counted per connection.
+        """
+        metrics = PoolMetrics()
+        metrics.released('a', 1, False)
+        metrics.released('a', 1, False, 50)
+        metrics.released('b', 1, True, 0)
+        self.assertEqual(metrics.queries, {'a': 51, 'b': 0})
+        metrics.forget('a')
+        self.assertEqual(metrics.queries, {'b': 0})
+
+
+    def test_errors(self):
+        """
+        Errors are counted per connection.
+        """
+        metrics = PoolMetrics()
+        metrics.released('a', 1, True)
+        metrics.released('a', 1, False)
+        metrics.released('b', 1, True)
+        self.assertEqual(metrics.errors, {'a': 1, 'b': 1})
+        metrics.forget('a')
+        self.assertEqual(metrics.errors, {'b': 1})
+
+
+    def test_sink(self):
+        """
+        The sink is given each measurement.
+        """
+        events = []
+        metrics = PoolMetrics(lambda *args: events.append(args))
+        metrics.checkedOut('a', 2, waiting=1)
+        metrics.released('a', 3, False, waiting=0)
+        self.assertEqual(events, [
+            ('checkout', {'wait': 2, 'waiting': 1}),
+            ('release', {'duration': 3, 'failed': False, 'waiting': 0}),
+        ])
+
+
+
+class ConnectionPoolStatsTest(TestCase):
+
+
+    timeout = 2
+
+
+    def test_stats(self):
+        """
+        You can get statistics about how the pool is used.
+        """
+        clock = task.Clock()
+        events = []
+        pool = ConnectionPool(clock=clock,
+                              sink=lambda *args: events.append(args))
+        conn = MagicMock()
+        pending = []
+        def runInteraction(*args):
+            pending.append(defer.Deferred())
+            return pending[-1]
+        conn.runInteraction.side_effect = runInteraction
+        pool.add(conn)
+
+        d1 = pool.runInteraction('a')
+        d2 = pool.runInteraction('b')
+        stats = pool.stats()
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['in_use'], 1)
+        self.assertEqual(stats['idle'], 0)
+        self.assertEqual(stats['waiting'], 1)
+
+        clock.advance(2)
+        pending[0].errback(Exception('foo'))
+        self.failureResultOf(d1)
+        clock.advance(1)
+        pending[1].callback('done')
+        self.successResultOf(d2)
+
+        stats = pool.stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['waiting'], 0)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['wait_total'], 2)
+        self.assertEqual(stats['wait_max'], 2)
+        self.assertEqual(stats['connections'], [{'queries': 0, 'errors': 1}],
+                         "The interactions didn't execute anything")
+        self.assertEqual(sum([x[1] for x in stats['wait_histogram']]), 2)
+
+        self.assertEqual([(x[0], x[1].get('wait', x[1].get('duration')))
+                          for x in events], [
+            ('checkout', 0),
+            ('release', 2),
+            ('checkout', 2),
+            ('release', 1),
+        ])
+
+
+
+    @defer.inlineCallbacks
+    def test_stats_queries(self):
+        """
+        Each statement executed in an interaction is counted as a query, and
+        so is each C{runQuery}, C{runOperation} and C{runMany}.
+        """
+        db = sqlite3.connect(':memory:')
+        pool = ConnectionPool()
+        pool.add(BlockingRunner(db))
+
+        def interaction(cursor):
+            d = cursor.execute('create table foo (a integer)')
+            for i in xrange(3):
+                d.addCallback(lambda _, i=i: cursor.execute(
+                    'insert into foo (a) values (?)', (i,)))
+            return d
+
+        yield pool.runInteraction(interaction)
+        yield pool.runQuery('select * from foo')
+        yield pool.runMany('insert into foo (a) values (?)', [(1,), (2,)])
+        stats = pool.stats()
+        self.assertEqual(stats['checkouts'], 3)
+        self.assertEqual(stats['connections'], [{'queries': 6, 'errors': 0}])
+
+
+
 class NextAvailablePoolTest(TestCase):
 
 
@@ -480,13 +1276,19 @@ class NextAvailablePoolTest(TestCase):
         self.assertEqual(set(r), set(['foo', 'bar', 'choo']))
 
 
-
-
-
-
-
-
-
-
-
-
+    @defer.inlineCallbacks
+    def test_idle_waiting(self):
+        """
+        You can list the idle things and count the waiting requests.
+        """
+        pool = NextAvailablePool()
+        pool.add('foo')
+        pool.add('bar')
+        self.assertEqual(pool.idle(), ['foo', 'bar'])
+        yield pool.get()
+        self.assertEqual(pool.idle(), ['bar'])
+        yield pool.get()
+        pool.get()
+        pool.get()
+        self.assertEqual(pool.idle(), [])
+        self.assertEqual(pool.waiting(), 2)
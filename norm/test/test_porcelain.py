@@ -2,13 +2,15 @@
 # See LICENSE for details.
 
 from twisted.trial.unittest import TestCase
-from twisted.internet import defer
+from twisted.internet import defer, task, reactor
 
 from norm.porcelain import makePool, insert, ormHandle
 from norm.patch import Patcher
 from norm.test.util import postgres_url, skip_postgres
 from norm.orm.props import Int
-from norm.orm.expr import Eq, Query
+from norm.orm.base import IdentityMap, Many
+from norm.orm.error import NotLoaded
+from norm.orm.expr import Eq, Query, Count
 
 
 
@@ -56,6 +58,68 @@ class PostgresTest(TestCase):
 
 
 
+    @defer.inlineCallbacks
+    def test_runMany_percent(self):
+        """
+        Values given to C{runMany} may have percent signs in them.
+        """
+        pool = yield makePool(postgres_url)
+        self.addCleanup(pool.close)
+        yield pool.runOperation('CREATE TEMPORARY TABLE porc5 (name text)')
+        yield pool.runMany('insert into porc5 (name) values (?)',
+                           [('50%',), ('a%sb',), ('%%',)])
+        rows = yield pool.runQuery('select name from porc5 order by name')
+        self.assertEqual([x[0] for x in rows], ['%%', '50%', 'a%sb'])
+
+
+    @defer.inlineCallbacks
+    def test_prepare(self):
+        """
+        Statements executed several times are prepared when C{prepare} is
+        C{True}.
+        """
+        pool = yield makePool(postgres_url, prepare=True)
+        self.addCleanup(pool.close)
+        yield pool.runOperation('''CREATE TEMPORARY TABLE porc4 (
+            id serial primary key,
+            name text
+        )''')
+        for name in ['a', 'b', 'c']:
+            yield insert(pool, 'insert into porc4 (name) values (?)', (name,))
+        for i in xrange(3):
+            rows = yield pool.runQuery('select name from porc4 where id = ?',
+                                       (2,))
+            self.assertEqual(rows[0][0], 'b')
+
+        rows = yield pool.runQuery('select count(*) from pg_prepared_statements')
+        self.assertTrue(rows[0][0] >= 2, "Should have prepared statements")
+
+
+    @defer.inlineCallbacks
+    def test_prepareFails(self):
+        """
+        A statement which can't be prepared is executed as usual without
+        aborting the transaction it's in.
+        """
+        pool = yield makePool(postgres_url, prepare=True)
+        self.addCleanup(pool.close)
+
+        @defer.inlineCallbacks
+        def interaction(cursor):
+            results = []
+            for i in xrange(3):
+                # the types of the parameters can't be inferred by PREPARE
+                yield cursor.execute('select ? + ?', (i, 1))
+                results.append((yield cursor.fetchone())[0])
+            yield cursor.execute('select 1')
+            results.append((yield cursor.fetchone())[0])
+            defer.returnValue(results)
+
+        results = yield pool.runInteraction(interaction)
+        self.assertEqual(results, [1, 2, 3, 1])
+
+
+
 class SqliteTest(TestCase):
 
 
@@ -98,6 +162,77 @@ class SqliteTest(TestCase):
 
 
 
+class ThreadedSqliteTest(TestCase):
+
+
+    timeout = 2
+
+
+    @defer.inlineCallbacks
+    def test_basic(self):
+        pool = yield makePool('sqlite:', threaded=True)
+        self.assertEqual(pool.db_scheme, 'sqlite')
+        self.addCleanup(pool.close)
+        yield pool.runOperation('''CREATE TABLE porc1 (
+            id integer primary key,
+            name text
+        )''')
+
+        rowid = yield insert(pool, 'insert into porc1 (name) values (?)',
+                             ('bob',))
+        rows = yield pool.runQuery('select id, name from porc1 where id = ?',
+                                   (rowid,))
+        self.assertEqual(map(tuple,rows), [(rowid, 'bob')])
+        self.assertEqual(rows[0]['name'], 'bob')
+
+
+    @defer.inlineCallbacks
+    def test_connections(self):
+        """
+        A file database can be used through several threaded connections.
+        """
+        path = self.mktemp()
+        pool = yield makePool('sqlite:' + path, connections=3, threaded=True)
+        self.addCleanup(pool.close)
+        self.assertEqual(len(pool.pool.list()), 3)
+        yield pool.runOperation('create table foo (name text)')
+
+        yield defer.gatherResults([
+            pool.runOperation('insert into foo (name) values (?)', (str(i),))
+            for i in xrange(10)])
+        rows = yield pool.runQuery('select count(*) from foo')
+        self.assertEqual(rows[0][0], 10)
+
+
+    @defer.inlineCallbacks
+    def test_grow(self):
+        """
+        Pools of file databases grow up to C{max_size} when busy.
+        """
+        path = self.mktemp()
+        pool = yield makePool('sqlite:' + path, threaded=True, max_size=3)
+        self.addCleanup(pool.close)
+        self.assertEqual(pool.min_size, 1)
+        yield pool.runOperation('create table foo (name text)')
+
+        yield defer.gatherResults([
+            pool.runOperation('insert into foo (name) values (?)', (str(i),))
+            for i in xrange(6)])
+        self.assertEqual(len(pool.pool.list()), 3)
+        rows = yield pool.runQuery('select count(*) from foo')
+        self.assertEqual(rows[0][0], 6)
+
+
+    def test_memoryConnections(self):
+        """
+        Multiple connections to an in-memory database would each get their
+        own database.
+        """
+        self.assertRaises(ValueError, makePool, 'sqlite:', connections=2,
+                          threaded=True)
+
+
+
 class ormHandleMixin(object):
 
 
@@ -105,6 +240,8 @@ class ormHandleMixin(object):
         __sql_table__ = 'porc3'
         id = Int(primary=True)
         age = Int()
+        same_age = Many(age, lambda: ormHandleMixin.Foo.age,
+                        order_by=lambda: ormHandleMixin.Foo.id)
 
 
     def getPool(self):
@@ -153,6 +290,296 @@ class ormHandleMixin(object):
         self.assertEqual(len(foos), 0)
 
 
+    @defer.inlineCallbacks
+    def test_find_as(self):
+        """
+        You can find plain values instead of objects, in or out of a
+        transaction.
+        """
+        pool = yield self.getPool()
+        handle = yield ormHandle(pool, identity_map=IdentityMap())
+        foo = self.Foo()
+        foo.age = 3
+        yield handle.insert(foo)
+
+        rows = yield handle.find(self.Foo, as_='tuples')
+        self.assertEqual(rows, [(3, foo.id)])
+        rows = yield handle.query(Query(self.Foo), as_='dicts')
+        self.assertEqual(rows, [{'age': 3, 'id': foo.id}])
+        rows = yield handle.transact(lambda h: h.find(self.Foo,
+                                                      as_='columns'))
+        self.assertEqual(rows, {'age': [3], 'id': [foo.id]})
+
+
+    @defer.inlineCallbacks
+    def test_get(self):
+        """
+        You can get an object by primary key.
+        """
+        pool = yield self.getPool()
+        handle = yield ormHandle(pool)
+        foo = yield handle.insert(self.Foo())
+
+        foo2 = yield handle.get(self.Foo, foo.id)
+        self.assertEqual(foo2.id, foo.id)
+        missing = yield handle.get(self.Foo, foo.id + 1)
+        self.assertEqual(missing, None)
+        self.assertRaises(TypeError, handle.get, self.Foo, 1, 2)
+
+
+    @defer.inlineCallbacks
+    def test_load(self):
+        """
+        Attributes left out of a query can be loaded later.
+        """
+        pool = yield self.getPool()
+        handle = yield ormHandle(pool)
+        foo = self.Foo()
+        foo.age = 12
+        yield handle.insert(foo)
+
+        foos = yield handle.find(self.Foo, project=[self.Foo.id])
+        foo2 = foos[0]
+        self.assertRaises(NotLoaded, getattr, foo2, 'age')
+        result = yield handle.load(foo2)
+        self.assertTrue(result is foo2)
+        self.assertEqual(foo2.age, 12)
+
+        result = yield handle.load(foo2)
+        self.assertTrue(result is foo2, "Nothing left to load")
+
+        foos = yield handle.find(self.Foo, project=[self.Foo.id])
+        yield handle.transact(lambda h: h.load(foos[0], self.Foo.age))
+        self.assertEqual(foos[0].age, 12)
+
+
+    @defer.inlineCallbacks
+    def test_relations(self):
+        """
+        Related objects can be loaded with a query or afterward, and are
+        the objects in the identity map.
+        """
+        pool = yield self.getPool()
+        handle = yield ormHandle(pool, identity_map=IdentityMap())
+        for age in [1, 1, 2]:
+            foo = self.Foo()
+            foo.age = age
+            yield handle.insert(foo)
+
+        foos = yield handle.find(self.Foo, eager=self.Foo.same_age,
+                                 order_by=self.Foo.id)
+        self.assertEqual(len(foos[0].same_age), 2)
+        self.assertTrue(foos[0].same_age[0] is foos[0])
+        self.assertTrue(foos[0].same_age[1] is foos[1])
+        self.assertTrue(foos[2].same_age[0] is foos[2])
+
+        foo = foos[0]
+        del foos
+        foo = yield handle.get(self.Foo, foo.id)
+        foo.age = 2
+        result = yield handle.load(foo, self.Foo.same_age)
+        self.assertTrue(result is foo)
+        self.assertEqual([x.id for x in foo.same_age], [3])
+        self.assertEqual(foo.age, 2, "Only the relation is loaded")
+
+        yield handle.transact(lambda h: h.load(foo, self.Foo.same_age))
+        self.assertEqual([x.id for x in foo.same_age], [3])
+
+
+    @defer.inlineCallbacks
+    def test_count(self):
+        """
+        You can count the rows a query would return.
+        """
+        pool = yield self.getPool()
+        handle = yield ormHandle(pool, identity_map=IdentityMap())
+        yield handle.insert(self.Foo())
+        yield handle.insert(self.Foo())
+
+        count = yield handle.count(Query(self.Foo))
+        self.assertEqual(count, 2)
+        count = yield handle.transact(lambda h: h.count(Query(self.Foo)))
+        self.assertEqual(count, 2)
+
+        rows = yield handle.find((self.Foo, Count(self.Foo.id)),
+                                 group_by=self.Foo.id)
+        self.assertEqual([x[1] for x in rows], [1, 1])
+        self.assertTrue(isinstance(rows[0][0], self.Foo))
+
+
+    @defer.inlineCallbacks
+    def test_updateWhere(self):
+        """
+        You can update and delete many rows at once.  Objects of the class
+        are forgotten by the identity map.
+        """
+        pool = yield self.getPool()
+        handle = yield ormHandle(pool, identity_map=IdentityMap())
+        foo = self.Foo()
+        foo.age = 1
+        yield handle.insert(foo)
+        yield handle.insert(self.Foo())
+
+        count = yield handle.updateWhere(self.Foo, self.Foo.age == 1, age=2)
+        self.assertEqual(count, 1)
+        self.assertEqual(foo.age, 1, "Loaded objects aren't changed")
+        foo2 = yield handle.get(self.Foo, foo.id)
+        self.assertFalse(foo2 is foo)
+        self.assertEqual(foo2.age, 2)
+
+        count = yield handle.transact(lambda h:
+            h.deleteWhere(self.Foo, self.Foo.age == None))
+        self.assertEqual(count, 1)
+        count = yield handle.deleteWhere(self.Foo, None)
+        self.assertEqual(count, 1)
+
+
+    @defer.inlineCallbacks
+    def test_unitOfWork(self):
+        """
+        In unit of work mode, objects updated in a transaction are updated
+        together before anything else is done and at the end of the
+        transaction.
+        """
+        pool = yield self.getPool()
+        handle = yield ormHandle(pool, unit_of_work=True)
+        foos = yield handle.insertMany([self.Foo() for i in xrange(3)])
+
+        calls = []
+        real_updateMany = handle.operator.updateMany
+        def updateMany(cursor, objs):
+            calls.append(list(objs))
+            return real_updateMany(cursor, objs)
+        handle.operator.updateMany = updateMany
+
+        @defer.inlineCallbacks
+        def work(h):
+            foos[0].age = 1
+            yield h.update(foos[0])
+            foos[1].age = 2
+            yield h.update(foos[1])
+            yield h.update(foos[0])
+            self.assertEqual(calls, [], "Should wait to update")
+            count = yield h.count(Query(self.Foo, self.Foo.age != None))
+            self.assertEqual(count, 2, "Should flush before querying")
+            self.assertEqual(calls, [[foos[0], foos[1]]])
+
+            foos[2].age = 3
+            yield h.update(foos[2])
+        yield handle.transact(work)
+        self.assertEqual(calls, [[foos[0], foos[1]], [foos[2]]])
+
+        rows = yield handle.find(self.Foo.age, order_by=self.Foo.id)
+        self.assertEqual(rows, [1, 2, 3])
+
+
+    @defer.inlineCallbacks
+    def test_updateMany(self):
+        """
+        You can update several objects at once.
+        """
+        pool = yield self.getPool()
+        handle = yield ormHandle(pool)
+        foos = yield handle.insertMany([self.Foo() for i in xrange(2)])
+        foos[0].age = 5
+        foos[1].age = 6
+        yield handle.updateMany(foos)
+        rows = yield handle.find(self.Foo.age, order_by=self.Foo.id)
+        self.assertEqual(rows, [5, 6])
+
+
+    @defer.inlineCallbacks
+    def test_identityMap(self):
+        """
+        With an identity map, each row is loaded as the same object.
+        """
+        pool = yield self.getPool()
+        handle = yield ormHandle(pool, identity_map=IdentityMap())
+        foo = yield handle.insert(self.Foo())
+
+        foos = yield handle.find(self.Foo)
+        self.assertTrue(foos[0] is foo)
+
+        yield pool.runOperation('delete from porc3')
+        foo2 = yield handle.get(self.Foo, foo.id)
+        self.assertTrue(foo2 is foo, "Should not query the database")
+
+        yield handle.delete(foo)
+        foo3 = yield handle.get(self.Foo, foo.id)
+        self.assertEqual(foo3, None)
+
+
+    @defer.inlineCallbacks
+    def test_transactionIdentity(self):
+        """
+        Each transaction can have its own identity map.
+        """
+        pool = yield self.getPool()
+        handle = yield ormHandle(pool, transaction_identity=True)
+        yield handle.insert(self.Foo())
+
+        @defer.inlineCallbacks
+        def interaction(handle):
+            foos1 = yield handle.find(self.Foo)
+            foos2 = yield handle.find(self.Foo)
+            self.assertTrue(foos1[0] is foos2[0])
+            foo = yield handle.get(self.Foo, foos1[0].id)
+            self.assertTrue(foo is foos1[0])
+            defer.returnValue(foo)
+
+        foo1 = yield handle.transact(interaction)
+        foo2 = yield handle.transact(interaction)
+        self.assertFalse(foo1 is foo2, "Should be separate per transaction")
+
+
+    @defer.inlineCallbacks
+    def test_iterate(self):
+        """
+        You can handle the results of a query in batches, in or out of a
+        transaction.
+        """
+        pool = yield self.getPool()
+        handle = yield ormHandle(pool)
+        for i in xrange(5):
+            foo = self.Foo()
+            foo.age = i
+            yield handle.insert(foo)
+
+        ages = []
+        def handleBatch(foos):
+            ages.append([x.age for x in foos])
+            return defer.succeed(None)
+
+        yield handle.iterate(Query(self.Foo), handleBatch, batch_size=2)
+        self.assertEqual(sorted(sum(ages, [])), range(5))
+        self.assertEqual([len(x) for x in ages], [2, 2, 1])
+
+        ages = []
+        yield handle.transact(lambda h: h.iterate(Query(self.Foo),
+                                                  handleBatch, 3))
+        self.assertEqual([len(x) for x in ages], [3, 2])
+
+
+    @defer.inlineCallbacks
+    def test_iterate_backpressure(self):
+        """
+        The next batch isn't fetched until the Deferred returned for the
+        previous batch fires.
+        """
+        pool = yield self.getPool()
+        handle = yield ormHandle(pool)
+        for i in xrange(3):
+            yield handle.insert(self.Foo())
+
+        busy = []
+        def handleBatch(foos):
+            self.assertEqual(busy, [], "Should wait for the previous batch")
+            busy.append(True)
+            return task.deferLater(reactor, 0, busy.pop)
+
+        yield handle.iterate(Query(self.Foo), handleBatch, batch_size=1)
+
+
     @defer.inlineCallbacks
     def test_interaction(self):
         """
@@ -256,6 +683,30 @@ class SqliteOrmHandleTest(ormHandleMixin, TestCase):
 
 
 
+class ThreadedSqliteOrmHandleTest(ormHandleMixin, TestCase):
+
+
+    timeout = 2
+
+
+    @defer.inlineCallbacks
+    def getPool(self):
+        pool = yield makePool('sqlite:', threaded=True)
+        self.addCleanup(pool.close)
+        yield pool.runOperation('''CREATE TABLE porc3 (
+            id INTEGER PRIMARY KEY,
+            age INTEGER
+        )''')
+        defer.returnValue(pool)
+
+
+    def test_iterate_backpressure(self):
+        pass
+    test_iterate_backpressure.skip = ("Interactions run in a thread, so "
+                                      "they can't wait on the reactor")
+
+
+
 class PostgresOrmHandleTest(ormHandleMixin, TestCase):
 
 
@@ -6,12 +6,20 @@ from twisted.internet import defer
 from zope.interface.verify import verifyObject
 
 from mock import MagicMock
+from datetime import date, datetime
 
 from norm.interface import IAsyncCursor
 from norm.common import BlockingCursor
-from norm.postgres import PostgresCursorWrapper
+from norm.postgres import (PostgresCursorWrapper, BlockingPostgresCursor,
+                           copyData, numberParams, StatementCache)
 from norm.test.util import postgresConnStr
 
+try:
+    from norm.tx_postgres import TxPostgresCursor
+    skip_txpostgres = ''
+except ImportError:
+    skip_txpostgres = 'txpostgres is not installed'
+
 
 
 class PostgresCursorWrapperTest(TestCase):
@@ -39,10 +47,291 @@ class PostgresCursorWrapperTest(TestCase):
         self.assertCallThrough('fetchall')
 
 
+    def test_fetchmany(self):
+        self.assertCallThrough('fetchmany', 10)
+
+
+    def test_executemany(self):
+        self.assertCallThrough('executemany', 'foo %s', [(1,), (2,)])
+        self.assertCallThrough('executemany', 'foo', [])
+
+
+    def test_stream(self):
+        """
+        The SQL is translated before being streamed.
+        """
+        mock = MagicMock()
+        mock.stream.return_value = defer.succeed('foo')
+        cursor = PostgresCursorWrapper(mock)
+        func = MagicMock()
+        result = cursor.stream('select ?', (1,), func, 10)
+        mock.stream.assert_called_once_with('select %s', (1,), func, 10)
+        self.assertEqual(self.successResultOf(result), 'foo')
+
+
+    def test_rowCount(self):
+        self.assertCallThrough('rowCount')
+
+
+    def test_copyFrom(self):
+        self.assertCallThrough('copyFrom', 'foo', ['a', 'b'], [(1, 2)])
+
+
     def test_close(self):
         self.assertCallThrough('close')
 
 
+    def test_execute_statements(self):
+        """
+        If given a L{StatementCache}, execution goes through it.
+        """
+        mock = MagicMock()
+        mock.execute.side_effect = lambda *args: defer.succeed('foo')
+        statements = StatementCache(threshold=1)
+        cursor = PostgresCursorWrapper(mock, statements)
+
+        result = cursor.execute('select ? from foo', (1,))
+        self.assertEqual(self.successResultOf(result), 'foo')
+        self.assertEqual(mock.execute.call_args_list[-1][0],
+                         ('EXECUTE norm_stmt_0 (%s)', (1,)))
+
+
+
+class BlockingPostgresCursorTest(TestCase):
+
+
+    def test_IAsyncCursor(self):
+        verifyObject(IAsyncCursor, BlockingPostgresCursor(None))
+
+
+    def test_copyFrom(self):
+        """
+        Rows are sent to COPY FROM STDIN in the text format.
+        """
+        mock = MagicMock()
+        cursor = BlockingPostgresCursor(mock)
+        self.successResultOf(cursor.copyFrom('foo', ['a', 'b'],
+                                             [(1, None), (True, 'x')]))
+        sql, data = mock.copy_expert.call_args[0]
+        self.assertEqual(sql, 'COPY foo (a,b) FROM STDIN')
+        self.assertEqual(data.read(), '1\t\\N\nt\tx\n')
+
+
+    def test_stream(self):
+        """
+        Results are streamed with a named (server-side) cursor, which is
+        closed afterward.
+        """
+        mock = MagicMock()
+        named = mock.connection.cursor.return_value
+        named.fetchmany.side_effect = [[(1,), (2,)], [(3,)], []]
+        cursor = BlockingPostgresCursor(mock)
+        batches = []
+        self.successResultOf(cursor.stream('select %s', (1,),
+                                           batches.append, 2))
+        self.assertEqual(batches, [[(1,), (2,)], [(3,)]])
+        name = mock.connection.cursor.call_args[0][0]
+        self.assertTrue(name.startswith('norm_stream_'))
+        named.execute.assert_called_once_with('select %s', (1,))
+        self.assertEqual(named.fetchmany.call_args_list[0][0], (2,))
+        named.close.assert_called_once_with()
+        self.assertEqual(mock.execute.call_count, 0)
+
+
+
+class copyDataTest(TestCase):
+
+
+    def test_escape(self):
+        """
+        Special characters are escaped.
+        """
+        self.assertEqual(copyData([('a\tb\nc\\d\re',)]),
+                         'a\\tb\\nc\\\\d\\re\n')
+
+
+    def test_types(self):
+        """
+        Database-ready values of various types are formatted.
+        """
+        self.assertEqual(copyData([
+            (None, False, 12, u'\N{SNOWMAN}', date(2001, 2, 3),
+             datetime(2001, 2, 3, 4, 5, 6), buffer('\x00\xff')),
+        ]), '\\N\tf\t12\t\xe2\x98\x83\t2001-02-03\t2001-02-03T04:05:06'
+            '\t\\\\x00ff\n')
+
+
+
+class numberParamsTest(TestCase):
+
+
+    def test_number(self):
+        self.assertEqual(numberParams('select %s, %s from foo where a = %s'),
+                         'select $1, $2 from foo where a = $3')
+        self.assertEqual(numberParams('select 1'), 'select 1')
+
+
+
+class StatementCacheTest(TestCase):
+
+
+    def setUp(self):
+        self.called = []
+
+
+    def execute(self, sql, params=()):
+        self.called.append((sql, params))
+        return defer.succeed(sql)
+
+
+    def test_threshold(self):
+        """
+        Statements are prepared once they have been executed C{threshold}
+        times, and executed with EXECUTE after that.
+        """
+        cache = StatementCache(threshold=2)
+        sql = 'select a from foo where b = %s'
+        cache.execute(self.execute, sql, (1,))
+        self.assertEqual(self.called, [(sql, (1,))])
+        self.assertEqual(cache.prepared(), [])
+
+        self.called = []
+        cache.execute(self.execute, sql, (2,))
+        self.assertEqual(self.called, [
+            ('SAVEPOINT norm_prepare', ()),
+            ('PREPARE norm_stmt_0 AS select a from foo where b = $1', ()),
+            ('RELEASE SAVEPOINT norm_prepare', ()),
+            ('EXECUTE norm_stmt_0 (%s)', (2,)),
+        ])
+        self.assertEqual(cache.prepared(), [sql])
+
+        self.called = []
+        cache.execute(self.execute, sql, (3,))
+        self.assertEqual(self.called, [('EXECUTE norm_stmt_0 (%s)', (3,))])
+
+
+    def test_notPrepared(self):
+        """
+        Statements without parameters, with literal percent signs or which
+        aren't queries or DML aren't prepared.
+        """
+        cache = StatementCache(threshold=1)
+        for sql, params in [
+                ('select 1', ()),
+                ("select a from foo where b like 'a%%' and c = %s", (1,)),
+                ('DECLARE foo CURSOR FOR select %s', (1,)),
+                ('select %s', (1, 2)),
+            ]:
+            self.called = []
+            cache.execute(self.execute, sql, params)
+            self.assertEqual(self.called, [(sql, params)])
+        self.assertEqual(cache.prepared(), [])
+
+
+    def test_evict(self):
+        """
+        When there are too many prepared statements, the least recently used
+        one is deallocated.
+        """
+        cache = StatementCache(size=2, threshold=1)
+        cache.execute(self.execute, 'select %s', (1,))
+        cache.execute(self.execute, 'update foo set a = %s', (1,))
+        cache.execute(self.execute, 'select %s', (1,))
+
+        self.called = []
+        cache.execute(self.execute, 'delete from foo where a = %s', (1,))
+        self.assertEqual(self.called, [
+            ('DEALLOCATE norm_stmt_1', ()),
+            ('SAVEPOINT norm_prepare', ()),
+            ('PREPARE norm_stmt_2 AS delete from foo where a = $1', ()),
+            ('RELEASE SAVEPOINT norm_prepare', ()),
+            ('EXECUTE norm_stmt_2 (%s)', (1,)),
+        ])
+        self.assertEqual(cache.prepared(), ['select %s',
+                                            'delete from foo where a = %s'])
+
+
+    def test_prepareFails(self):
+        """
+        If a statement can't be prepared, the savepoint it was prepared in is
+        rolled back, the statement is executed as usual and it isn't prepared
+        again.
+        """
+        cache = StatementCache(threshold=1)
+        def execute(sql, params=()):
+            self.called.append((sql, params))
+            if sql.startswith('PREPARE'):
+                return defer.fail(Exception('foo'))
+            return defer.succeed(sql)
+
+        result = cache.execute(execute, 'select %s', (1,))
+        self.assertEqual(self.successResultOf(result), 'select %s')
+        self.assertEqual(self.called, [
+            ('SAVEPOINT norm_prepare', ()),
+            ('PREPARE norm_stmt_0 AS select $1', ()),
+            ('ROLLBACK TO SAVEPOINT norm_prepare', ()),
+            ('RELEASE SAVEPOINT norm_prepare', ()),
+            ('select %s', (1,)),
+        ])
+
+        self.called = []
+        cache.execute(execute, 'select %s', (1,))
+        self.assertEqual(self.called, [('select %s', (1,))])
+        self.assertEqual(cache.prepared(), [])
+
+
+    def test_noTransaction(self):
+        """
+        Outside a transaction, where SAVEPOINT fails, statements are prepared
+        without one.
+        """
+        cache = StatementCache(threshold=1)
+        def execute(sql, params=()):
+            self.called.append((sql, params))
+            if sql.startswith('SAVEPOINT'):
+                return defer.fail(Exception('no transaction'))
+            return defer.succeed(sql)
+
+        result = cache.execute(execute, 'select %s', (1,))
+        self.assertEqual(self.successResultOf(result),
+                         'EXECUTE norm_stmt_0 (%s)')
+        self.assertEqual(self.called, [
+            ('SAVEPOINT norm_prepare', ()),
+            ('PREPARE norm_stmt_0 AS select $1', ()),
+            ('EXECUTE norm_stmt_0 (%s)', (1,)),
+        ])
+
+
+
+class TxPostgresCursorTest(TestCase):
+
+
+    skip = skip_txpostgres
+
+
+    def setUp(self):
+        self.pg_cursor = MagicMock()
+        self.pg_cursor.mogrify.side_effect = lambda sql, params: (
+            sql.replace('%s', "'%s'") % params)
+        self.cursor = TxPostgresCursor(self.pg_cursor, MagicMock())
+        self.cursor.poll = lambda: defer.succeed(None)
+
+
+    def test_executemany(self):
+        """
+        The statements are mogrified and sent in pages, which aren't
+        formatted again, so values may have percent signs in them.
+        """
+        d = self.cursor.executemany('insert into foo (a) values (?)',
+                                    [('50%',), ('a%sb',), ('c',)],
+                                    page_size=2)
+        self.successResultOf(d)
+        self.assertEqual([x[0] for x in self.pg_cursor.execute.call_args_list],
+            [("insert into foo (a) values ('50%');"
+              "insert into foo (a) values ('a%sb')", None),
+             ("insert into foo (a) values ('c')", None)])
+
+
 
 class PostgresCursorWrapperFunctionalTest(TestCase):
 
@@ -71,3 +360,37 @@ class PostgresCursorWrapperFunctionalTest(TestCase):
         return d.addCallback(check)
 
 
+    @defer.inlineCallbacks
+    def test_executemany(self):
+        """
+        A query can be executed for each of several sets of params.
+        """
+        connstr = postgresConnStr()
+        import psycopg2
+        db = psycopg2.connect(connstr)
+        self.addCleanup(db.close)
+        wrapped = PostgresCursorWrapper(BlockingPostgresCursor(db.cursor()))
+
+        yield wrapped.execute('create temporary table foo (name text)')
+        yield wrapped.executemany('insert into foo (name) values (?)',
+                                  [('a',), ('b',), ('c',)])
+        yield wrapped.execute('select name from foo order by name')
+        rows = yield wrapped.fetchall()
+        self.assertEqual(rows, [('a',), ('b',), ('c',)])
+
+
+    @defer.inlineCallbacks
+    def test_stream(self):
+        """
+        Results can be streamed from a server-side cursor.
+        """
+        connstr = postgresConnStr()
+        import psycopg2
+        db = psycopg2.connect(connstr)
+        self.addCleanup(db.close)
+        wrapped = PostgresCursorWrapper(BlockingPostgresCursor(db.cursor()))
+
+        batches = []
+        yield wrapped.stream('select generate_series(1, ?)', (5,),
+                             batches.append, 2)
+        self.assertEqual(batches, [[(1,), (2,)], [(3,), (4,)], [(5,)]])
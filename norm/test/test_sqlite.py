@@ -45,6 +45,18 @@ class SqliteCursorWrapperTest(TestCase):
         self.assertCallThrough('lastRowId')
 
 
+    def test_stream(self):
+        self.assertCallThrough('stream', 'foo', (1,), list, 10)
+
+
+    def test_executemany(self):
+        self.assertCallThrough('executemany', 'foo', [(1,), (2,)])
+
+
+    def test_rowCount(self):
+        self.assertCallThrough('rowCount')
+
+
     def test_close(self):
         self.assertCallThrough('close')
 
@@ -2,11 +2,12 @@
 # See LICENSE for details.
 
 from zope.interface import implements
+from twisted.internet import defer
 from txpostgres import txpostgres
 import psycopg2.extras
 
 from norm.interface import IAsyncCursor
-from norm.postgres import translateSQL
+from norm.postgres import translateSQL, _cursor_names
 
 
 
@@ -18,15 +19,65 @@ class TxPostgresCursor(txpostgres.Cursor):
 
     def execute(self, sql, params=()):
         sql = translateSQL(sql)
+        statements = getattr(self._connection, 'statements', None)
+        if statements is not None:
+            return statements.execute(self._execute, sql, params)
+        return self._execute(sql, params)
+
+
+    def _execute(self, sql, params=None):
         return txpostgres.Cursor.execute(self, sql, params)
 
 
+    def executemany(self, sql, param_list, page_size=100):
+        """
+        Execute C{sql} for each set of params.  Asynchronous psycopg2
+        cursors can't C{executemany}, so (like psycopg2's C{execute_batch})
+        the statements are sent in pages of C{page_size} statements each.
+        """
+        sql = translateSQL(sql)
+        param_list = list(param_list)
+        d = defer.succeed(None)
+        for i in xrange(0, len(param_list), page_size):
+            page = ';'.join([self.mogrify(sql, params)
+                             for params in param_list[i:i+page_size]])
+            # the page is already mogrified, so it mustn't be formatted
+            # again (which would choke on any % in the values)
+            d.addCallback(lambda _, page=page: self._execute(page, None))
+        return d
+
+
+    @defer.inlineCallbacks
+    def stream(self, sql, params, func, size=1000):
+        """
+        Execute C{sql} through a server-side cursor (made with C{DECLARE},
+        since asynchronous connections can't have named cursors) so that
+        only C{size} rows at a time are sent from the database.
+
+        This must be run inside a transaction (which any interaction is).
+        """
+        name = 'norm_stream_%d' % (_cursor_names.next(),)
+        yield self.execute('DECLARE %s NO SCROLL CURSOR FOR %s' % (name, sql),
+                           params)
+        while True:
+            yield self.execute('FETCH FORWARD %d FROM %s' % (size, name))
+            rows = yield self.fetchall()
+            if not rows:
+                break
+            yield func(rows)
+        yield self.execute('CLOSE %s' % (name,))
+
+
     def lastRowId(self):
         d = self.execute('select lastval()')
         d.addCallback(lambda _: self.fetchone())
         return d.addCallback(lambda row: row[0])
 
 
+    def rowCount(self):
+        return defer.succeed(self.rowcount)
+
+
 
 def dict_connect(*args, **kwargs):
     kwargs['connection_factory'] = psycopg2.extras.DictConnection
@@ -35,8 +86,18 @@ def dict_connect(*args, **kwargs):
 
 
 class DictConnection(txpostgres.Connection):
+    """
+    @ivar statements: An optional L{StatementCache} used by my cursors to
+        prepare frequently executed statements.
+    """
 
 
     cursorFactory = TxPostgresCursor
     connectionFactory = staticmethod(dict_connect)
+    statements = None
+
+
+    def runMany(self, sql, param_list):
+        return self.runInteraction(lambda cursor:
+                                   cursor.executemany(sql, param_list))
 